@@ -0,0 +1,169 @@
+"""
+Microbenchmark for fbw_a32nx_winwing_cdu.parse_fbw_segment
+
+Compares the state machine parser against the previous implementation (kept below as
+parse_fbw_segment_legacy), which looked up colour, size and alignment for every character by scanning
+the format stack. Both parsers run uncached on every title, line, page and scratchpad segment of the
+corpus and must return the same characters, the benchmark aborts otherwise.
+The cached parser is measured as well, as it is used by create_mobi_json.
+
+The default corpus (corpus/fbw_a32nx_pages.json) holds A32NX F-PLN and PERF pages as they are sent by
+SimBridge in the "left"/"right" objects of an "update:" message. Any file with the same layout,
+a list of {"name": ..., "content": {...}} objects, can be passed on the command line.
+
+Usage:
+    python bench_fbw_segments.py [pages.json] [--rounds N]
+"""
+
+import argparse
+from collections import deque
+import json
+import logging
+import os
+import sys
+import time
+from typing import Callable, List, Literal, Tuple, Union
+
+# The bridge scripts live in the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fbw_a32nx_winwing_cdu as fbw  # pylint: disable=wrong-import-position,import-error
+from fbw_a32nx_winwing_cdu import MfCharSize, MfColour  # pylint: disable=wrong-import-position,import-error
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+DEFAULT_PAGES = os.path.join(CORPUS_DIR, "fbw_a32nx_pages.json")
+
+Segment = Tuple[str, bool]
+
+FormatStack = deque[Union[MfCharSize, MfColour, Literal["left", "right"]]]
+
+
+def get_format_colour(format_stack: FormatStack) -> MfColour:
+    return next((x for x in format_stack if isinstance(x, MfColour)), MfColour.White)
+
+
+def get_format_size(format_stack: FormatStack, is_label_line: bool) -> MfCharSize:
+    return next(
+        (x for x in format_stack if isinstance(x, MfCharSize)),
+        MfCharSize.Small if is_label_line else MfCharSize.Large,
+    )
+
+
+def get_format_alignment(format_stack: FormatStack) -> Union[Literal["left", "right"], None]:
+    return next((x for x in format_stack if x == "left" or x == "right"), None)
+
+
+def parse_fbw_segment_legacy(segment: str, is_label_line: bool) -> fbw.ParsedSegment:
+    """The parser as it was before the format state was tracked while parsing."""
+    normal_chars: List[fbw.MfMcduChar] = []
+    left_chars: List[fbw.MfMcduChar] = []
+    right_chars: List[fbw.MfMcduChar] = []
+
+    format_stack: FormatStack = deque()
+    tag = None
+
+    last_match_index = 0
+    for match in fbw.FBW_TAG_REGEX.finditer(segment):
+        match get_format_alignment(format_stack):
+            case "left":
+                current_chars = left_chars
+            case "right":
+                current_chars = right_chars
+            case _:
+                current_chars = normal_chars
+
+        for c in segment[last_match_index:match.start()]:
+            current_chars.append(
+                (
+                    fbw.REPLACED_CHARS.get(c, c),
+                    get_format_colour(format_stack),
+                    get_format_size(format_stack, is_label_line),
+                )
+            )
+        last_match_index = match.end()
+
+        tag = match.group(1)
+        match tag:
+            case "end":
+                format_stack.popleft()
+            case "small":
+                format_stack.appendleft(MfCharSize.Small)
+            case "big":
+                format_stack.appendleft(MfCharSize.Large)
+            case "sp":
+                current_chars.append(tuple())
+            case "left" | "right":
+                format_stack.appendleft(tag)
+            case _ if tag in fbw.FBW_COLOUR_TAGS:
+                format_stack.appendleft(fbw.FBW_COLOUR_TAGS[tag])
+            case _:
+                format_stack.appendleft(None)
+
+    for c in segment[last_match_index:]:
+        current_chars.append(
+            (
+                fbw.REPLACED_CHARS.get(c, c),
+                get_format_colour(format_stack),
+                get_format_size(format_stack, is_label_line),
+            )
+        )
+
+    if len(normal_chars) > fbw.CDU_COLUMNS:
+        diff = len(normal_chars) - fbw.CDU_COLUMNS
+        normal_chars = normal_chars[diff // 2:-((diff + 1) // 2)]
+
+    return tuple(normal_chars), tuple(left_chars[:fbw.CDU_COLUMNS]), tuple(right_chars[:fbw.CDU_COLUMNS])
+
+
+def page_segments(content: dict) -> List[Segment]:
+    """Returns the segments of a page together with the is_label_line flag create_mobi_json uses for them."""
+    segments: List[Segment] = []
+    for key, is_label_line in (("titleLeft", False), ("title", False), ("page", True)):
+        if content.get(key) is not None:
+            segments.append((content[key], is_label_line))
+    for line_idx, line in enumerate(content.get("lines", [])[:fbw.CDU_ROWS - 1]):
+        segments.extend((segment, line_idx % 2 == 0) for segment in line[:3] if segment)
+    if content.get("scratchpad") is not None:
+        segments.append((content["scratchpad"], False))
+    return segments
+
+
+def segments_per_second(parser: Callable[[str, bool], fbw.ParsedSegment], segments: List[Segment], rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for segment, is_label_line in segments:
+            parser(segment, is_label_line)
+    return rounds * len(segments) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pages", nargs="?", default=DEFAULT_PAGES, help="JSON list of SimBridge MCDU pages")
+    parser.add_argument("--rounds", type=int, default=500, help="passes over all segments per parser")
+    args = parser.parse_args()
+
+    with open(args.pages, "r", encoding="utf-8") as file:
+        pages = json.load(file)
+    segments: List[Segment] = [segment for page in pages for segment in page_segments(page["content"])]
+    logging.info("Loaded %s pages with %s segments from %s", len(pages), len(segments), args.pages)
+
+    uncached: Callable[[str, bool], fbw.ParsedSegment] = fbw.parse_fbw_segment.__wrapped__
+    for segment, is_label_line in segments:
+        if uncached(segment, is_label_line) != parse_fbw_segment_legacy(segment, is_label_line):
+            logging.error("State machine output differs from the legacy parser for %r", segment)
+            sys.exit(1)
+
+    legacy_rate = segments_per_second(parse_fbw_segment_legacy, segments, args.rounds)
+    state_rate = segments_per_second(uncached, segments, args.rounds)
+    cached_rate = segments_per_second(fbw.parse_fbw_segment, segments, args.rounds)
+
+    logging.info("before (format stack scans): %12.1f segments/s", legacy_rate)
+    logging.info("after  (state machine):      %12.1f segments/s", state_rate)
+    logging.info("after  (cached):             %12.1f segments/s", cached_rate)
+    logging.info("speed-up uncached: %.1fx", state_rate / legacy_rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark for pmdg_737_winwing_cdu.create_mobi_json
+
+Compares the lookup-table renderer against the previous per-cell implementation (kept below as
+create_mobi_json_legacy) on a 1008 byte PMDG 737 CDU buffer and reports frames per second for both.
+Both renderers must produce the exact same JSON, the benchmark aborts otherwise.
+
+The default buffer (corpus/pmdg_737_legs.bin) is a RTE LEGS page in the PMDG_NG3_SDK.h broadcast layout:
+24 x 14 cells in column-major order, 3 bytes per cell (symbol, colour, flags).
+Any other buffer dumped from the SimConnect callback can be passed on the command line.
+
+Usage:
+    python bench_pmdg_737.py [buffer.bin] [--frames N]
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from typing import Callable, Dict, List, Union
+
+# The bridge scripts live in the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pmdg_737_winwing_cdu as pmdg  # pylint: disable=wrong-import-position,import-error
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+DEFAULT_BUFFER = os.path.join(CORPUS_DIR, "pmdg_737_legs.bin")
+
+
+def create_mobi_json_legacy(data: bytes) -> str:
+    """The per-cell renderer as it was before the lookup table was introduced."""
+    message: Dict[str, Union[str, List[List[Union[str, int]]]]] = {
+        "Target": "Display",
+        "Data": [[] for _ in range(pmdg.CDU_CELLS)]
+    }
+
+    for x in range(pmdg.CDU_COLUMNS):
+        for y in range(pmdg.CDU_ROWS):
+            src_idx: int = (x * pmdg.CDU_ROWS + y) * pmdg.CDU_CELL_BYTE_COUNT
+            dst_idx: int = y * pmdg.CDU_COLUMNS + x
+
+            if src_idx + 2 >= len(data):
+                message["Data"][dst_idx] = []
+                continue
+
+            symbol: str = chr(data[src_idx])
+            is_lowercase: bool = symbol.islower()
+            symbol = symbol.upper()
+            color: int = data[src_idx + 1]
+            flags: int = data[src_idx + 2]
+
+            if symbol == ' ' or symbol == '\0':
+                message["Data"][dst_idx] = []
+            else:
+                if symbol == '\xA1': symbol = "\u2190"
+                elif symbol == '\xA2': symbol = "\u2192"
+                elif symbol == '\xA3': symbol = "\u2191"
+                elif symbol == '\xA4': symbol = "\u2193"
+                elif symbol == '\u00CA': symbol = "\u2610"
+
+                if flags & pmdg.CDU_FLAG_UNUSED:
+                    color_str: str = "e"
+                elif flags & pmdg.CDU_FLAG_REVERSE:
+                    color_str = "e"
+                else:
+                    color_str = {
+                        pmdg.CDU_COLOR_WHITE: "w",
+                        pmdg.CDU_COLOR_CYAN: "c",
+                        pmdg.CDU_COLOR_GREEN: "g",
+                        pmdg.CDU_COLOR_MAGENTA: "m",
+                        pmdg.CDU_COLOR_AMBER: "a",
+                        pmdg.CDU_COLOR_RED: "r"
+                    }.get(color, "w")
+
+                message["Data"][dst_idx] = [
+                    symbol,
+                    color_str,
+                    1 if (is_lowercase) or (flags & pmdg.CDU_FLAG_SMALL_FONT) else 0
+                ]
+
+    return json.dumps(message)
+
+
+def frames_per_second(renderer: Callable[[bytes], str], data: bytes, frames: int) -> float:
+    start = time.perf_counter()
+    for _ in range(frames):
+        renderer(data)
+    return frames / (time.perf_counter() - start)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("buffer", nargs="?", default=DEFAULT_BUFFER, help="raw PMDG CDU buffer (1008 bytes)")
+    parser.add_argument("--frames", type=int, default=5000, help="frames to render per implementation")
+    args = parser.parse_args()
+
+    with open(args.buffer, "rb") as file:
+        data = file.read()
+    logging.info("Loaded %s (%s bytes)", args.buffer, len(data))
+
+    if pmdg.create_mobi_json(data) != create_mobi_json_legacy(data):
+        logging.error("Lookup-table output differs from the legacy renderer")
+        sys.exit(1)
+
+    legacy_fps = frames_per_second(create_mobi_json_legacy, data, args.frames)
+    table_fps = frames_per_second(pmdg.create_mobi_json, data, args.frames)
+
+    logging.info("before (per-cell loop): %10.1f frames/s", legacy_fps)
+    logging.info("after  (lookup table):  %10.1f frames/s", table_fps)
+    logging.info("speed-up: %.1fx", table_fps / legacy_fps)
+
+
+if __name__ == "__main__":
+    main()
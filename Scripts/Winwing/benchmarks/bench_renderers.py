@@ -0,0 +1,271 @@
+"""
+Benchmark suite for the display conversion of every CDU bridge
+
+Every bridge has its own conversion from the aircraft's CDU data to the MobiFlight display JSON
+(create_mobi_json, generate_display_json, DisplayFrame.update, parse_fsl_mcdu). This suite loads the corpus
+of every bridge (corpus/<renderer>.json, see build_corpus.py) and runs its conversion in isolation:
+- time per frame: fastest of several passes over all frames of the corpus, also expressed relative to a
+  fixed reference conversion timed alongside, so a machine that is busier or clocked lower than when
+  the baseline was taken does not show up as a regression
+- allocations per frame: peak memory allocated while converting a frame (tracemalloc)
+- output size: average size of the display JSON in bytes
+The frames are prepared the way the bridge hands them to its conversion (base64 and dataref decoding is not
+measured). Conversions with caches (FBW and Headwind segments, ProSim 737 lines) are measured warm, as the
+same pages come up again and again in flight.
+
+The results are compared with a stored baseline (baseline.json) and the suite exits with status 1 if any
+conversion got relatively slower or allocates more than the tolerance allows, or if its output size changed.
+Times and allocations are only compared if the baseline was taken with the same Python version and platform,
+output sizes are always compared. Store a new baseline with --update-baseline after an intended change.
+
+Only the scripts' own dependencies (websockets, SimConnect, gql) need to be installed, no simulator is used.
+Scripts that cannot be imported are reported as skipped. The EC135 bridge draws its screen inline and has
+no conversion that can be run in isolation.
+
+Usage:
+    python bench_renderers.py [renderer ...] [--rounds N] [--tolerance T] [--update-baseline]
+"""
+
+import argparse
+import base64
+import importlib
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from types import ModuleType
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+# The bridge scripts live in the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(BENCHMARK_DIR, "corpus")
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, "baseline.json")
+DEFAULT_TOLERANCE = 0.25
+
+
+class RendererCase(NamedTuple):
+    name: str
+    module: str
+    corpus: str
+    # Turns a corpus frame into the input of the conversion, not measured
+    prepare: Callable[[ModuleType, Any], Any]
+    # Runs the conversion on a prepared frame and returns the display JSON
+    render: Callable[[ModuleType, Any], str]
+
+
+class Result(NamedTuple):
+    frames: int
+    us_per_frame: float
+    # us_per_frame divided by the time of the reference conversion
+    relative_time: float
+    peak_kib_per_frame: float
+    output_bytes: float
+
+
+def from_base64(_module: ModuleType, frame: str) -> bytes:
+    return base64.b64decode(frame)
+
+
+def unchanged(_module: ModuleType, frame: Any) -> Any:
+    return frame
+
+
+def decoded_datarefs(module: ModuleType, frame: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: module.decode_dataref_value(name, value) for name, value in frame.items()}
+
+
+def ifly_screen(module: ModuleType, frame: Dict[str, str]) -> Any:
+    return module.CduScreenSnapshot(*(base64.b64decode(frame[key]) for key in ("chars", "small_font", "colors")))
+
+
+def md80_lines(module: ModuleType, frame: Dict[str, str]) -> List[str]:
+    """The lines as handle_dataref_updates() collects them from the cdu_line_NN datarefs."""
+    lines = [""] * module.CDU_ROWS
+    for name, value in frame.items():
+        lines[int(name.split("_")[-1]) - 1] = base64.b64decode(value).decode("utf-8", errors="ignore").replace("\x00", " ")
+    return lines
+
+
+def display_frame_update(module: ModuleType, values: Dict[str, Any]) -> str:
+    return module.DisplayFrame(module.get_line_number, module.render_line).update(values)
+
+
+CASES: List[RendererCase] = [
+    RendererCase("pmdg_737", "pmdg_737_winwing_cdu", "pmdg_737.json", from_base64, lambda m, x: m.create_mobi_json(x)),
+    RendererCase("pmdg_777", "pmdg_777_winwing_cdu", "pmdg_777.json", from_base64, lambda m, x: m.create_mobi_json(x)),
+    RendererCase("aerosoft_crj", "aerosoft_crj_winwing_cdu", "aerosoft_crj.json", from_base64, lambda m, x: m.create_mobi_json(x)),
+    RendererCase("maddogx", "maddogx_winwing_cdu", "maddogx.json", from_base64, lambda m, x: m.create_mobi_json(x)),
+    RendererCase("ini_a340", "ini_a340_winwing_cdu", "ini_a340.json", from_base64, lambda m, x: m.create_mobi_json(x)),
+    RendererCase("tfdi_md11", "tfdi_md11_winwing_cdu", "tfdi_md11.json", from_base64, lambda m, x: m.create_mobi_json(x)),
+    RendererCase("ifly_737", "ifly_737_winwing_cdu", "ifly_737.json", ifly_screen, lambda m, x: json.dumps(m.create_mobi_json(x))),
+    RendererCase("zibo_737_800x", "zibo_737_800x", "zibo_737_800x.json", decoded_datarefs, lambda m, x: m.generate_display_json(x)),
+    RendererCase("toliss_a3xx", "toliss_a3xx", "toliss_a3xx.json", decoded_datarefs, lambda m, x: m.generate_display_json(x)),
+    RendererCase("hotstart_cl650", "hotstart_cl650", "hotstart_cl650.json", unchanged, display_frame_update),
+    RendererCase("flightfactor_75_76", "flightfactor_75_76", "flightfactor_75_76.json", decoded_datarefs,
+                 lambda m, x: m.generate_display_json(m.CduDevice.Captain, x)),
+    RendererCase("flightfactor_777v2", "flightfactor_777v2", "flightfactor_777v2.json", decoded_datarefs,
+                 lambda m, x: m.generate_display_json(m.CduDevice.Captain, x)),
+    RendererCase("rotate_md11", "rotate_md11", "rotate_md11.json", decoded_datarefs,
+                 lambda m, x: m.generate_display_json(x, m.CduDevice.Captain)),
+    RendererCase("rotate_md80", "rotate_md80", "rotate_md80.json", md80_lines, lambda m, x: m.generate_display_json(x)),
+    RendererCase("fbw_a32nx", "fbw_a32nx_winwing_cdu", "fbw_a32nx_pages.json", unchanged, lambda m, x: m.create_mobi_json(x)),
+    RendererCase("headwind_a33", "headwind_a33_winwing_cdu", "fbw_a32nx_pages.json", unchanged, lambda m, x: m.create_mobi_json(x)),
+    RendererCase("fenix", "fenix_winwing_cdu", "fenix.json", unchanged, lambda m, x: m.create_mobi_json(x)),
+    RendererCase("prosim_a320", "prosim_a320_winwing_cdu", "prosim_a320.json", unchanged, lambda m, x: m.create_mobi_json(x)),
+    RendererCase("prosim_737", "prosim_737_winwing_cdu", "prosim_737.json", unchanged, lambda m, x: m.create_mobi_json(x)),
+    RendererCase("fslabs", "fslabs_winwing_cdu", "fslabs.json", unchanged, lambda m, x: m.parse_fsl_mcdu(x)),
+]
+
+
+def environment() -> str:
+    """Identifies where a measurement was taken, times are only comparable within the same environment."""
+    return f"{platform.python_implementation()} {platform.python_version()} {platform.system()} {platform.machine()}"
+
+
+def load_frames(path: str) -> List[Any]:
+    with open(path, "r", encoding="utf-8") as file:
+        corpus = json.load(file)
+    # The SimBridge page collection is a plain list of named pages
+    if isinstance(corpus, list):
+        return [page["content"] for page in corpus]
+    return list(corpus["frames"])
+
+
+def timed_pass(render: Callable[[Any], Any], inputs: List[Any]) -> float:
+    start = time.perf_counter()
+    for frame in inputs:
+        render(frame)
+    return (time.perf_counter() - start) / len(inputs)
+
+
+# A screen of display cells as every bridge produces it, converted the way the bridges build their JSON
+REFERENCE_CELLS: List[List[Any]] = [[chr(65 + index % 26), "w" if index % 3 else "g", index % 2]
+                                    for index in range(336)]
+
+
+def reference_conversion(cells: List[List[Any]]) -> str:
+    return json.dumps({"Target": "Display", "Data": [cell if cell[0] != " " else [] for cell in cells]})
+
+
+def measure(render: Callable[[Any], str], inputs: List[Any], rounds: int) -> Result:
+    # The first pass warms up caches and lookup tables and determines the output size
+    output_bytes = sum(len(render(frame).encode("utf-8")) for frame in inputs) / len(inputs)
+
+    # Passes of the conversion and of the reference alternate so both see the same conditions, the fastest
+    # pass of each is the one least disturbed by the rest of the system
+    reference_inputs = [REFERENCE_CELLS] * len(inputs)
+    seconds = reference = float("inf")
+    for _ in range(rounds):
+        seconds = min(seconds, timed_pass(render, inputs))
+        reference = min(reference, timed_pass(reference_conversion, reference_inputs))
+
+    peaks: List[int] = []
+    tracemalloc.start()
+    try:
+        for frame in inputs:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            render(frame)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+    finally:
+        tracemalloc.stop()
+
+    return Result(
+        frames=len(inputs),
+        us_per_frame=seconds * 1e6,
+        relative_time=seconds / reference,
+        peak_kib_per_frame=sum(peaks) / len(peaks) / 1024,
+        output_bytes=output_bytes,
+    )
+
+
+def run_case(case: RendererCase, rounds: int) -> Optional[Result]:
+    try:
+        module = importlib.import_module(case.module)
+    except ImportError as e:
+        logging.warning("%-20s skipped, %s cannot be imported: %s", case.name, case.module, e)
+        return None
+    inputs = [case.prepare(module, frame) for frame in load_frames(os.path.join(CORPUS_DIR, case.corpus))]
+    return measure(lambda frame: case.render(module, frame), inputs, rounds)
+
+
+def regressions(result: Result, baseline: Dict[str, float], tolerance: float, compare_costs: bool) -> List[str]:
+    found: List[str] = []
+    if round(result.output_bytes) != round(baseline["output_bytes"]):
+        found.append(f"output size {baseline['output_bytes']:.0f} -> {result.output_bytes:.0f} bytes")
+    if compare_costs:
+        if result.relative_time > baseline["relative_time"] * (1 + tolerance):
+            found.append(f"relative time {baseline['relative_time']:.2f} -> {result.relative_time:.2f}")
+        if result.peak_kib_per_frame > baseline["peak_kib_per_frame"] * (1 + tolerance):
+            found.append(f"allocations {baseline['peak_kib_per_frame']:.1f} -> {result.peak_kib_per_frame:.1f} KiB/frame")
+    return found
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("renderers", nargs="*", help="renderers to run, all by default")
+    parser.add_argument("--rounds", type=int, default=200, help="timed passes over the corpus")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed relative increase of time and allocations")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file to compare with or update")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the new baseline")
+    args = parser.parse_args()
+
+    # The bridges log at import and while converting, only the suite's own output is of interest
+    logging.getLogger().setLevel(logging.WARNING)
+    logger = logging.getLogger("bench_renderers")
+    logger.setLevel(logging.INFO)
+
+    unknown = set(args.renderers) - {case.name for case in CASES}
+    if unknown:
+        parser.error(f"unknown renderers: {', '.join(sorted(unknown))}")
+    cases = [case for case in CASES if not args.renderers or case.name in args.renderers]
+
+    baseline: Dict[str, Any] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+    compare_costs = baseline.get("environment") == environment()
+    if baseline and not compare_costs and not args.update_baseline:
+        logger.warning("Baseline was taken on %s, this is %s: only output sizes are compared",
+                       baseline.get("environment"), environment())
+
+    results: Dict[str, Result] = {}
+    failed = False
+    logger.info("%-20s %6s %12s %9s %12s %10s", "renderer", "frames", "us/frame", "relative", "KiB/frame", "bytes")
+    for case in cases:
+        result = run_case(case, args.rounds)
+        if result is None:
+            continue
+        results[case.name] = result
+        status = ""
+        reference = baseline.get("renderers", {}).get(case.name)
+        if reference is not None and not args.update_baseline:
+            found = regressions(result, reference, args.tolerance, compare_costs)
+            status = "REGRESSION: " + ", ".join(found) if found else "ok"
+            failed = failed or bool(found)
+        logger.info("%-20s %6s %12.1f %9.2f %12.1f %10.0f  %s", case.name, result.frames, result.us_per_frame,
+                    result.relative_time, result.peak_kib_per_frame, result.output_bytes, status)
+
+    if args.update_baseline:
+        # Renderers that were not run keep their stored values
+        renderers = dict(baseline.get("renderers", {})) if compare_costs else {}
+        renderers.update({name: result._asdict() for name, result in results.items()})
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump({"environment": environment(), "renderers": renderers}, file, indent=2, sort_keys=True)
+            file.write("\n")
+        logger.info("Stored baseline of %s renderers in %s", len(renderers), args.baseline)
+    elif failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+"""
+Builds the renderer benchmark corpus (corpus/<renderer>.json) from the SimBridge pages in corpus/fbw_a32nx_pages.json
+
+Recording the CDU feed of every aircraft needs every aircraft and simulator, so the corpus is derived from
+one set of real pages instead: every page is rendered by the FBW bridge into 24 x 14 cells (character,
+colour, size), and every screen is then encoded the way the other aircraft deliver their CDU:
+- SimConnect client data buffers (PMDG 737/777, CRJ, MaddogX, A340, MD-11) and the iFly shared memory arrays
+- X-Plane dataref values as sent by the Web API, base64 encoded strings and int arrays
+- Fenix, ProSim A320 and ProSim 737 display documents (XML)
+- FSLabs MCDU value lists
+SimBridge pages (FBW, Headwind) are used as they are. Characters an aircraft cannot represent are replaced
+by the nearest one it can, so the screens are close to, not identical with the FBW pages.
+
+A corpus file holds {"format": ..., "source": ..., "frames": [...]}, binary frames are base64 encoded.
+Frames recorded from a bridge can be added to or replace the derived ones.
+
+Usage:
+    python build_corpus.py [pages.json]
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import struct
+import sys
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+# The bridge scripts live in the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fbw_a32nx_winwing_cdu as fbw  # pylint: disable=wrong-import-position,import-error
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+DEFAULT_PAGES = os.path.join(CORPUS_DIR, "fbw_a32nx_pages.json")
+
+COLUMNS = 24
+ROWS = 14
+CELLS = COLUMNS * ROWS
+
+# Character, MobiFlight colour and size (0 large, 1 small) of a cell, None for an empty cell
+Cell = Optional[Tuple[str, str, int]]
+Screen = List[Cell]
+
+
+def load_screens(path: str) -> List[Screen]:
+    with open(path, "r", encoding="utf-8") as file:
+        pages = json.load(file)
+    screens: List[Screen] = []
+    for page in pages:
+        data = json.loads(fbw.create_mobi_json(page["content"]))["Data"]
+        screens.append([(str(cell[0]), str(cell[1]), int(cell[2])) if cell else None for cell in data])
+    return screens
+
+
+def rows(screen: Screen) -> List[Screen]:
+    return [screen[row * COLUMNS:(row + 1) * COLUMNS] for row in range(ROWS)]
+
+
+def symbol_byte(char: str, specials: Dict[str, int]) -> int:
+    if char in specials:
+        return specials[char]
+    code = ord(char)
+    return code if code < 256 else ord("?")
+
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+def b64_text(text: str) -> str:
+    return b64(text.encode("utf-8"))
+
+
+def split_row(row: Screen, key: Callable[[str, str, int], str], chars: Dict[str, str]) -> Dict[str, str]:
+    """Splits a row into one 24 character text per key, e.g. per colour dataref, blanks elsewhere."""
+    texts: Dict[str, List[str]] = {}
+    for column, cell in enumerate(row):
+        if cell is None:
+            continue
+        char, colour, size = cell
+        texts.setdefault(key(char, colour, size), [" "] * COLUMNS)[column] = chars.get(char, char)
+    return {name: "".join(text) for name, text in texts.items()}
+
+
+# --- SimConnect client data and shared memory ---
+
+PMDG_COLOURS = {"w": 0, "c": 1, "g": 2, "m": 3, "a": 4, "r": 5}
+PMDG_SYMBOLS = {"←": 0xA1, "→": 0xA2, "↑": 0xA3, "↓": 0xA4, "☐": 0xCA}
+
+
+def encode_pmdg(screen: Screen) -> bytes:
+    """PMDG_NG3_SDK.h / PMDG_777X_SDK.h: column-major cells of symbol, colour and flags."""
+    data = bytearray(CELLS * 3)
+    for index, cell in enumerate(screen):
+        row, column = divmod(index, COLUMNS)
+        offset = (column * ROWS + row) * 3
+        if cell is None:
+            data[offset] = ord(" ")
+            continue
+        char, colour, size = cell
+        data[offset:offset + 3] = bytes((symbol_byte(char, PMDG_SYMBOLS), PMDG_COLOURS.get(colour, 0), 0x01 if size else 0))
+    return bytes(data)
+
+
+CRJ_COLOURS = {"w": 1, "r": 2, "g": 3, "c": 5, "m": 6, "y": 7, "a": 7}
+CRJ_SYMBOLS = {"☐": ord("@"), "↑": ord("a"), "↓": ord("b"), "→": ord("c"), "←": ord("d"), "°": ord("e")}
+
+
+def encode_crj(screen: Screen) -> bytes:
+    """Aerosoft CRJ: row-major cells of symbol and format (colour, 0x80 small font)."""
+    data = bytearray(CELLS * 2)
+    for index, cell in enumerate(screen):
+        if cell is None:
+            data[index * 2] = ord(" ")
+            continue
+        char, colour, size = cell
+        data[index * 2:index * 2 + 2] = bytes((symbol_byte(char, CRJ_SYMBOLS), CRJ_COLOURS.get(colour, 1) | (0x80 if size else 0)))
+    return bytes(data)
+
+
+MADDOGX_COLOURS = {"w": 7, "a": 6, "c": 5, "g": 4, "m": 3, "r": 2}
+MADDOGX_SYMBOLS = {"☐": ord("["), "[": ord("{"), "]": ord("}")}
+
+
+def encode_maddogx(screen: Screen) -> bytes:
+    """MaddogX CDU_SC_DATA of the Canadian CDU: 8 byte header, screen and attribute arrays."""
+    header = bytes((1, 0, 0, 0, 0, 1, 0, 0))
+    screen_bytes = bytearray(CELLS)
+    attributes = bytearray(CELLS)
+    for index, cell in enumerate(screen):
+        if cell is None:
+            screen_bytes[index] = ord(" ")
+            continue
+        char, colour, size = cell
+        screen_bytes[index] = symbol_byte(char, MADDOGX_SYMBOLS)
+        attributes[index] = MADDOGX_COLOURS.get(colour, 7) | (0x80 if size else 0)
+    return header + bytes(screen_bytes) + bytes(attributes)
+
+
+A340_COLOURS = {"w": 0, "c": 1, "a": 2, "g": 3, "e": 4, "r": 5, "y": 6, "m": 7}
+A340_SYMBOLS = {"←": ord("a"), "→": ord("b"), "↑": ord("e"), "↓": ord("f"), "☐": ord("o"), "°": ord("d"), "Δ": ord("c")}
+
+
+def encode_a340(screen: Screen) -> bytes:
+    """INI A340 MCDU: row-major cells of symbol, colour and flags."""
+    data = bytearray(CELLS * 3)
+    for index, cell in enumerate(screen):
+        if cell is None:
+            data[index * 3] = ord(" ")
+            continue
+        char, colour, size = cell
+        data[index * 3:index * 3 + 3] = bytes((symbol_byte(char, A340_SYMBOLS), A340_COLOURS.get(colour, 0), 0x01 if size else 0))
+    return bytes(data)
+
+
+def encode_md11(screen: Screen) -> bytes:
+    """TFDi MD-11 MCDU: 4 status bools, then row-major cells of char16_t value and large flag."""
+    data = bytearray(4)
+    for cell in screen:
+        char, size = (" ", 0) if cell is None else (cell[0], cell[2])
+        data += struct.pack("<H?", ord(char) if ord(char) < 0x10000 else ord("?"), not size)
+    return bytes(data)
+
+
+IFLY_COLOURS = {"w": 0, "g": 1, "c": 2, "m": 3, "e": 4}
+# Special characters are sent as a colour code, the character itself is not used
+IFLY_SYMBOL_COLOURS = {"☐": 5, "°": 6, "←": 9, "→": 10}
+
+
+def encode_ifly(screen: Screen) -> Dict[str, str]:
+    """iFly 737 MAX shared memory: row-major character, small font and colour arrays of one CDU."""
+    chars, small_font, colours = bytearray(CELLS), bytearray(CELLS), bytearray(CELLS)
+    for index, cell in enumerate(screen):
+        if cell is None:
+            chars[index] = ord(" ")
+            continue
+        char, colour, size = cell
+        chars[index] = ord(char) if ord(char) < 128 else ord("?")
+        small_font[index] = 1 if size else 0
+        colours[index] = IFLY_SYMBOL_COLOURS.get(char, IFLY_COLOURS.get(colour, 0))
+    return {"chars": b64(bytes(chars)), "small_font": b64(bytes(small_font)), "colors": b64(bytes(colours))}
+
+
+# --- X-Plane dataref values ---
+
+def encode_zibo(screen: Screen) -> Dict[str, Any]:
+    """laminar/B738/fmc1/LineNN_<suffix>: one dataref per line, colour and size."""
+    chars = {"°": "`", "☐": "*", "*": "="}
+    prefix = "laminar/B738/fmc1/"
+    values: Dict[str, Any] = {}
+
+    def content_suffix(_char: str, colour: str, size: int) -> str:
+        return "S" if size else {"g": "G", "m": "M", "e": "I"}.get(colour, "L")
+
+    def label_suffix(_char: str, colour: str, _size: int) -> str:
+        return "GX" if colour == "g" else "X"
+
+    screen_rows = rows(screen)
+    for suffix, text in split_row(screen_rows[0], content_suffix, chars).items():
+        values[f"{prefix}Line00_{suffix}"] = b64_text(text)
+    for line in range(1, 7):
+        for suffix, text in split_row(screen_rows[line * 2 - 1], label_suffix, chars).items():
+            values[f"{prefix}Line{line:02d}_{suffix}"] = b64_text(text)
+        for suffix, text in split_row(screen_rows[line * 2], content_suffix, chars).items():
+            values[f"{prefix}Line{line:02d}_{suffix}"] = b64_text(text)
+    entry = split_row(screen_rows[13], lambda _c, colour, _s: "_I" if colour == "e" else "", chars)
+    for suffix, text in entry.items():
+        values[f"{prefix}Line_entry{suffix}"] = b64_text(text)
+    return values
+
+
+def encode_toliss(screen: Screen) -> Dict[str, Any]:
+    """AirbusFBW/MCDU1<title|labelN|contN|scontN|sp><colour>, special characters in the "s" datarefs."""
+    symbols = {"←": "0", "→": "1", "↑": "C", "↓": "D", "☐": "E", "°": "`", "Δ": "|"}
+    colours = {"w": "w", "c": "b", "g": "g", "a": "a", "m": "m", "y": "y"}
+    prefix = "AirbusFBW/MCDU1"
+    values: Dict[str, Any] = {f"{prefix}VertSlewKeys": 0}
+
+    def suffix(char: str, colour: str) -> str:
+        return "s" if char in symbols else colours.get(colour, "w")
+
+    screen_rows = rows(screen)
+    names: Dict[str, str] = split_row(screen_rows[0], lambda c, colour, _s: f"title{suffix(c, colour)}", symbols)
+    for line in range(1, 7):
+        names.update(split_row(screen_rows[line * 2 - 1],
+                               lambda c, colour, _s, line=line: f"label{line}{suffix(c, colour)}", symbols))
+        names.update(split_row(screen_rows[line * 2],
+                               lambda c, colour, size, line=line: f"{'scont' if size else 'cont'}{line}{suffix(c, colour)}",
+                               symbols))
+    names.update(split_row(screen_rows[13], lambda _c, colour, _s: "spa" if colour == "a" else "spw", symbols))
+    for name, text in names.items():
+        values[prefix + name] = b64_text(text)
+    return values
+
+
+HOTSTART_COLOURS = {"w": 0x07, "m": 0x05, "g": 0x04, "y": 0x03, "a": 0x03, "c": 0x01}
+
+
+def encode_hotstart(screen: Screen) -> Dict[str, Any]:
+    """CL650/CDU/1/screen/text_lineN and style_lineN, one style byte (colour, 0x80 large) per character."""
+    prefix = "CL650/CDU/1/screen/"
+    values: Dict[str, Any] = {}
+    for line, row in enumerate(rows(screen) + [[None] * COLUMNS]):
+        text = "".join(" " if cell is None else cell[0] for cell in row)
+        style = bytes(0x87 if cell is None else HOTSTART_COLOURS.get(cell[1], 0x07) | (0 if cell[2] else 0x80) for cell in row)
+        values[f"{prefix}text_line{line}"] = b64_text(text)
+        values[f"{prefix}style_line{line}"] = b64(style)
+    return values
+
+
+def encode_ff757(screen: Screen) -> Dict[str, Any]:
+    """1-sim/cduL/display/symbols (base64 text), symbolsSize and symbolsColor (int arrays)."""
+    chars = {"☐": "\x1d", "°": "\x1c"}
+    prefix = "1-sim/cduL/display/"
+    return {
+        f"{prefix}symbols": b64_text("".join(" " if cell is None else chars.get(cell[0], cell[0]) for cell in screen)),
+        f"{prefix}symbolsSize": [0 if cell is None else cell[2] for cell in screen],
+        f"{prefix}symbolsColor": [0 for _ in screen],
+    }
+
+
+FF777_COLOURS = {"w": 1, "m": 2, "g": 3, "c": 4, "e": 5}
+
+
+def encode_ff777(screen: Screen) -> Dict[str, Any]:
+    """As the 757/767 with an effects array, sizes are 1 (large) and 2 (small)."""
+    chars = {"☐": "#", "°": "*"}
+    prefix = "1-sim/cduL/display/"
+    return {
+        f"{prefix}symbols": b64_text("".join(" " if cell is None else chars.get(cell[0], cell[0]) for cell in screen)),
+        f"{prefix}symbolsSize": [1 if cell is None else cell[2] + 1 for cell in screen],
+        f"{prefix}symbolsColor": [1 if cell is None else FF777_COLOURS.get(cell[1], 1) for cell in screen],
+        f"{prefix}symbolsEffects": [0 for _ in screen],
+    }
+
+
+def encode_rotate_md11(screen: Screen) -> Dict[str, Any]:
+    """Rotate/aircraft/controls/cdu_0/mcdu_line_N_content (base64 text) and _style (int array)."""
+    chars = {"☐": "$", "°": "`"}
+    prefix = "Rotate/aircraft/controls/cdu_0/mcdu_line_"
+    values: Dict[str, Any] = {}
+    for line, row in enumerate(rows(screen)):
+        values[f"{prefix}{line}_content"] = b64_text("".join(" " if cell is None else chars.get(cell[0], cell[0]) for cell in row))
+        values[f"{prefix}{line}_style"] = [1 if cell is not None and cell[1] == "g" else 0 for cell in row]
+    return values
+
+
+def encode_rotate_md80(screen: Screen) -> Dict[str, Any]:
+    """Rotate/md80/instruments/cdu_line_NN, base64 text of the 30 column virtual CDU."""
+    chars = {"☐": "$", "°": "`"}
+    values: Dict[str, Any] = {}
+    for line, row in enumerate(rows(screen), start=1):
+        text = "".join(" " if cell is None else chars.get(cell[0], cell[0]) for cell in row)
+        values[f"Rotate/md80/instruments/cdu_line_{line:02d}"] = b64_text(text.ljust(30))
+    return values
+
+
+# --- Display documents and value lists ---
+
+FENIX_SYMBOLS = {"☐": "#", "↑": "¤", "↓": "¥", "→": "¢", "←": "£", "Δ": "&"}
+FENIX_COLOURS = ("a", "c", "y", "w", "g", "m")
+
+
+def encode_fenix_row(row: Screen) -> str:
+    """Row text with the Fenix format characters: s/l switch the size, a colour letter switches the colour."""
+    text: List[str] = []
+    size, colour = 0, "w"
+    for cell in row:
+        if cell is None:
+            text.append(" ")
+            continue
+        char, cell_colour, cell_size = cell
+        if cell_size != size:
+            size = cell_size
+            text.append("s" if size else "l")
+        cell_colour = cell_colour if cell_colour in FENIX_COLOURS else "w"
+        if cell_colour != colour:
+            colour = cell_colour
+            text.append(colour)
+        text.append(FENIX_SYMBOLS.get(char, char.upper()))
+    return "".join(text)
+
+
+def encode_fenix(screen: Screen) -> str:
+    return "<root>" + "".join(f"<line>{escape(encode_fenix_row(row))}</line>" for row in rows(screen)) + "</root>"
+
+
+PROSIM_737_COLOURS = {"c": "1", "g": "2", "m": "3", "y": "4", "a": "5"}
+# Brackets start the ProSim markup tags and cannot be shown
+PROSIM_737_SYMBOLS = {"☐": "#", "°": "`", "[": "(", "]": ")"}
+
+
+def encode_prosim_737_text(row: Screen) -> str:
+    """ProSim markup: [s]...[/s] small text, [<colour code>]...[/<colour code>] coloured text."""
+    text: List[str] = []
+    for cell in row:
+        if cell is None:
+            text.append(" ")
+            continue
+        char, colour, size = cell
+        char = PROSIM_737_SYMBOLS.get(char, char)
+        if colour in PROSIM_737_COLOURS:
+            code = PROSIM_737_COLOURS[colour]
+            char = f"[{code}]{char}[/{code}]"
+        text.append(f"[s]{char}[/s]" if size else char)
+    return "".join(text).rstrip()
+
+
+def encode_prosim_737(screen: Screen) -> str:
+    screen_rows = rows(screen)
+    title = "".join(" " if cell is None else cell[0] for cell in screen_rows[0]).strip()
+    lines = "".join(f"<line>{escape(encode_prosim_737_text(row) or '¨')}</line>" for row in screen_rows[1:13])
+    scratchpad = escape("".join(" " if cell is None else cell[0] for cell in screen_rows[13]).rstrip())
+    return f"<root><title>{escape(title)}</title><titlePage></titlePage>{lines}<scratchpad>{scratchpad}</scratchpad></root>"
+
+
+FSL_COLOURS = {"c": 1, "e": 2, "y": 3, "g": 4, "m": 5, "a": 6, "w": 7}
+FSL_SYMBOLS = {"°": 28, "☐": 29, "↓": 30, "→": 31, "↑": 94, "←": 95, "Δ": 110}
+
+
+def encode_fslabs(screen: Screen) -> List[list]:
+    """FSLabs /MCDU/Display "Value": a [character code, colour, size] triple per cell, [] for empty cells."""
+    return [
+        [] if cell is None else [symbol_byte(cell[0], FSL_SYMBOLS), FSL_COLOURS.get(cell[1], 7), cell[2]]
+        for cell in screen
+    ]
+
+
+# Corpus name, frame format and encoder of every derived corpus
+ENCODERS: List[Tuple[str, str, Callable[[Screen], Any]]] = [
+    ("pmdg_737", "simconnect client data", lambda screen: b64(encode_pmdg(screen))),
+    ("pmdg_777", "simconnect client data", lambda screen: b64(encode_pmdg(screen))),
+    ("aerosoft_crj", "simconnect client data", lambda screen: b64(encode_crj(screen))),
+    ("maddogx", "simconnect client data", lambda screen: b64(encode_maddogx(screen))),
+    ("ini_a340", "simconnect client data", lambda screen: b64(encode_a340(screen))),
+    ("tfdi_md11", "simconnect client data", lambda screen: b64(encode_md11(screen))),
+    ("ifly_737", "ifly shared memory", encode_ifly),
+    ("zibo_737_800x", "xplane dataref values", encode_zibo),
+    ("toliss_a3xx", "xplane dataref values", encode_toliss),
+    ("hotstart_cl650", "xplane dataref values", encode_hotstart),
+    ("flightfactor_75_76", "xplane dataref values", encode_ff757),
+    ("flightfactor_777v2", "xplane dataref values", encode_ff777),
+    ("rotate_md11", "xplane dataref values", encode_rotate_md11),
+    ("rotate_md80", "xplane dataref values", encode_rotate_md80),
+    ("fenix", "display xml", encode_fenix),
+    ("prosim_a320", "display xml", encode_fenix),
+    ("prosim_737", "display xml", encode_prosim_737),
+    ("fslabs", "fslabs value list", encode_fslabs),
+]
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pages", nargs="?", default=DEFAULT_PAGES, help="JSON list of SimBridge MCDU pages")
+    args = parser.parse_args()
+
+    screens = load_screens(args.pages)
+    source = f"derived from {os.path.basename(args.pages)} by build_corpus.py"
+    for name, frame_format, encode in ENCODERS:
+        path = os.path.join(CORPUS_DIR, f"{name}.json")
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"format": frame_format, "source": source, "frames": [encode(screen) for screen in screens]},
+                      file, ensure_ascii=False, indent=1)
+            file.write("\n")
+        logging.info("Wrote %s frames to %s", len(screens), path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Optional row-level delta updates for the MobiFlight CDU display endpoint
+
+Every bridge renders the complete screen as {"Target": "Display", "Data": [336 cells]}, which is
+roughly 10 KB of JSON, even if only a single scratchpad character has changed.
+With delta mode enabled, DisplayDeltaEncoder keeps the last screen sent to a CDU and replaces
+follow-up frames by a patch that only carries the changed part of each changed row:
+
+    {"Target": "DisplayPatch", "Data": [[<first cell index>, [<cell>, <cell>, ...]], ...]}
+
+Cell indexes are row-major (row * 24 + column), cells use the same format as in "Display".
+A full "Display" frame is still sent for the first frame after every (re)connect, whenever
+too many rows changed for a patch to be smaller, and for every message with another target.
+
+The MobiFlight display endpoint does not know "DisplayPatch", so delta mode is off by default.
+It is meant to be used together with an endpoint that does, e.g. tools/fake_mobiflight_cdu.py,
+and is enabled by setting the environment variable MOBIFLIGHT_CDU_DISPLAY_DELTA=1.
+"""
+
+import json
+import logging
+import os
+from typing import Any, List, Optional
+
+DISPLAY_DELTA_ENV: str = "MOBIFLIGHT_CDU_DISPLAY_DELTA"
+
+DISPLAY_TARGET: str = "Display"
+DISPLAY_PATCH_TARGET: str = "DisplayPatch"
+
+DISPLAY_COLUMNS: int = 24
+# Above this number of changed rows a full frame is sent instead of a patch
+MAX_PATCH_ROWS: int = 7
+
+
+def display_delta_enabled() -> bool:
+    """Returns True if delta mode has been enabled through the environment."""
+    return os.environ.get(DISPLAY_DELTA_ENV, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def create_display_delta_encoder(name: str) -> Optional["DisplayDeltaEncoder"]:
+    """Returns an encoder for one CDU if delta mode is enabled, None otherwise."""
+    if not display_delta_enabled():
+        return None
+    logging.info("Display delta mode enabled for %s", name)
+    return DisplayDeltaEncoder(name)
+
+
+def apply_display_patch(screen: List[Any], patch: List[List[Any]]) -> None:
+    """Applies the Data of a DisplayPatch message to a list of display cells in place."""
+    for start, cells in patch:
+        if start < 0 or start + len(cells) > len(screen):
+            raise ValueError(f"Patch range {start}..{start + len(cells)} outside of {len(screen)} cells")
+        screen[start:start + len(cells)] = cells
+
+
+class DisplayDeltaEncoder:
+    """Turns full Display messages for one CDU into DisplayPatch messages against the last frame sent."""
+
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.last_cells: Optional[List[Any]] = None
+        self.full_frames: int = 0
+        self.patches: int = 0
+
+    def reset(self) -> None:
+        """Forgets the last frame, the next Display message is sent in full. Call after every (re)connect."""
+        self.last_cells = None
+
+    def encode(self, message: str) -> Optional[str]:
+        """Returns the message to send instead of the given MobiFlight message, None if nothing has changed."""
+        try:
+            decoded: Any = json.loads(message)
+        except ValueError:
+            return message
+        if not isinstance(decoded, dict) or decoded.get("Target") != DISPLAY_TARGET:
+            return message
+
+        cells: List[Any] = decoded.get("Data") or []
+        previous: Optional[List[Any]] = self.last_cells
+        self.last_cells = cells
+        if previous is None or len(previous) != len(cells):
+            self.full_frames += 1
+            return message
+
+        patch: List[List[Any]] = []
+        for row_start in range(0, len(cells), DISPLAY_COLUMNS):
+            row_end: int = min(row_start + DISPLAY_COLUMNS, len(cells))
+            if cells[row_start:row_end] == previous[row_start:row_end]:
+                continue
+            first: int = row_start
+            while cells[first] == previous[first]:
+                first += 1
+            last: int = row_end - 1
+            while cells[last] == previous[last]:
+                last -= 1
+            patch.append([first, cells[first:last + 1]])
+
+        if not patch:
+            return None
+        if len(patch) > MAX_PATCH_ROWS:
+            self.full_frames += 1
+            return message
+        self.patches += 1
+        return json.dumps({"Target": DISPLAY_PATCH_TARGET, "Data": patch})
+
+    def log_stats(self) -> None:
+        logging.info("%s: %s full display frames, %s display patches sent", self.name, self.full_frames, self.patches)
@@ -0,0 +1,397 @@
+"""
+Record and replay of the simulator side of the WinWing CDU scripts
+
+Performance complaints can rarely be reproduced without the exact simulator traffic that caused them.
+Every script can record the raw frames it receives, before anything is decoded:
+- SimConnect client data, the received SIMCONNECT_RECV_CLIENT_DATA including its header
+- X-Plane Web API messages, and the IDs and names of the subscribed datarefs
+- SimBridge messages of the FBW and Headwind MCDU interface
+- GraphQL results of Fenix and ProSim
+- FSLabs MCDU HTTP response bodies
+- iFly CDU screens read from shared memory
+
+Recording is opt-in: set the environment variable MOBIFLIGHT_CDU_RECORD to a file name. Every frame is appended
+to the file with its time.monotonic() timestamp and a channel naming its source. Every run of a script starts a
+new session in the file, so one file can hold several runs, but only one script should write to it at a time.
+
+Replay: with MOBIFLIGHT_CDU_REPLAY set to a recording (tools/replay_cdu_feed.py sets it and starts the script),
+a script takes its frames from the recording instead of the simulator. The replay sources below stand in for
+the simulator connections, everything from decoding to sending to MobiFlight runs unchanged. Neither the
+simulator nor Windows is needed. MOBIFLIGHT_CDU_REPLAY_SPEED scales the recorded timing, 1 replays at the
+original speed and 0 as fast as possible. Once all frames have been replayed, the script is given a few seconds
+to send them and is then stopped as if Ctrl+C had been pressed, so it logs its statistics as usual.
+
+File format: the magic b"MFCDUREC" and a version byte, then records of
+    timestamp (float64), channel length (uint16), payload length (uint32), channel (UTF-8), payload
+in little endian. A record with an empty channel starts a session, its payload is the name of the script.
+"""
+
+import _thread
+import asyncio
+import atexit
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+from typing import Any, AsyncIterator, Collection, Dict, Generator, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import websockets.asyncio.client as ws_client
+
+RECORD_ENV: str = "MOBIFLIGHT_CDU_RECORD"
+REPLAY_ENV: str = "MOBIFLIGHT_CDU_REPLAY"
+REPLAY_SPEED_ENV: str = "MOBIFLIGHT_CDU_REPLAY_SPEED"
+
+MAGIC: bytes = b"MFCDUREC"
+FORMAT_VERSION: int = 1
+RECORD_HEADER = struct.Struct("<dHI")
+SESSION_CHANNEL: str = ""
+
+# Channels of the sources shared by several scripts
+XPLANE_CHANNEL: str = "xplane"
+XPLANE_DATAREFS_CHANNEL: str = "xplane/datarefs"
+SIMBRIDGE_CHANNEL: str = "simbridge"
+GRAPHQL_CHANNEL: str = "graphql"
+
+# Time between the start of the first source and the first frame, gives the scripts time to connect to MobiFlight
+REPLAY_START_DELAY: float = 1.0
+# Time given to the scripts to send the last replayed frames before they are stopped
+REPLAY_DRAIN_TIME: float = 3.0
+
+
+class RecordedFrame(NamedTuple):
+    timestamp: float
+    channel: str
+    payload: bytes
+
+
+class FeedRecorder:
+    """Appends the raw frames of one script run to a recording. Frames are recorded from several threads."""
+
+    enabled: bool = True
+
+    def __init__(self, path: str, script: str) -> None:
+        self.path: str = path
+        self.lock: threading.Lock = threading.Lock()
+        self.frames: int = 0
+        self.file = open(path, "ab")  # pylint: disable=consider-using-with
+        if self.file.tell() == 0:
+            self.file.write(MAGIC + bytes([FORMAT_VERSION]))
+        self.record(SESSION_CHANNEL, script)
+        logging.info("Recording the simulator frames of %s to %s", script, path)
+
+    def record(self, channel: str, payload: Union[bytes, str]) -> None:
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        encoded_channel: bytes = channel.encode("utf-8")
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(RECORD_HEADER.pack(time.monotonic(), len(encoded_channel), len(payload)))
+            self.file.write(encoded_channel)
+            self.file.write(payload)
+            # A script that is killed still leaves a complete recording
+            self.file.flush()
+            self.frames += 1
+
+    def close(self) -> None:
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+                logging.info("Recorded %s frames to %s", self.frames - 1, self.path)
+
+
+class NullRecorder(FeedRecorder):
+    """Recorder used while recording is disabled, records nothing."""
+
+    enabled: bool = False
+
+    def __init__(self) -> None:  # pylint: disable=super-init-not-called
+        pass
+
+    def record(self, channel: str, payload: Union[bytes, str]) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+NULL_RECORDER = NullRecorder()
+_recorder: Optional[FeedRecorder] = None
+_recorder_lock = threading.Lock()
+
+
+def script_name() -> str:
+    return os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "unknown"
+
+
+def feed_recorder() -> FeedRecorder:
+    """Returns the recorder of this script run, NULL_RECORDER unless MOBIFLIGHT_CDU_RECORD is set."""
+    global _recorder  # pylint: disable=global-statement
+    if _recorder is not None:
+        return _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            path: str = os.environ.get(RECORD_ENV, "")
+            _recorder = NULL_RECORDER
+            if path:
+                try:
+                    _recorder = FeedRecorder(path, script_name())
+                    atexit.register(_recorder.close)
+                except OSError as e:
+                    logging.warning("Could not open recording %s: %s", path, e)
+        return _recorder
+
+
+def read_recording(path: str) -> Iterator[RecordedFrame]:
+    """Yields all frames of a recording including the session records. Raises ValueError if it is none."""
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC) + 1) != MAGIC + bytes([FORMAT_VERSION]):
+            raise ValueError(f"{path} is not a CDU feed recording of version {FORMAT_VERSION}")
+        while True:
+            header: bytes = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, channel_length, payload_length = RECORD_HEADER.unpack(header)
+            channel: bytes = file.read(channel_length)
+            payload: bytes = file.read(payload_length)
+            # The last record is incomplete if the recording script was killed while writing it
+            if len(channel) < channel_length or len(payload) < payload_length:
+                return
+            yield RecordedFrame(timestamp, channel.decode("utf-8"), payload)
+
+
+def recorded_scripts(path: str) -> List[str]:
+    """Names of the scripts of all sessions of a recording."""
+    return [frame.payload.decode("utf-8") for frame in read_recording(path) if frame.channel == SESSION_CHANNEL]
+
+
+class FeedReplay:
+    """
+    Replays the frames of a recording with their recorded timing scaled by 1 / speed, speed 0 replays as fast
+    as possible. Every source reads the recording on its own, but all of them follow the same timeline, which
+    starts REPLAY_START_DELAY after the first source. The gaps between sessions are skipped.
+    The script is stopped once every source has replayed all of its frames.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0) -> None:
+        self.path: str = path
+        self.speed: float = speed
+        self.lock: threading.Lock = threading.Lock()
+        self.active_sources: int = 0
+        self.finished_sources: int = 0
+        self.replayed: int = 0
+        self.stop_timer: Optional[threading.Timer] = None
+        # time.monotonic() of the first frame
+        self.started: Optional[float] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # Sources waiting forever once their frames are replayed, kept so they are not garbage collected
+        self.finished: List[Any] = []
+
+    def due_times(self, channels: Collection[str]) -> Iterator[Tuple[float, RecordedFrame]]:
+        """Yields the frames of the given channels with their time relative to the replay start in seconds."""
+        session_start: Optional[float] = None
+        session_offset: float = 0.0
+        last_time: float = 0.0
+        for frame in read_recording(self.path):
+            if frame.channel == SESSION_CHANNEL:
+                # Timestamps of different runs are not related, the next session follows right away
+                session_start = None
+                session_offset = last_time
+                continue
+            if session_start is None:
+                session_start = frame.timestamp
+            last_time = session_offset + frame.timestamp - session_start
+            if frame.channel in channels:
+                yield (last_time / self.speed if self.speed > 0 else 0.0), frame
+
+    def watch_loop(self) -> None:
+        """Remembers the running event loop of the script, if any, so stop() can wake it up."""
+        try:
+            self.loop = asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+
+    def source_started(self) -> float:
+        """Returns the time.monotonic() of the first frame."""
+        with self.lock:
+            if self.started is None:
+                self.started = time.monotonic() + REPLAY_START_DELAY
+            self.active_sources += 1
+            if self.stop_timer is not None:
+                self.stop_timer.cancel()
+                self.stop_timer = None
+            return self.started
+
+    def source_finished(self, replayed: int) -> None:
+        with self.lock:
+            self.active_sources -= 1
+            self.finished_sources += 1
+            self.replayed += replayed
+            if self.active_sources == 0:
+                self.stop_timer = threading.Timer(REPLAY_DRAIN_TIME, self.stop)
+                self.stop_timer.daemon = True
+                self.stop_timer.start()
+
+    def stop(self) -> None:
+        logging.info("Replayed %s frames of %s to %s sources, stopping", self.replayed, self.path, self.finished_sources)
+        _thread.interrupt_main()
+        if self.loop is not None:
+            # The interrupt is only handled once the loop wakes up, it may be waiting for I/O
+            self.loop.call_soon_threadsafe(lambda: None)
+
+    async def frames(self, channels: Collection[str]) -> AsyncIterator[RecordedFrame]:
+        """Yields the frames of the given channels on the event loop at their (scaled) recorded time."""
+        self.watch_loop()
+        started: float = self.source_started()
+        replayed: int = 0
+        try:
+            for due, frame in self.due_times(channels):
+                delay: float = started + due - time.monotonic()
+                # Even as fast as possible, the other tasks get their turn between two frames
+                await asyncio.sleep(max(0.0, delay))
+                replayed += 1
+                yield frame
+        finally:
+            self.source_finished(replayed)
+
+    def blocking_frames(self, channels: Collection[str]) -> Iterator[RecordedFrame]:
+        """Same as frames() for sources running on their own thread, e.g. the SimConnect dispatch thread."""
+        started: float = self.source_started()
+        replayed: int = 0
+        try:
+            for due, frame in self.due_times(channels):
+                delay: float = started + due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                replayed += 1
+                yield frame
+        finally:
+            self.source_finished(replayed)
+
+    def first_payload(self, channel: str) -> Optional[bytes]:
+        for frame in read_recording(self.path):
+            if frame.channel == channel:
+                return frame.payload
+        return None
+
+    async def wait_forever(self, source: Any) -> None:
+        """Parks a source whose frames have all been replayed until the script is stopped."""
+        self.finished.append(source)
+        await asyncio.Event().wait()
+
+
+def replay_speed() -> float:
+    try:
+        return max(0.0, float(os.environ.get(REPLAY_SPEED_ENV, "1")))
+    except ValueError:
+        return 1.0
+
+
+_replay: Optional[FeedReplay] = None
+
+
+def feed_replay() -> Optional[FeedReplay]:
+    """Returns the replay of this script run, None unless MOBIFLIGHT_CDU_REPLAY is set."""
+    global _replay  # pylint: disable=global-statement
+    path: str = os.environ.get(REPLAY_ENV, "")
+    if not path:
+        return None
+    if _replay is None:
+        _replay = FeedReplay(path, replay_speed())
+        logging.info("Replaying the simulator frames of %s at speed %s", path, _replay.speed or "as fast as possible")
+    return _replay
+
+
+class ReplayConnection:
+    """Stands in for a WebSocket client connection: recv() returns the recorded messages of a channel."""
+
+    def __init__(self, replay: FeedReplay, channel: str) -> None:
+        self.replay: FeedReplay = replay
+        self.channel: str = channel
+        self.messages: AsyncIterator[RecordedFrame] = replay.frames([channel])
+        self.sent: int = 0
+
+    async def recv(self) -> str:
+        frame: Optional[RecordedFrame] = await anext(self.messages, None)
+        if frame is None:
+            await self.replay.wait_forever(self)
+            raise ConnectionError(f"Replay of {self.channel} finished")
+        return frame.payload.decode("utf-8")
+
+    async def send(self, message: Union[str, bytes]) -> None:
+        # Requests like subscriptions have no effect on a recording
+        logging.debug("Replay of %s ignores sent message %.80s", self.channel, message)
+        self.sent += 1
+
+    async def close(self) -> None:
+        pass
+
+    def __aiter__(self) -> "ReplayConnection":
+        return self
+
+    async def __anext__(self) -> str:
+        return await self.recv()
+
+
+class ReplayConnect:
+    """Stands in for websockets' connect(): awaited or iterated, it provides a single ReplayConnection."""
+
+    def __init__(self, replay: FeedReplay, channel: str) -> None:
+        self.replay: FeedReplay = replay
+        self.channel: str = channel
+
+    def __await__(self) -> Generator[Any, None, ReplayConnection]:
+        yield from asyncio.sleep(0).__await__()
+        return ReplayConnection(self.replay, self.channel)
+
+    async def __aiter__(self) -> AsyncIterator[ReplayConnection]:
+        yield ReplayConnection(self.replay, self.channel)
+
+
+def connect_websocket(uri: str, channel: str, **kwargs: Any) -> Any:
+    """websockets' connect(uri), or the replay of the channel while replaying."""
+    replay: Optional[FeedReplay] = feed_replay()
+    if replay is not None:
+        return ReplayConnect(replay, channel)
+    return ws_client.connect(uri, **kwargs)
+
+
+class ReplayHttpClient:
+    """Stands in for a polling HTTP client: every get() returns the next recorded body of a channel."""
+
+    def __init__(self, replay: FeedReplay, channel: str) -> None:
+        self.replay: FeedReplay = replay
+        self.bodies: AsyncIterator[RecordedFrame] = replay.frames([channel])
+
+    async def get(self, _path: str) -> Tuple[int, bytes]:
+        frame: Optional[RecordedFrame] = await anext(self.bodies, None)
+        if frame is None:
+            await self.replay.wait_forever(self)
+            raise ConnectionError("Replay finished")
+        return 200, frame.payload
+
+    def close(self) -> None:
+        pass
+
+
+class ReplayGraphQLSession:
+    """Stands in for a gql client session: subscribe() yields the recorded dataRefs results of the given names."""
+
+    def __init__(self, replay: FeedReplay) -> None:
+        self.replay: FeedReplay = replay
+
+    async def subscribe(
+        self, _document: Any, variable_values: Optional[Dict[str, Any]] = None, **_kwargs: Any
+    ) -> AsyncIterator[Dict[str, Any]]:
+        names = set((variable_values or {}).get("names", []))
+        async for frame in self.replay.frames([GRAPHQL_CHANNEL]):
+            result: Dict[str, Any] = json.loads(frame.payload)
+            if not names or result.get("dataRefs", {}).get("name") in names:
+                yield result
+        await self.replay.wait_forever(self)
+
+    async def close(self) -> None:
+        pass
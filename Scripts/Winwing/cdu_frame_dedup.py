@@ -0,0 +1,41 @@
+"""
+Shared raw frame deduplication for the WinWing CDU scripts
+
+SimConnect based aircraft deliver the complete CDU screen buffer on every update, also when only
+another CDU or nothing visible at all has changed. Converting such a frame to MobiFlight JSON and
+writing it to the WebSocket only repeats what the device already shows.
+
+FrameDeduplicator compares the raw buffer against the last accepted one before any conversion
+happens, so an unchanged page costs one bytes comparison and nothing else.
+"""
+
+import logging
+from typing import Optional
+
+
+class FrameDeduplicator:
+    """Suppresses raw CDU frames that are identical to the previously accepted frame."""
+
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.last_frame: Optional[bytes] = None
+        self.received: int = 0
+        self.suppressed: int = 0
+
+    def is_new(self, frame: bytes) -> bool:
+        """Returns True if the frame differs from the last accepted one and should be converted and sent."""
+        self.received += 1
+        if frame == self.last_frame:
+            self.suppressed += 1
+            return False
+        self.last_frame = frame
+        return True
+
+    def reset(self) -> None:
+        """Forgets the last accepted frame, so that the next frame is always passed on."""
+        self.last_frame = None
+
+    def log_stats(self) -> None:
+        ratio: float = 100.0 * self.suppressed / self.received if self.received else 0.0
+        logging.info("%s: %s frames received, %s suppressed as unchanged (%.1f%%)",
+                     self.name, self.received, self.suppressed, ratio)
@@ -0,0 +1,189 @@
+"""
+Per-CDU end-to-end latency tracing for the WinWing CDU scripts
+
+A frame passes several stages between the simulator and the device, and a laggy CDU can be caused by any of
+them: the simulator delivering late, the script being slow to decode or render, or MobiFlight accepting the
+frame late. FrameTrace takes a timestamp at every stage a frame passes:
+- receive: the data arrived from the simulator (SimConnect callback, X-Plane message, GraphQL or SimBridge
+  event, HTTP poll response or shared memory read)
+- decode: the raw data has been turned into CDU values
+- render: the values have been rendered into display cells
+- serialize: the display JSON has been built and handed to the MobiFlight sink
+- send: the frame has been written to the MobiFlight socket
+When the frame has been sent, the time spent in every stage (since the previous stage) and the total time
+since receive are added to per-CDU histograms. Stages a script does not have separately, e.g. decode and
+render done in one step, are simply not marked. Frames superseded before they were sent are not recorded.
+
+Tracing is opt-in: set the environment variable MOBIFLIGHT_CDU_METRICS_PORT to a port number and the
+histograms are served in Prometheus text format at http://127.0.0.1:<port>/metrics.
+Without it start_trace() returns a trace that records nothing.
+"""
+
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+METRICS_PORT_ENV: str = "MOBIFLIGHT_CDU_METRICS_PORT"
+METRICS_HOST: str = "127.0.0.1"
+METRIC_NAME: str = "mobiflight_cdu_frame_latency_seconds"
+STAGES: Tuple[str, ...] = ("receive", "decode", "render", "serialize", "send")
+TOTAL_STAGE: str = "total"
+# Upper bounds of the histogram buckets in seconds, +Inf is added when rendering
+BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def metrics_port() -> Optional[int]:
+    value: str = os.environ.get(METRICS_PORT_ENV, "")
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        logging.warning("Ignoring %s=%s, not a port number", METRICS_PORT_ENV, value)
+        return None
+
+
+class LatencyHistogram:
+    """Cumulative bucket counts, sum and count of the observed latencies of one CDU and stage."""
+
+    def __init__(self) -> None:
+        self.bucket_counts: List[int] = [0] * len(BUCKETS)
+        self.total: float = 0.0
+        self.count: int = 0
+
+    def observe(self, seconds: float) -> None:
+        for index, upper_bound in enumerate(BUCKETS):
+            if seconds <= upper_bound:
+                self.bucket_counts[index] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class LatencyRegistry:
+    """Histograms of all CDUs of a script. Traces are recorded from the event loop and SimConnect threads."""
+
+    def __init__(self) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+
+    def observe(self, cdu: str, stage: str, seconds: float) -> None:
+        key = (cdu, stage)
+        histogram: Optional[LatencyHistogram] = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    def record(self, cdu: str, marks: List[Tuple[str, float]]) -> None:
+        with self.lock:
+            for (_, previous), (stage, timestamp) in zip(marks, marks[1:]):
+                self.observe(cdu, stage, timestamp - previous)
+            self.observe(cdu, TOTAL_STAGE, marks[-1][1] - marks[0][1])
+
+    def render(self) -> str:
+        lines: List[str] = [
+            f"# HELP {METRIC_NAME} Time a CDU frame spent in each stage since the previous one, "
+            f"{TOTAL_STAGE} is receive to send",
+            f"# TYPE {METRIC_NAME} histogram",
+        ]
+        with self.lock:
+            for (cdu, stage), histogram in sorted(self.histograms.items()):
+                labels: str = f'cdu="{cdu}",stage="{stage}"'
+                for upper_bound, count in zip(BUCKETS, histogram.bucket_counts):
+                    lines.append(f'{METRIC_NAME}_bucket{{{labels},le="{upper_bound}"}} {count}')
+                lines.append(f'{METRIC_NAME}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"{METRIC_NAME}_sum{{{labels}}} {histogram.total}")
+                lines.append(f"{METRIC_NAME}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = LatencyRegistry()
+
+
+class FrameTrace:
+    """Timestamps of one frame on its way from the simulator to MobiFlight."""
+
+    __slots__ = ("marks",)
+
+    def __init__(self, received_at: Optional[float] = None) -> None:
+        self.marks: List[Tuple[str, float]] = [
+            ("receive", time.perf_counter() if received_at is None else received_at)
+        ]
+
+    def mark(self, stage: str) -> None:
+        self.marks.append((stage, time.perf_counter()))
+
+    def finish(self, cdu: str) -> None:
+        """Marks the frame as sent and records it for the given CDU."""
+        self.mark("send")
+        REGISTRY.record(cdu, self.marks)
+
+
+class NullTrace(FrameTrace):
+    """Trace used while metrics are disabled, records nothing."""
+
+    __slots__ = ()
+
+    def __init__(self) -> None:  # pylint: disable=super-init-not-called
+        pass
+
+    def mark(self, stage: str) -> None:
+        pass
+
+    def finish(self, cdu: str) -> None:
+        pass
+
+
+NULL_TRACE = NullTrace()
+_enabled: bool = metrics_port() is not None
+
+
+def start_trace(received_at: Optional[float] = None) -> FrameTrace:
+    """
+    Starts the trace of a frame whose data has just arrived, or arrived at received_at (time.perf_counter()).
+    Returns NULL_TRACE if metrics are disabled.
+    """
+    if not _enabled:
+        return NULL_TRACE
+    return FrameTrace(received_at)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body: bytes = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:  # pylint: disable=redefined-builtin
+        pass  # Scrapes would flood the script log
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+
+def ensure_metrics_server() -> None:
+    """Starts the metrics endpoint once per script if MOBIFLIGHT_CDU_METRICS_PORT is set."""
+    global _server  # pylint: disable=global-statement
+    port: Optional[int] = metrics_port()
+    if port is None:
+        return
+    with _server_lock:
+        if _server is not None:
+            return
+        try:
+            _server = ThreadingHTTPServer((METRICS_HOST, port), MetricsRequestHandler)
+        except OSError as e:
+            logging.warning("Could not start CDU metrics endpoint on port %s: %s", port, e)
+            return
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="cdu-metrics", daemon=True).start()
+        logging.info("Serving CDU latency metrics at http://%s:%s/metrics", METRICS_HOST, port)
@@ -1,11 +1,18 @@
-import asyncio, json
+import asyncio, json, time
+from itertools import chain
 import xml.etree.ElementTree as ET
 import logging
-import websockets.asyncio.client as ws_client
-import websockets.exceptions
+import os
+import sys
 from gql import Client, gql
 from gql.transport.websockets import WebsocketsTransport
 
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mobiflight_sink import MobiFlightSink  # pylint: disable=wrong-import-position,import-error
+from cdu_latency_metrics import NULL_TRACE, start_trace  # pylint: disable=wrong-import-position,import-error
+from cdu_feed_recording import GRAPHQL_CHANNEL, ReplayGraphQLSession, feed_recorder, feed_replay  # pylint: disable=wrong-import-position,import-error
+
 subs = {'#': '☐',    # ballot box \u2610
         '¤': '↑',    # up arrow    \u2191
         '¥': '↓',    # down arrow  \u2193
@@ -16,36 +23,98 @@ subs = {'#': '☐',    # ballot box \u2610
 replace_chars =  ['£', '¢', '¥', '¤', '#', '&' ]
 format_chars = ['s', 'l', 'a', 'c', 'y', 'w', 'g', 'm']
 
+# Rendered frames between two logs of the per-stage timing
+STATS_LOG_INTERVAL = 500
+
+def render_row(text):
+    """Converts the text of one display row to MobiFlight display entries"""
+    entries = []
+    size = 0 # default row start with size large  
+    formatting = 'w' # default row start is white
+    for char in text:
+        if char in format_chars:
+            if char == 's':
+                size = 1
+            elif char == 'l':
+                size = 0
+            else:
+                formatting = char
+        elif char in replace_chars:
+            entries.append([subs[char], formatting, size])
+        elif char != ' ':
+            entries.append([char, formatting, size])
+        else:
+            entries.append([])
+    return entries
+
 def create_mobi_json(xml_string):   
-    message =  {}
-    message["Target"] = "Display"
-    message["Data"] = []    
-    formatting = 'w'
     root = ET.fromstring(xml_string)
-    for child in root:     
-        size = 0 # default row start with size large  
-        formatting = 'w' # default row start is white
-        for char in child.text:
-            entry = []
-            if char in format_chars:
-                if char == 's':
-                    size = 1
-                elif char == 'l':
-                    size = 0
-                else:
-                    formatting = char
-            elif char in replace_chars:
-                    entry = [subs[char], formatting, size]
-                    message["Data"].append(entry)
-            else:
-                if char != ' ':
-                    entry = [char, formatting, size]
-                message["Data"].append(entry)
-        logging.debug(child.text)   
-    logging.debug(message)
+    message = {"Target": "Display", "Data": list(chain.from_iterable(render_row(child.text or "") for child in root))}
     return json.dumps(message, separators=(',', ':')) 
 
 
+class Mcdu_Display_Renderer:
+    """
+    Renders the display documents of one MCDU like create_mobi_json, but only does the work for what changed:
+    an identical document is skipped, and only rows whose text differs from the last document are re-rendered.
+    Keeps the time spent parsing, rendering and serializing.
+    """
+
+    def __init__(self, id):
+        self.id = id
+        self.last_xml_string = None
+        self.row_texts = []
+        self.rows = []
+        self.frames = 0
+        self.skipped = 0
+        self.rows_rendered = 0
+        self.parse_time = 0.0
+        self.render_time = 0.0
+        self.serialize_time = 0.0
+
+    def render(self, xml_string, trace=NULL_TRACE):
+        """Returns the MobiFlight JSON for a display document, None if it is identical to the previous one"""
+        if xml_string == self.last_xml_string:
+            self.skipped += 1
+            return None
+
+        start = time.perf_counter()
+        row_texts = [child.text or "" for child in ET.fromstring(xml_string)]
+        parsed = time.perf_counter()
+        trace.mark("decode")
+
+        del self.row_texts[len(row_texts):], self.rows[len(row_texts):]
+        for index, text in enumerate(row_texts):
+            if index >= len(self.row_texts):
+                self.row_texts.append(text)
+                self.rows.append(render_row(text))
+                self.rows_rendered += 1
+            elif text != self.row_texts[index]:
+                self.row_texts[index] = text
+                self.rows[index] = render_row(text)
+                self.rows_rendered += 1
+        rendered = time.perf_counter()
+        trace.mark("render")
+
+        mobi_json = json.dumps({"Target": "Display", "Data": list(chain.from_iterable(self.rows))}, separators=(',', ':'))
+        serialized = time.perf_counter()
+
+        self.last_xml_string = xml_string
+        self.parse_time += parsed - start
+        self.render_time += rendered - parsed
+        self.serialize_time += serialized - rendered
+        self.frames += 1
+        if self.frames % STATS_LOG_INTERVAL == 0:
+            self.log_stats()
+        return mobi_json
+
+    def log_stats(self):
+        frames = max(self.frames, 1)
+        logging.info(f"{self.id}: {self.frames} frames rendered, {self.skipped} identical skipped, {self.rows_rendered} rows re-rendered, "
+                     f"per frame parse {self.parse_time / frames * 1000:.3f} ms, render {self.render_time / frames * 1000:.3f} ms, "
+                     f"serialize {self.serialize_time / frames * 1000:.3f} ms")
+
+
 async def run_fenix_graphql_client(mobi_client1, mobi_client2):
     await asyncio.sleep(1)
     transport = WebsocketsTransport(url="ws://localhost:8083/graphql/")
@@ -62,73 +131,39 @@ async def run_fenix_graphql_client(mobi_client1, mobi_client2):
         """
         )
     params = {"names": ["aircraft.mcdu1.display", "aircraft.mcdu2.display"]}   
-    session = await client.connect_async(reconnecting=True) 
+    displays = {"aircraft.mcdu1.display": (Mcdu_Display_Renderer("CDU-CAPTAIN"), mobi_client1),
+                "aircraft.mcdu2.display": (Mcdu_Display_Renderer("CDU-CO-PILOT"), mobi_client2)}
+    recorder = feed_recorder()
+    replay = feed_replay()
+    session = ReplayGraphQLSession(replay) if replay else await client.connect_async(reconnecting=True)
     while (True):
         try:
             async for result in session.subscribe(subscription, variable_values=params, operation_name=op_name):
-                if "dataRefs" in result:
-                    if (result["dataRefs"]["name"] == "aircraft.mcdu1.display"):
-                        mobi_json = create_mobi_json(result["dataRefs"]["value"])
-                        await mobi_client1.send_json_data(mobi_json)
-                    elif (result["dataRefs"]["name"] == "aircraft.mcdu2.display"):
-                        mobi_json = create_mobi_json(result["dataRefs"]["value"])
-                        await mobi_client2.send_json_data(mobi_json)              
+                trace = start_trace()
+                recorder.record(GRAPHQL_CHANNEL, json.dumps(result))
+                if "dataRefs" in result and result["dataRefs"]["name"] in displays:
+                    renderer, mobi_client = displays[result["dataRefs"]["name"]]
+                    mobi_json = renderer.render(result["dataRefs"]["value"], trace)
+                    if mobi_json is not None:
+                        mobi_client.post(mobi_json, trace)
         except Exception as ex: 
             logging.error(f"run_fenix_graphql_client: {ex}")  
         await asyncio.sleep(5)
 
 
-class Mobiflight_Client:
-
-    def __init__(self, uri, id):
-        self.uri = uri
-        self.id = id
-        self.websocket_connection = None
-
-    async def run_mobiflight_websocket_client(self):  
-        while (True):
-            try:
-                if self.websocket_connection == None:                                
-                    self.websocket_connection = await ws_client.connect(self.uri)  
-                    logging.info(f"Established connection to MobiFlight websocket interface for {self.id}.")                       
-                    # Load font                                        
-                    fontName = "AirbusThales"
-                    await self.websocket_connection.send(f'{{ "Target": "Font", "Data": "{fontName}" }}')
-                    logging.info(f"Setting font: {fontName}")
-                    await asyncio.sleep(1) # wait a second for font to be set
-                # Wait for disconnection or data
-                await self.websocket_connection.recv()    
-            except websockets.exceptions.InvalidStatus as invalid:      
-                self.websocket_connection = None
-                if invalid.response.status_code == 501:
-                    logging.info(f"MobiFlight websocket interface for {self.id} not active. Stop trying.")
-                    # Break and stop for that CDU
-                    break
-                else:
-                    logging.error(f"Error on trying to connect to MobiFlight websocket interface for {self.id}. Will retry: {invalid}")    
-            except Exception as ex:            
-                logging.error(f"Error on trying to connect to MobiFlight websocket interface for {self.id}. Will retry: {ex}")                  
-                self.websocket_connection = None                                        
-            await asyncio.sleep(5)
-
-    async def send_json_data(self, mobi_json):
-        if self.websocket_connection is not None:
-            await self.websocket_connection.send(mobi_json)  
-
-    
-
 async def main():   
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')  
     log = logging.getLogger("gql.transport.websockets")
     log.setLevel(logging.WARNING)   
     logging.info("----STARTED fenix_winwing_cdu.py----")   
-    client1 = Mobiflight_Client("ws://localhost:8320/winwing/cdu-captain", "CDU-CAPTAIN")
-    client2 = Mobiflight_Client("ws://localhost:8320/winwing/cdu-co-pilot", "CDU-CO-PILOT")  
-    mobi_task = asyncio.create_task(client1.run_mobiflight_websocket_client())
-    mobi_task2 = asyncio.create_task(client2.run_mobiflight_websocket_client())
+    client1 = MobiFlightSink("ws://localhost:8320/winwing/cdu-captain", font="AirbusThales", max_retries=None)
+    client2 = MobiFlightSink("ws://localhost:8320/winwing/cdu-co-pilot", font="AirbusThales", max_retries=None)
+    mobi_task = asyncio.create_task(client1.run())
+    mobi_task2 = asyncio.create_task(client2.run())
     fenix_task = asyncio.create_task(run_fenix_graphql_client(client1, client2))
     await asyncio.gather(fenix_task, mobi_task, mobi_task2)
     
 
 # --------- MAIN -----------
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,10 +1,17 @@
 import asyncio
 import os
+import sys
 import json
 import logging
 import logging.handlers
-import websockets.asyncio.client as ws_client
 import http.client
+import time
+
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mobiflight_sink import MobiFlightSink  # pylint: disable=wrong-import-position,import-error
+from cdu_latency_metrics import start_trace  # pylint: disable=wrong-import-position,import-error
+from cdu_feed_recording import ReplayHttpClient, feed_recorder, feed_replay  # pylint: disable=wrong-import-position,import-error
 
 FSL_COLOR_MAP = {
     0: "w",  # black (ignore)
@@ -34,107 +41,193 @@ subs = {
     "£": "\u2190",  
 }
 
-mobi_websocket_connections = {"captain": None, "co-pilot": None}
-data_queues = {"3CA1": asyncio.Queue(), "3CA2": asyncio.Queue()}
-
 MAX_WS_RETRIES = 3   # <--- Added retry limit
 
-
-async def fetch_fsl_mcdu(mcdu):
-    """Fetch MCDU data using a persistent HTTP connection, avoiding redundant updates."""
-    global data_queues
-
-    last_fetched_data = None
-    conn = http.client.HTTPConnection("localhost", 8080, timeout=1)
-
-    while True:
-        try:
-            conn.request("GET", f"/MCDU/Display/{mcdu}")
-            response = conn.getresponse()
-
-            if response.status == 200:
-                new_data = json.load(response)
-
-                if "Value" in new_data:
-                    parsed_data = parse_fsl_mcdu(new_data["Value"])
-
-                    if parsed_data != last_fetched_data:
-                        last_fetched_data = parsed_data
-                        await data_queues[mcdu].put(parsed_data)
-
-        except (http.client.HTTPException, TimeoutError) as ex:
-            logging.warning(f"fetch_fsl_mcdu: Connection to FSLabs aircraft not possible. Timeout or HTTP error: {ex}")
-            await asyncio.sleep(2)
-            conn = http.client.HTTPConnection("localhost", 8080, timeout=1)
-
-        except Exception as ex:
-            logging.error(f"fetch_fsl_mcdu: {ex}")
-            conn = http.client.HTTPConnection("localhost", 8080, timeout=1)
-
-        await asyncio.sleep(0.3)
-
-
-async def run_fsl_http_client(mcdu, cdu):
-    global mobi_websocket_connections
-    global data_queues
-
-    while True:        
-        mobi_json = await data_queues[mcdu].get()
-
-        if mobi_json and mobi_websocket_connections[cdu]:
-            await mobi_websocket_connections[cdu].send(mobi_json)
-
-
-async def run_mobiflight_websocket_client(cdu_type):
-    """WebSocket client with retry limit."""
-    global mobi_websocket_connections
-
-    retries = 0
-    has_connected_once = False
-
-    while True:
-        try:
-            if mobi_websocket_connections[cdu_type] is None:
-
-                if not has_connected_once and retries >= MAX_WS_RETRIES:
-                    logging.info(
-                        f"[{cdu_type}] No CDU detected after {retries} attempts -> stopping task."
+FSL_HOST = "localhost"
+FSL_PORT = 8080
+REQUEST_TIMEOUT = 1.0
+# The display is polled quickly right after it has changed, the interval grows while it stays static
+MIN_POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 0.3
+POLL_BACKOFF = 1.5
+STATS_INTERVAL = 60.0
+
+
+class KeepAliveHttpClient:
+    """Minimal HTTP/1.1 client on asyncio streams, keeps one connection open for repeated GET requests."""
+
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    async def get(self, path):
+        """Returns status and body of a GET request. Raises OSError, TimeoutError or http.client.HTTPException."""
+        # A kept-alive connection may have been closed by the server since the last request, retry once on a new one
+        for attempt in range(2):
+            reused = self.writer is not None
+            try:
+                if not reused:
+                    self.reader, self.writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port), self.timeout
                     )
-                    return
-
-                ws_url = f"ws://localhost:8320/winwing/cdu-{cdu_type}"
-                logging.info(
-                    f"[{cdu_type}] Connecting to MobiFlight WebSocket "
-                    f"(attempt {retries + 1}/{MAX_WS_RETRIES}) -> {ws_url}"
-                )
-
-                mobi_websocket_connections[cdu_type] = await ws_client.connect(ws_url)
-                logging.info(f"[{cdu_type}] Connected.")
-
-                has_connected_once = True
-                retries = 0  # reset retry counter
-
-                fontName = "AirbusThales"
-                await mobi_websocket_connections[cdu_type].send(
-                    f'{{ "Target": "Font", "Data": "{fontName}" }}'
-                )
-                logging.info(f"[{cdu_type}] Setting font: {fontName}")
-                await asyncio.sleep(1) # wait a second for font to be set
-
-            await asyncio.sleep(0.05)
-       
-        except Exception as ex:
-            logging.info(f"[{cdu_type}] WebSocket connection failed: {ex}")
-            mobi_websocket_connections[cdu_type] = None
-            retries += 1
-
-            if retries >= MAX_WS_RETRIES:
-                logging.info(
-                   f"[{cdu_type}] No CDU detected after {retries} attempts -> stopping task. If you only have one CDU attached, you can ignore this message."
-                )
-                return
-
-            await asyncio.sleep(2)
+                return await asyncio.wait_for(self.request(path), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if not reused or attempt:
+                    raise
+            except BaseException:
+                # Unknown state of the connection, e.g. after a timeout in the middle of a response
+                self.close()
+                raise
+        raise ConnectionError(f"Connection to {self.host}:{self.port} lost")
+
+    async def request(self, path):
+        self.writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nConnection: keep-alive\r\n\r\n".encode("ascii")
+        )
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by server")
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError) as ex:
+            raise http.client.BadStatusLine(status_line.decode("latin-1")) from ex
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = await self.read_chunked()
+        elif "content-length" in headers:
+            body = await self.reader.readexactly(int(headers["content-length"]))
+        else:
+            # Body ends with the connection
+            body = await self.reader.read()
+            self.close()
+
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, body
+
+    async def read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # Skip trailers up to the empty line
+                while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readexactly(2)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+
+class PollStats:
+    """Request latency and change-hit ratio of one MCDU poller, logged every STATS_INTERVAL seconds."""
+
+    def __init__(self, mcdu):
+        self.mcdu = mcdu
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.changes = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency, changed):
+        self.requests += 1
+        self.changes += 1 if changed else 0
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def log_if_due(self, interval):
+        if time.monotonic() - self.started >= STATS_INTERVAL:
+            self.log(interval)
+            self.reset()
+
+    def log(self, interval):
+        if not self.requests:
+            return
+        logging.info(
+            f"MCDU {self.mcdu}: {self.requests} requests, {self.changes} changed "
+            f"({100 * self.changes / self.requests:.1f}% hits), latency avg "
+            f"{1000 * self.total_latency / self.requests:.1f} ms, max {1000 * self.max_latency:.1f} ms, "
+            f"poll interval {interval:.2f} s"
+        )
+
+
+async def fetch_fsl_mcdu(mcdu, sink):
+    """Poll MCDU data over a kept-alive connection without blocking, avoiding redundant updates."""
+    last_body = None
+    last_fetched_data = None
+    # Changed bodies are recorded, and while replaying the recorded ones are polled instead of the aircraft
+    channel = f"fslabs/{mcdu}"
+    recorder = feed_recorder()
+    replay = feed_replay()
+    client = ReplayHttpClient(replay, channel) if replay else KeepAliveHttpClient(FSL_HOST, FSL_PORT, REQUEST_TIMEOUT)
+    stats = PollStats(mcdu)
+    interval = MIN_POLL_INTERVAL
+
+    try:
+        while True:
+            changed = False
+            try:
+                started = time.monotonic()
+                status, body = await client.get(f"/MCDU/Display/{mcdu}")
+                latency = time.monotonic() - started
+
+                # An unchanged response does not need to be decoded again
+                if status == 200 and body != last_body:
+                    trace = start_trace()
+                    recorder.record(channel, body)
+                    last_body = body
+                    new_data = json.loads(body)
+                    trace.mark("decode")
+
+                    if "Value" in new_data:
+                        parsed_data = parse_fsl_mcdu(new_data["Value"])
+
+                        if parsed_data != last_fetched_data:
+                            last_fetched_data = parsed_data
+                            sink.post(parsed_data, trace)
+                            changed = True
+
+                stats.record(latency, changed)
+
+            except (http.client.HTTPException, OSError, TimeoutError) as ex:
+                logging.warning(f"fetch_fsl_mcdu: Connection to FSLabs aircraft not possible. Timeout or HTTP error: {ex}")
+                interval = MIN_POLL_INTERVAL
+                await asyncio.sleep(2)
+                continue
+
+            except Exception as ex:
+                logging.error(f"fetch_fsl_mcdu: {ex}")
+                client.close()
+
+            interval = MIN_POLL_INTERVAL if changed else min(MAX_POLL_INTERVAL, interval * POLL_BACKOFF)
+            stats.log_if_due(interval)
+            await asyncio.sleep(interval)
+    finally:
+        stats.log(interval)
+        client.close()
 
 
 def parse_fsl_mcdu(value_list):
@@ -164,26 +257,21 @@ def parse_fsl_mcdu(value_list):
 
 
 
-# Wrapper to run all tasks for a CDU and cancel fetch/process if websocket exits
+# Wrapper to run all tasks for a CDU and cancel fetching if the MobiFlight connection gives up
 async def run_cdu_tasks(mcdu, cdu):
-    fetch_task = asyncio.create_task(fetch_fsl_mcdu(mcdu))
-    process_task = asyncio.create_task(run_fsl_http_client(mcdu, cdu))
-    ws_task = asyncio.create_task(run_mobiflight_websocket_client(cdu))
-
-    done, pending = await asyncio.wait([ws_task], return_when=asyncio.FIRST_COMPLETED)
+    sink = MobiFlightSink(f"ws://localhost:8320/winwing/cdu-{cdu}", font="AirbusThales",
+                          max_retries=MAX_WS_RETRIES, retry_delay=2)
+    ws_task = asyncio.create_task(sink.run())
+    fetch_task = asyncio.create_task(fetch_fsl_mcdu(mcdu, sink))
 
-    # If ws_task is done (returns early), cancel the others
-    if ws_task in done:
-        fetch_task.cancel()
-        process_task.cancel()
-        try:
-            await fetch_task
-        except asyncio.CancelledError:
-            pass
-        try:
-            await process_task
-        except asyncio.CancelledError:
-            pass
+    # ws_task returns early if no CDU is detected
+    await ws_task
+    fetch_task.cancel()
+    try:
+        await fetch_task
+    except asyncio.CancelledError:
+        pass
+    await sink.close()
 
 
 async def main():
@@ -217,4 +305,5 @@ def setup_logging(log_level, log_file_full_path):
     root_logger.addHandler(console_handler)
 
 
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,13 +1,21 @@
 import asyncio
-from collections import deque
 from enum import IntEnum, StrEnum
+from functools import lru_cache
 from itertools import chain
 import json
 import logging
+import os
 from math import ceil, floor
 import re
+import sys
+import time
 from typing import Literal, Never, Optional, List, Dict, Union
-import websockets.asyncio.client as ws_client
+
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mobiflight_sink import MobiFlightSink  # pylint: disable=wrong-import-position,import-error
+from cdu_latency_metrics import start_trace  # pylint: disable=wrong-import-position,import-error
+from cdu_feed_recording import SIMBRIDGE_CHANNEL, connect_websocket, feed_recorder  # pylint: disable=wrong-import-position,import-error
 
 
 class MfCharSize(IntEnum):
@@ -29,6 +37,8 @@ class MfColour(StrEnum):
 
 
 MfMcduChar = Union[tuple[Never], tuple[str, MfColour, MfCharSize]]
+# Characters without specific alignment, left aligned and right aligned characters
+ParsedSegment = tuple[tuple[MfMcduChar, ...], tuple[MfMcduChar, ...], tuple[MfMcduChar, ...]]
 
 # URLs for WinWing CDU WebSockets
 CAPTAIN_CDU_URL: str = "ws://localhost:8320/winwing/cdu-captain"
@@ -42,6 +52,9 @@ CDU_COLUMNS: int = 24
 CDU_ROWS: int = 14
 CDU_CELLS: int = CDU_COLUMNS * CDU_ROWS
 
+# Parsed segments kept in the cache, the pages of both MCDUs use far less
+FBW_SEGMENT_CACHE_SIZE: int = 1024
+
 # Special character mapping
 REPLACED_CHARS = {
     "←": "\u2190",  # left arrow
@@ -58,71 +71,19 @@ REPLACED_CHARS = {
 }
 
 
-class MobiFlightClient:
-    def __init__(self, websocket_uri: str, max_retries: int = 3) -> None:
-        self.websocket: Optional[ws_client.ClientConnection] = None
-        self.connected: asyncio.Event = asyncio.Event()
-        self.websocket_uri: str = websocket_uri
-        self.retries: int = 0
-        self.max_retries: int = max_retries
-
-    async def run(self) -> None:
-        while self.retries < self.max_retries:
-            try:
-                if self.websocket is None:
-                    logging.info("Connecting to MobiFlight at %s", self.websocket_uri)
-                    self.websocket = await ws_client.connect(
-                        self.websocket_uri, ping_interval=None
-                    )
-                    logging.info("MobiFlight connected at %s", self.websocket_uri)
-                    self.connected.set()
-                await self.websocket.recv()
-            except Exception as e:
-                self.retries += 1
-                logging.debug(f"Retrying MobiFlight websocket, attempt {self.retries}: {e}")
-                self.websocket = None
-                self.connected.clear()
-            await asyncio.sleep(5)
-        logging.info(
-            "Max retries reached. Giving up connecting to MobiFlight at %s. "
-            "If you only have one CDU attached, you can ignore this message.",
-            self.websocket_uri,
-        )
-        self.connected.set()
-
-    async def send(self, data: str) -> None:
-        if self.websocket and self.connected.is_set():
-            await self.websocket.send(data)
-
-    async def close(self) -> None:
-        if self.websocket:
-            await self.websocket.close()
-            self.websocket = None
-            self.connected.clear()
-
-    def is_connected(self) -> bool:
-        return self.websocket and self.connected.is_set()
-
-
-FormatStack = deque[Union[MfCharSize, MfColour, Literal["left", "right"]]]
-
-
-def get_format_colour(format_stack: FormatStack) -> MfColour:
-    return next((x for x in format_stack if isinstance(x, MfColour)), MfColour.White)
-
-
-def get_format_size(format_stack: FormatStack, is_label_line: bool) -> MfCharSize:
-    return next(
-        (x for x in format_stack if isinstance(x, MfCharSize)),
-        MfCharSize.Small if is_label_line else MfCharSize.Large,
-    )
-
-
-def get_format_alignment(
-    format_stack: FormatStack,
-) -> Union[Literal["left", "right"], None]:
-    return next((x for x in format_stack if x == "left" or x == "right"), None)
+# Formatting in effect while parsing a segment: colour, size and the list the characters are aligned into
+FormatState = tuple[MfColour, MfCharSize, List[MfMcduChar]]
 
+FBW_COLOUR_TAGS: Dict[str, MfColour] = {
+    "amber": MfColour.Amber,
+    "cyan": MfColour.Cyan,
+    "green": MfColour.Green,
+    "inop": MfColour.Grey,
+    "magenta": MfColour.Magenta,
+    "red": MfColour.Red,
+    "white": MfColour.White,
+    "yellow": MfColour.Yellow,
+}
 
 FBW_TAGS = [
     "end",
@@ -131,94 +92,62 @@ FBW_TAGS = [
     "right",
     "small",
     "big",
-    "amber",
-    "cyan",
-    "green",
-    "inop",
-    "magenta",
-    "red",
-    "white",
-    "yellow",
+    *FBW_COLOUR_TAGS,
     "",
 ]
 FBW_TAG_REGEX = re.compile("{(" + "|".join(FBW_TAGS) + ")}")
 
 
-def parse_fbw_segment(
-    segment: str, is_label_line: bool
-) -> tuple[List[MfMcduChar], List[MfMcduChar], List[MfMcduChar]]:
+@lru_cache(maxsize=FBW_SEGMENT_CACHE_SIZE)
+def parse_fbw_segment(segment: str, is_label_line: bool) -> ParsedSegment:
     """
     Returns a list of characters that are not specifically aligned,
     a list that are left aligned, and a list that are right aligned.
+
+    Most segments are identical from one update to the next, so results are cached per
+    (segment, is_label_line). They are returned as tuples because cached results are shared.
     """
 
     normal_chars: List[MfMcduChar] = []
     left_chars: List[MfMcduChar] = []
     right_chars: List[MfMcduChar] = []
 
-    format_stack: FormatStack = deque()
-    tag = None
+    # The current format is kept up to date as tags are opened and closed,
+    # every opening tag saves the format it replaces so that its {end} can restore it
+    colour: MfColour = MfColour.White
+    size: MfCharSize = MfCharSize.Small if is_label_line else MfCharSize.Large
+    current_chars: List[MfMcduChar] = normal_chars
+    saved_formats: List[FormatState] = []
 
     last_match_index = 0
     for match in FBW_TAG_REGEX.finditer(segment):
-        match get_format_alignment(format_stack):
-            case "left":
-                current_chars = left_chars
-            case "right":
-                current_chars = right_chars
-            case _:
-                current_chars = normal_chars
-
-        for c in segment[last_match_index:match.start()]:
-            current_chars.append(
-                (
-                    REPLACED_CHARS.get(c, c),
-                    get_format_colour(format_stack),
-                    get_format_size(format_stack, is_label_line),
-                )
-            )
+        current_chars.extend((REPLACED_CHARS.get(c, c), colour, size) for c in segment[last_match_index:match.start()])
         last_match_index = match.end()
 
         tag = match.group(1)
+        if tag == "end":
+            colour, size, current_chars = saved_formats.pop()
+            continue
+        if tag == "sp":
+            current_chars.append(tuple())
+            continue
+
+        saved_formats.append((colour, size, current_chars))
         match tag:
-            case "end":
-                format_stack.popleft()
             case "small":
-                format_stack.appendleft(MfCharSize.Small)
+                size = MfCharSize.Small
             case "big":
-                format_stack.appendleft(MfCharSize.Large)
-            case "amber":
-                format_stack.appendleft(MfColour.Amber)
-            case "cyan":
-                format_stack.appendleft(MfColour.Cyan)
-            case "green":
-                format_stack.appendleft(MfColour.Green)
-            case "inop":
-                format_stack.appendleft(MfColour.Grey)
-            case "magenta":
-                format_stack.appendleft(MfColour.Magenta)
-            case "red":
-                format_stack.appendleft(MfColour.Red)
-            case "white":
-                format_stack.appendleft(MfColour.White)
-            case "yellow":
-                format_stack.appendleft(MfColour.Yellow)
-            case "sp":
-                current_chars.append(tuple())
-            case "left" | "right":  # these are used only in the F-PLN title line...
-                format_stack.appendleft(tag)
+                size = MfCharSize.Large
+            case "left":  # these are used only in the F-PLN title line...
+                current_chars = left_chars
+            case "right":
+                current_chars = right_chars
+            case _ if tag in FBW_COLOUR_TAGS:
+                colour = FBW_COLOUR_TAGS[tag]
             case _:
                 logging.warning(f'Unknown format tag "{tag}"!')
-                format_stack.appendleft(None)
-
-    for c in segment[last_match_index:]:
-        current_chars.append(
-            (
-                REPLACED_CHARS.get(c, c),
-                get_format_colour(format_stack),
-                get_format_size(format_stack, is_label_line),
-            )
-        )
+
+    current_chars.extend((REPLACED_CHARS.get(c, c), colour, size) for c in segment[last_match_index:])
 
     # centre the content in the same way the FBW HTML layout does if it's too long
     if len(normal_chars) > CDU_COLUMNS:
@@ -228,7 +157,12 @@ def parse_fbw_segment(
         end = ceil(diff / 2)
         normal_chars = normal_chars[start:-end]
 
-    return normal_chars, left_chars[:CDU_COLUMNS], right_chars[:CDU_COLUMNS]
+    return tuple(normal_chars), tuple(left_chars[:CDU_COLUMNS]), tuple(right_chars[:CDU_COLUMNS])
+
+
+def log_segment_cache_stats() -> None:
+    info = parse_fbw_segment.cache_info()  # pylint: disable=no-value-for-parameter
+    logging.info("Segment cache: %s hits, %s misses, %s/%s entries", info.hits, info.misses, info.currsize, info.maxsize)
 
 
 def is_blank_char(char: MfMcduChar) -> bool:
@@ -237,7 +171,7 @@ def is_blank_char(char: MfMcduChar) -> bool:
 
 def place_chars_in_row(
     row: List[MfMcduChar],
-    chars: tuple[List[MfMcduChar], List[MfMcduChar], List[MfMcduChar]],
+    chars: ParsedSegment,
     column: int,
 ) -> None:
     for i, c in enumerate(chars[1]):  # left-aligned
@@ -354,9 +288,10 @@ def create_mobi_json(content: Dict) -> str:
 class FbwMcduClient:
     """Client for the FlyByWire MCDU WebSocket"""
 
-    def __init__(self, mobiflight_clients: Dict[str, MobiFlightClient]) -> None:
+    def __init__(self, mobiflight_clients: Dict[str, MobiFlightSink]) -> None:
         self.mobiflight = mobiflight_clients
         self.fbw_websocket = None
+        self.recorder = feed_recorder()
         self.last_mcdu_data: Dict[Literal["left", "right"], Dict] = {}
         self.retries = 0
         self.max_retries = 10
@@ -374,6 +309,8 @@ class FbwMcduClient:
                         continue
 
                 msg = await self.fbw_websocket.recv()
+                received_at = time.perf_counter()
+                self.recorder.record(SIMBRIDGE_CHANNEL, msg)
 
                 # Process any update messages
                 if msg.startswith("update:"):
@@ -386,17 +323,20 @@ class FbwMcduClient:
                             # only update if there is new data to display
                             if mcdu_data is not None and self.last_mcdu_data.get(side) != mcdu_data:
                                 self.last_mcdu_data[side] = mcdu_data
-                                await mobiflight.send(create_mobi_json(mcdu_data))
+                                trace = start_trace(received_at)
+                                trace.mark("decode")
+                                mobiflight.post(create_mobi_json(mcdu_data), trace)
                             elif mcdu_data is None:
                                 self.last_mcdu_data[side] = None
                                 # clear the display
-                                await mobiflight.send(create_mobi_json({}))
+                                mobiflight.post(create_mobi_json({}))
                         else:
                             # make sure we get a refresh if we later connect
                             self.last_mcdu_data[side] = None
 
             except Exception as e:
                 logging.error(f"Error processing MCDU data: {e}")
+                log_segment_cache_stats()
                 self.fbw_websocket = None
                 await asyncio.sleep(5)
 
@@ -407,7 +347,7 @@ class FbwMcduClient:
             try:
                 if self.fbw_websocket is None:
                     logging.info("Connecting to FlyByWire SimBridge...")
-                    self.fbw_websocket = await ws_client.connect(FBW_MCDU_URL)
+                    self.fbw_websocket = await connect_websocket(FBW_MCDU_URL, SIMBRIDGE_CHANNEL)
                     logging.info("Connected to FlyByWire SimBridge")
 
                     # Request an update as soon as connected in-case a CDU is already connected
@@ -437,9 +377,9 @@ async def main():
 
     logging.info("----STARTED FBW A32NX MCDU to WinWing CDU Integration----")
 
-    mobiflight_left = MobiFlightClient(CAPTAIN_CDU_URL)
+    mobiflight_left = MobiFlightSink(CAPTAIN_CDU_URL)
     mobiflight_left_task = asyncio.create_task(mobiflight_left.run())
-    mobiflight_clients = {"left": mobiflight_left}  # Dictionary with MobiFlightClient objects
+    mobiflight_clients = {"left": mobiflight_left}  # Dictionary with MobiFlightSink objects
 
     fbw_client = FbwMcduClient(mobiflight_clients)
     fbw_task = asyncio.create_task(fbw_client.run())
@@ -459,4 +399,6 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logging.info("Process terminated by user")
     except Exception as e:
-        logging.error(f"Error: {e}")
\ No newline at end of file
+        logging.error(f"Error: {e}")
+    finally:
+        log_segment_cache_stats()
\ No newline at end of file
@@ -10,16 +10,14 @@ CL650/CDU/<CDU Number>/screen/text_lineX - text lines where X is from 0 to 14
 CL650/CDU/<CDU Number>/screen/style_lineX - character styles lines where X is from 0 to 14, bytes type with 24 elements, each element representing type for each character
 
 
-Upon script start, MobiFlight is probed (get_available_devices()) to detect the devices connected to the PC. Any device that returns a successful response is then tracked.
+Upon script start, all MobiFlight CDU endpoints are probed at once (get_available_devices()) to detect the devices connected to the PC. Any device that accepts the connection is then tracked and the probe connection is kept for its display updates.
 
-Two tasks are started independently for each available CDU device.
-1. handle_dataref_updates -> Listens to X-Plane's WebSocket server for dataref updates for that specific CDU and pushes an event to a queue
-2. handle_device_update   -> Listens to the queue and dispatches updates to MobiFlight to update that CDU
+A single DatarefSubscription (xplane_dataref_subscription.py) connects to X-Plane's WebSocket server once, subscribes to the datarefs of all available CDU devices and routes every update to the device it belongs to.
+For each available CDU device, handle_device_update takes the newest set of values from the device's StateMailbox (state_mailbox.py) and dispatches updates to MobiFlight to update that CDU. Sets of values superseded while the display is rate limited are dropped, so the display never falls behind the simulator.
 
-Tasks are started independently for each CDU device to ensure each device can update quickly, particularly when players might be performing shared cockpit flights.
+Every device has its own display task to ensure each device can update quickly, particularly when players might be performing shared cockpit flights.
 
-Upon a failed connection while dispatching updates to MobiFlight, the handle_device_update function uses `async for` with the websockets client. The failed message is put back in the queue, the loop continues to the next iteration which then reconnects again.
-The failed message is picked back up and dispatched to MobiFlight. This ensures a user's device eventually receives the updated display contents and doesn't hang which would require the user to cycle the page again.
+handle_device_update posts the translated display to a MobiFlightSink (mobiflight_sink.py), which only keeps the latest display if MobiFlight can't keep up. Upon a failed connection the sink reconnects and sends the latest display again. This ensures a user's device eventually receives the updated display contents and doesn't hang which would require the user to cycle the page again.
 """
 
 import asyncio
@@ -27,26 +25,33 @@ import base64
 import re
 import json
 import logging
-import urllib.request
-import websockets
+import os
+import sys
+from functools import partial
 from enum import StrEnum, IntEnum
 from typing import TypedDict, TypeAlias
 
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from xplane_display_frame import DisplayFrame  # pylint: disable=wrong-import-position,import-error
+from mobiflight_sink import MobiFlightSink, discover_endpoints  # pylint: disable=wrong-import-position,import-error
+from xplane_dataref_cache import load_dataref_mappings  # pylint: disable=wrong-import-position,import-error
+from xplane_dataref_subscription import DatarefSubscription  # pylint: disable=wrong-import-position,import-error
+from state_mailbox import StateMailbox  # pylint: disable=wrong-import-position,import-error
+
 CDU_COLUMNS = 24
 CDU_ROWS = 14
 
 WEBSOCKET_HOST = "localhost"
 WEBSOCKET_PORT = 8320
 
-BASE_REST_URL = "http://localhost:8086/api/v2/datarefs"
+BASE_API_URL = "http://localhost:8086/api"
 BASE_WEBSOCKET_URI = f"ws://{WEBSOCKET_HOST}:8086/api/v2"
 
 WS_CAPTAIN = f"ws://{WEBSOCKET_HOST}:{WEBSOCKET_PORT}/winwing/cdu-captain"
 WS_CO_PILOT = f"ws://{WEBSOCKET_HOST}:{WEBSOCKET_PORT}/winwing/cdu-co-pilot"
 WS_OBSERVER = f"ws://{WEBSOCKET_HOST}:{WEBSOCKET_PORT}/winwing/cdu-observer"
 
-FONT_REQUEST = json.dumps({"Target": "Font", "Data": "Boeing"})
-
 # contains processed datarefs for each line
 class LineData(TypedDict):
     text: str
@@ -130,45 +135,63 @@ DATAREF_FILTER_PATTERNS = {
 DATAREF_PROCESS_PATTERN = re.compile("^(text|style)_line([0-9]{1,2})$") # regex group 1 will be "text" or "style", group 2 will be line number
 DATAREF_LINE_COUNT = 15 # total of 15 lines in dataref, 0 through 14, last line is a Message line which is not displayed on Winwing
 
-def fetch_dataref_mapping(device: CduDevice):
-    with urllib.request.urlopen(BASE_REST_URL, timeout=5) as response:
-        response_json = json.load(response)
-        data = list(response_json["data"])
+def select_cdu_datarefs(device: CduDevice, datarefs: list[dict]) -> dict[int, str]:
+    pattern = DATAREF_FILTER_PATTERNS[device]
+    return {int(dataref["id"]): str(dataref["name"]) for dataref in datarefs if pattern.match(dataref["name"])}
+
+
+async def fetch_dataref_mappings(devices: list[CduDevice]) -> dict[CduDevice, dict[int, str]]:
+    mappings = await load_dataref_mappings(
+        {f"hotstart_cl650/{device}": partial(select_cdu_datarefs, device) for device in devices}, BASE_API_URL
+    )
+    return {device: mappings[f"hotstart_cl650/{device}"] for device in devices}
+
+
+def generate_row_cells(line_data: LineData) -> list[tuple[str, CduCharacterColor, CduCharacterSize]]:
+    row_cells: list[tuple[str, CduCharacterColor, CduCharacterSize]] = []
+    character_styles = list(line_data["style"])
+    row_text = line_data["text"]
 
-        dataref_map = filter(
-            lambda x: DATAREF_FILTER_PATTERNS[device].match(x["name"]),
-            data,
-        )
+    if len(row_text) == 0:
+        for _ in range(CDU_COLUMNS):
+            row_cells.append((" ", CduCharacterColor.WHITE, CduCharacterSize.SMALL)) # fill up empty line if text was empty
+    else: 
+        for character_index in range(CDU_COLUMNS):
+            if character_index < len(row_text): # or populate text with styles
+                row_cells.append((row_text[character_index], CduCharacterColor.from_style(character_styles[character_index]), CduCharacterSize.from_style(character_styles[character_index])))
+            else:
+                row_cells.append((" ", CduCharacterColor.WHITE, CduCharacterSize.SMALL)) # fill up rest of characters, but this is very unlikely to hit as datarefs have full characters
+
+    return row_cells
 
-        return dict(
-            map(
-                lambda dataref: (int(dataref["id"]), str(dataref["name"])),
-                dataref_map,
-            )
-        )
 
 def generate_display_json(cdu_data: CduData) -> str:
     display_data: list[tuple[str, CduCharacterColor, CduCharacterSize]] = []
 
     for row in range(CDU_ROWS):
-
         if row in cdu_data:
-            character_styles = list(cdu_data[row]["style"])
-            row_text = cdu_data[row]["text"]
-
-            if len(row_text) == 0:
-                for _ in range(CDU_COLUMNS):
-                    display_data.append((" ", CduCharacterColor.WHITE, CduCharacterSize.SMALL)) # fill up empty line if text was empty
-            else: 
-                for character_index in range(CDU_COLUMNS):
-                    if character_index < len(row_text): # or populate text with styles
-                        display_data.append((row_text[character_index], CduCharacterColor.from_style(character_styles[character_index]), CduCharacterSize.from_style(character_styles[character_index])))
-                    else:
-                        display_data.append((" ", CduCharacterColor.WHITE, CduCharacterSize.SMALL)) # fill up rest of characters, but this is very unlikely to hit as datarefs have full characters
+            display_data.extend(generate_row_cells(cdu_data[row]))
 
     return json.dumps({"Target": "Display", "Data": display_data})
 
 
+def get_line_number(dataref_name: str) -> int | None:
+    short_name = dataref_name[dataref_name.rfind('/')+1:]
+    re_match = DATAREF_PROCESS_PATTERN.fullmatch(short_name)
+    if re_match is None:
+        logging.error("error trying to extract type and line number from dataref: %s", short_name)
+        return None
+    return int(re_match.group(2))
+
+
+def render_line(line: int, line_datarefs: dict[str, str], display_data: list) -> None:
+    # the text and style datarefs of a line are always processed together, the Message line (14) is not displayed
+    line_data = process_datarefs(line_datarefs).get(line)
+    if line_data is None or line >= CDU_ROWS:
+        return
+    display_data[line * CDU_COLUMNS : (line + 1) * CDU_COLUMNS] = generate_row_cells(line_data)
+
+
 def process_datarefs(values: dict[str, str]) -> CduData:
     results: CduData = {}
 
@@ -214,7 +237,7 @@ def print_cdu_data(data: CduData):
         print(row, f"({len(data[row]['text'])}):", data[row]["text"], "****", f"({len(data[row]['style'])})", [hex(v) for v in list(data[row]["style"])])
 
 
-async def handle_device_update(queue: asyncio.Queue, device: CduDevice):
+async def handle_device_update(mailbox: StateMailbox, device: CduDevice, sink: MobiFlightSink):
     """
     Translates and sends dataref updates to MobiFlight.
     """
@@ -222,126 +245,54 @@ async def handle_device_update(queue: asyncio.Queue, device: CduDevice):
     last_run_time = 0
     rate_limit_time = 0.1
 
-    endpoint = device.get_endpoint()
-    logging.info("Connecting to CDU device %s", device)
-    async for websocket in websockets.connect(endpoint):
-        logging.info("Connected successfully to CDU device %s", device)
-        while True:
-            values = await queue.get()
+    # Only rows affected by changed datarefs are re-rendered into the persistent frame
+    display_frame = DisplayFrame(get_line_number, render_line)
 
-            try:
-                elapsed = asyncio.get_event_loop().time() - last_run_time
-
-                # Weaker CPUs may experience performance issues when a websocket connection is saturated with requests, such as when pages are frequently changed.
-                # This rate limits the number of active websocket requests to MobiFlight.
-                # The delay should not be noticeable unless a user heavily spams page changes, but it should be enough that too many messages won't be pushed at once.
-                if elapsed < rate_limit_time:
-                    await asyncio.sleep(rate_limit_time - elapsed)
-
-                cdu_data = process_datarefs(values)
-
-                display_json = generate_display_json(cdu_data)
-                await websocket.send(display_json)
-                last_run_time = asyncio.get_event_loop().time()
-
-            except websockets.exceptions.ConnectionClosed:
-                logging.error("MobiFlight websocket connection was closed... Attempting to reconnect")
-                await queue.put(values)
-                break
-
-
-async def handle_dataref_updates(queue: asyncio.Queue[dict[str,str]], device: CduDevice):
-    last_known_values: dict[str, str] = {}
-
-    dataref_map = fetch_dataref_mapping(device) # contains mapping between int id of dataref and name of dataref in X-Plane, values received only related to ids
-    logging.info("Connecting to X-Plane websocket server")
-    async for websocket in websockets.connect(
-        BASE_WEBSOCKET_URI,
-    ):
-        logging.info("Connected successfully to X-Plane websocket server")
-        try:
-            await websocket.send(
-                json.dumps(
-                    {
-                        "type": "dataref_subscribe_values",
-                        "req_id": 1,
-                        "params": {
-                            "datarefs": [
-                                {"id": id_value} for id_value in dataref_map.keys()
-                            ]
-                        },
-                    }
-                )
-            )
-            while True:
-                message = await websocket.recv()
-                data = json.loads(message)
-
-                if "data" not in data:
-                    continue
-
-                new_values: dict[str, str] = dict(last_known_values)
-
-                for dataref_id, value in data["data"].items():
-                    dataref_id = int(dataref_id)
-                    if dataref_id not in dataref_map:
-                        continue
-
-                    dataref_name = dataref_map[dataref_id]
-                    new_values[dataref_name] = value
-
-                if new_values == last_known_values:
-                    continue
-
-                last_known_values = new_values
-                await queue.put(new_values)
-        except websockets.exceptions.ConnectionClosed:
-            logging.error(
-                "X-Plane websocket connection was closed... Attempting to reconnect"
-            )
-            continue
+    # The sink reconnects on its own and redelivers the latest display after a reconnect
+    sink_task = asyncio.create_task(sink.run())
+    try:
+        while True:
+            await mailbox.wait()
 
+            elapsed = asyncio.get_event_loop().time() - last_run_time
 
-async def get_available_devices() -> list[CduDevice]:
-    device_candidates = [device for device in CduDevice]
+            # Weaker CPUs may experience performance issues when a websocket connection is saturated with requests, such as when pages are frequently changed.
+            # This rate limits the number of active websocket requests to MobiFlight.
+            # The delay should not be noticeable unless a user heavily spams page changes, but it should be enough that too many messages won't be pushed at once.
+            if elapsed < rate_limit_time:
+                await asyncio.sleep(rate_limit_time - elapsed)
 
-    available_devices: list[CduDevice] = []
+            # States that arrived during the rate limit supersede the one that woke us up
+            values, trace = mailbox.get_traced_nowait()
 
-    logging.info("Checking MobiFlight for available CDU devices")
-    for device in device_candidates:
-        device_endpoint = device.get_endpoint()
-        try:
-            async with websockets.connect(device_endpoint) as socket:
-                logging.info(
-                    "Discovered CDU device %s at endpoint %s", device, device_endpoint
-                )
-                available_devices.append(device)
-                await socket.send(FONT_REQUEST)
-                await asyncio.sleep(1) # wait a second for font to be set
-        except websockets.WebSocketException:
-            logging.warning(
-                "Attempted to probe CDU device %s at endpoint %s but device wasn't available",
-                device,
-                device_endpoint,
-            )
-            continue
+            display_json = display_frame.update(values, trace)
+            sink.post(display_json, trace)
+            last_run_time = asyncio.get_event_loop().time()
+    finally:
+        sink_task.cancel()
+        mailbox.log_stats()
+        await sink.close()
 
-    return available_devices
 
+async def get_available_devices() -> dict[CduDevice, MobiFlightSink]:
+    logging.info("Checking MobiFlight for available CDU devices")
+    # All endpoints are probed at once, the probe connections are kept for sending the display updates
+    return await discover_endpoints({device: device.get_endpoint() for device in CduDevice}, font="Boeing")
 
 
 async def main():
     available_devices = await get_available_devices()
-
+    dataref_maps = await fetch_dataref_mappings(list(available_devices))
+    subscription = DatarefSubscription(BASE_WEBSOCKET_URI)
 
     tasks = []
-    for device in available_devices:
-        queue = asyncio.Queue()
-
-        tasks.append(asyncio.create_task(handle_dataref_updates(queue, device)))
-        tasks.append(asyncio.create_task(handle_device_update(queue, device)))
+    for device, sink in available_devices.items():
+        mailbox = StateMailbox(f"{device} datarefs")
+        subscription.add_feed(device, dataref_maps[device], mailbox)
+        tasks.append(asyncio.create_task(handle_device_update(mailbox, device, sink)))
+    tasks.append(asyncio.create_task(subscription.run()))
 
-    logging.info("Started background tasks for %s", available_devices)
+    logging.info("Started background tasks for %s", list(available_devices))
 
     await asyncio.gather(*tasks)
 
@@ -2,11 +2,18 @@ from ctypes import Structure, c_int, c_long, c_ubyte, c_double, c_bool, c_char
 import ctypes
 import json
 import logging
+import os
+import sys
 import asyncio
-from typing import Dict, List, Optional, Union
-from websockets.asyncio.client import connect
+from typing import Dict, List, NamedTuple, Optional, Union
 import mmap
 
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mobiflight_sink import MobiFlightSink  # pylint: disable=wrong-import-position,import-error
+from cdu_latency_metrics import start_trace  # pylint: disable=wrong-import-position,import-error
+from cdu_feed_recording import FeedReplay, feed_recorder, feed_replay  # pylint: disable=wrong-import-position,import-error
+
 # WebSocket URLs
 CAPTAIN_CDU_URL: str = "ws://localhost:8320/winwing/cdu-captain"
 FO_CDU_URL: str = "ws://localhost:8320/winwing/cdu-co-pilot"
@@ -36,48 +43,31 @@ class ShareMemory737MAXSDK(ctypes.Structure):
         ("CDU_BRT_Switch_Status", c_ubyte * 2),
     ]
 
-class MobiFlightClient:
-    def __init__(self, url: str) -> None:
-        self.url: str = url
-        self.websocket = None
-        self._was_connected: bool = False
+# The per-CDU screen arrays are one byte per cell, so every CDU occupies CELLS bytes in each of them
+LSK_CHAR_OFFSET: int = ShareMemory737MAXSDK.LSKChar.offset
+LSK_SMALL_FONT_OFFSET: int = ShareMemory737MAXSDK.LSK_SmallFont.offset
+LSK_COLOR_OFFSET: int = ShareMemory737MAXSDK.LSK_Color.offset
 
-    async def connect(self) -> None:
-        try:
-            self.websocket = await connect(self.url)            
-            logging.info(f"Connected to WebSocket at {self.url}")
-            # Load font           
-            fontName: str = "Boeing"
-            await self.websocket.send(f'{{ "Target": "Font", "Data": "{fontName}" }}')
-            logging.info(f"Setting font: {fontName}")
-            await asyncio.sleep(1) # wait a second for font to be set
-            self._was_connected = True
-        except Exception as e:
-            logging.error(f"Failed to connect to WebSocket: {e}")
-            self._was_connected = False
-
-    async def send(self, data: Dict) -> None:
-        if not self.websocket:
-            if self._was_connected:
-                # Try to reconnect if we were previously connected
-                await self.connect()
-            if not self.websocket:
-                return
-        
-        try:
-            await self.websocket.send(json.dumps(data))
-        except Exception as e:
-            logging.error(f"Failed to send data: {e}")
-            self._was_connected = False
-            self.websocket = None
+POLL_INTERVAL_ENV: str = "MOBIFLIGHT_IFLY_POLL_INTERVAL"
+DEFAULT_POLL_INTERVAL: float = 0.1
+
+
+def poll_interval_from_env() -> float:
+    try:
+        return max(0.01, float(os.environ.get(POLL_INTERVAL_ENV, DEFAULT_POLL_INTERVAL)))
+    except ValueError:
+        return DEFAULT_POLL_INTERVAL
+
+
+class CduScreenSnapshot(NamedTuple):
+    """Copy of the screen arrays of one CDU, one byte per cell in row-major order"""
+    chars: bytes
+    small_font: bytes
+    colors: bytes
 
-    async def close(self) -> None:
-        if self.websocket:
-            await self.websocket.close()
-            self.websocket = None
 
-def create_mobi_json(memory_map: ShareMemory737MAXSDK, cdu_index: int) -> Dict:
-    """Create JSON message for MobiFlight WebSocket from memory map data"""
+def create_mobi_json(screen: CduScreenSnapshot) -> Dict:
+    """Create JSON message for MobiFlight WebSocket from the screen of one CDU"""
     message: Dict[str, Union[str, List[List[Union[str, int]]]]] = {
         "Target": "Display",
         "Data": [[] for _ in range(CELLS)]
@@ -100,30 +90,29 @@ def create_mobi_json(memory_map: ShareMemory737MAXSDK, cdu_index: int) -> Dict:
     
     try:
         data = []
-        for row in range(ROWS):
-            for col in range(COLUMNS):
-                    char = memory_map.LSKChar[cdu_index][row][col].decode('ascii', errors='replace')
-                    small_font = memory_map.LSK_SmallFont[cdu_index][row][col]
-                    color = memory_map.LSK_Color[cdu_index][row][col]
-
-                    if color == 0 and char in [' ', '\0']:
-                        data.append([])
-                    else:
-                        # Handle special characters
-                        if color == 5:  # Box character
-                            char = "\u2610"  # Unicode box
-                        elif color == 9:  # Left arrow
-                            char = "\u2190"  # Unicode left arrow
-                        elif color == 10:  # Right arrow
-                            char = "\u2192"  # Unicode right arrow
-                        elif color in (6, 7, 8):  # Degree symbol
-                            char = "\u00B0"  # Unicode degree symbol
-                        
-                        data.append([
-                            char,
-                            color_map.get(color, "w"),
-                            1 if small_font else 0
-                        ])
+        for cell in range(CELLS):
+            char = screen.chars[cell:cell + 1].decode('ascii', errors='replace')
+            small_font = screen.small_font[cell]
+            color = screen.colors[cell]
+
+            if color == 0 and char in [' ', '\0']:
+                data.append([])
+            else:
+                # Handle special characters
+                if color == 5:  # Box character
+                    char = "\u2610"  # Unicode box
+                elif color == 9:  # Left arrow
+                    char = "\u2190"  # Unicode left arrow
+                elif color == 10:  # Right arrow
+                    char = "\u2192"  # Unicode right arrow
+                elif color in (6, 7, 8):  # Degree symbol
+                    char = "\u00B0"  # Unicode degree symbol
+                
+                data.append([
+                    char,
+                    color_map.get(color, "w"),
+                    1 if small_font else 0
+                ])
         
         message["Data"] = data
                 
@@ -134,62 +123,121 @@ def create_mobi_json(memory_map: ShareMemory737MAXSDK, cdu_index: int) -> Dict:
     return message
 
 class IFlyCDUClient:
-    def __init__(self, cdu_index: int) -> None:
+    def __init__(self, cdu_index: int, poll_interval: Optional[float] = None) -> None:
         self.cdu_index: int = cdu_index  # 0 for captain, 1 for F/O
-        self.client = MobiFlightClient(CAPTAIN_CDU_URL if cdu_index == 0 else FO_CDU_URL)
+        self.client = MobiFlightSink(CAPTAIN_CDU_URL if cdu_index == 0 else FO_CDU_URL, font="Boeing")
+        self.poll_interval: float = poll_interval if poll_interval is not None else poll_interval_from_env()
         self.memory_map: Optional[mmap.mmap] = None
+        # Read-only views on this CDU's part of the screen arrays, nothing is copied to read them
+        self.char_view: Optional[memoryview] = None
+        self.small_font_view: Optional[memoryview] = None
+        self.color_view: Optional[memoryview] = None
+        self.last_screen: Optional[CduScreenSnapshot] = None
+        # Changed screens are recorded as chars, small font and colors one after another
+        self.channel: str = f"ifly/cdu{cdu_index}"
+        self.recorder = feed_recorder()
+        self.replay: Optional[FeedReplay] = feed_replay()
+        self.polls: int = 0
+        self.changes: int = 0
         self._running: bool = False
 
     def setup_memory_map(self) -> bool:
         try:
-            self.memory_map = mmap.mmap(-1, ctypes.sizeof(ShareMemory737MAXSDK),
-                                      MEMORY_MAP_NAME,
-                                      access=mmap.ACCESS_READ)
+            if self.replay is not None:
+                # replay_screens() writes the recorded screens to an anonymous map of the same layout
+                self.memory_map = mmap.mmap(-1, ctypes.sizeof(ShareMemory737MAXSDK))
+            else:
+                self.memory_map = mmap.mmap(-1, ctypes.sizeof(ShareMemory737MAXSDK),
+                                          MEMORY_MAP_NAME,
+                                          access=mmap.ACCESS_READ)
+            view = memoryview(self.memory_map)
+            start = self.cdu_index * CELLS
+            self.char_view = view[LSK_CHAR_OFFSET + start:LSK_CHAR_OFFSET + start + CELLS]
+            self.small_font_view = view[LSK_SMALL_FONT_OFFSET + start:LSK_SMALL_FONT_OFFSET + start + CELLS]
+            self.color_view = view[LSK_COLOR_OFFSET + start:LSK_COLOR_OFFSET + start + CELLS]
+            view.release()
             logging.info(f"Successfully opened memory map for CDU {self.cdu_index}")
             return True
         except Exception as e:
             logging.error(f"Failed to open memory map for CDU {self.cdu_index}: {e}")
             return False
 
+    def screen_changed(self) -> bool:
+        last = self.last_screen
+        return (
+            last is None
+            or self.char_view != last.chars
+            or self.small_font_view != last.small_font
+            or self.color_view != last.colors
+        )
+
     async def process_memory_map(self) -> None:
         if not self.memory_map:
             return
         
         try:
-            # Read the entire structure
-            data = self.memory_map.read(ctypes.sizeof(ShareMemory737MAXSDK))
-            self.memory_map.seek(0)
-            
-            # Create structure from memory map data
-            memory_struct = ShareMemory737MAXSDK.from_buffer_copy(data)
-            
+            self.polls += 1
+            # Compare in place, the frame is only copied, converted and sent if the screen has changed
+            if not self.screen_changed():
+                return
+
+            trace = start_trace()
+            screen = CduScreenSnapshot(
+                self.char_view.tobytes(), self.small_font_view.tobytes(), self.color_view.tobytes()
+            )
+            self.last_screen = screen
+            self.changes += 1
+            self.recorder.record(self.channel, b"".join(screen))
+            trace.mark("decode")
+
             # Create and send JSON message
-            json_data = create_mobi_json(memory_struct, self.cdu_index)
-            await self.client.send(json_data)
+            json_data = create_mobi_json(screen)
+            trace.mark("render")
+            self.client.post(json.dumps(json_data), trace)
             
         except Exception as e:
             logging.error(f"Error processing memory map for CDU {self.cdu_index}: {e}")
 
+    async def replay_screens(self) -> None:
+        start = self.cdu_index * CELLS
+        async for frame in self.replay.frames([self.channel]):
+            for index, offset in enumerate((LSK_CHAR_OFFSET, LSK_SMALL_FONT_OFFSET, LSK_COLOR_OFFSET)):
+                self.memory_map[offset + start:offset + start + CELLS] = frame.payload[index * CELLS:(index + 1) * CELLS]
+
+    def close_memory_map(self) -> None:
+        # The views have to be released before the memory map can be closed
+        for view in (self.char_view, self.small_font_view, self.color_view):
+            if view is not None:
+                view.release()
+        self.char_view = self.small_font_view = self.color_view = None
+        if self.memory_map:
+            self.memory_map.close()
+            self.memory_map = None
+
     async def run(self) -> None:
         if not self.setup_memory_map():
             return
         
         self._running = True
-        await self.client.connect()
+        client_task = asyncio.create_task(self.client.run())
+        replay_task = asyncio.create_task(self.replay_screens()) if self.replay is not None else None
         
         try:
             while self._running:
                 await self.process_memory_map()
-                await asyncio.sleep(0.1)  # Update 10 times per second
+                await asyncio.sleep(self.poll_interval)
         except asyncio.CancelledError:
             logging.info(f"CDU {self.cdu_index} client was cancelled")
         except Exception as e:
             logging.error(f"Error in run loop for CDU {self.cdu_index}: {e}")
         finally:
+            logging.info(f"CDU {self.cdu_index}: {self.polls} polls every {self.poll_interval:.2f} s, "
+                         f"{self.changes} screen changes sent")
             await self.client.close()
-            if self.memory_map:
-                self.memory_map.close()
-                self.memory_map = None
+            client_task.cancel()
+            if replay_task is not None:
+                replay_task.cancel()
+            self.close_memory_map()
 
     def stop(self) -> None:
         self._running = False
@@ -1,10 +1,17 @@
-import asyncio, ctypes, json, logging, struct
+import asyncio, ctypes, json, logging, os, sys
 from ctypes import wintypes, Structure, c_ubyte, sizeof
 from typing import Any
-import websockets.asyncio.client as ws_client
 from SimConnect import SimConnect, Enum
 from SimConnect.Enum import SIMCONNECT_CLIENT_DATA_ID, SIMCONNECT_RECV_ID, SIMCONNECT_RECV_CLIENT_DATA
 
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from simconnect_client_data import client_data_bytes, record_client_data  # pylint: disable=wrong-import-position,import-error
+from simconnect_replay import replay_simconnect  # pylint: disable=wrong-import-position,import-error
+from cdu_frame_dedup import FrameDeduplicator  # pylint: disable=wrong-import-position,import-error
+from mobiflight_sink import MobiFlightSink  # pylint: disable=wrong-import-position,import-error
+from cdu_latency_metrics import start_trace  # pylint: disable=wrong-import-position,import-error
+
 # --- Config ---
 CAPTAIN_MCDU_URL = "ws://localhost:8320/winwing/cdu-captain"
 FO_MCDU_URL = "ws://localhost:8320/winwing/cdu-co-pilot"
@@ -42,51 +49,13 @@ class SimConnectMobiFlight(SimConnect):
     def my_dispatch_proc(self, pData, cbData, pContext):
         if not pData: return
         if pData.contents.dwID == SIMCONNECT_RECV_ID.SIMCONNECT_RECV_ID_CLIENT_DATA:
+            record_client_data(pData, cbData)
             client_data = ctypes.cast(pData, ctypes.POINTER(SIMCONNECT_RECV_CLIENT_DATA)).contents
             for handler in self.client_data_handlers:
                 handler(client_data)
         else:
             super().my_dispatch_proc(pData, cbData, pContext)
 
-# --- MobiFlight WebSocket Client ---
-class MobiFlightClient:
-    def __init__(self, uri:str, max_retries=3):
-        self.uri, self.max_retries, self.retries = uri, max_retries, 0
-        self.connected, self.websocket = asyncio.Event(), None
-        self._was_connected, self.last_data = False, None
-
-    async def run(self):
-        while self.retries < self.max_retries:
-            try:
-                logging.info(f"Connecting to {self.uri}")
-                self.websocket = await ws_client.connect(self.uri, ping_interval=None)                
-                await self.websocket.send(json.dumps({"Target":"Font","Data":"AirbusThales"}))
-                logging.info(f"Setting font: AirbusThales")
-                await asyncio.sleep(1) # wait a second for font to be set
-                self.connected.set()
-                if self._was_connected and self.last_data: await self.send(self.last_data)
-                self._was_connected, self.retries = True, 0
-                async for _ in self.websocket: pass
-            except Exception as e:
-                self.retries += 1               
-                logging.info(f"WebSocket failure: {e} ({self.retries}/{self.max_retries})")
-                self.websocket = None
-                self.connected.clear()
-            await asyncio.sleep(5)     
-        logging.info("Max retries reached. Giving up connecting to MobiFlight at %s. If you only have one CDU attached, you can ignore this message.", self.uri)
-        self.connected.set()
-        
-    async def send(self, data:str):
-        if self.websocket and self.connected.is_set():
-            await self.websocket.send(data)
-            self.last_data = data
-            
-    async def close(self):
-        if self.websocket: 
-            await self.websocket.close()
-            self.websocket = None
-            self.connected.clear()
-
 # --- Data Conversion ---
 def create_mobi_json(data:bytes)->str:
     out = {"Target":"Display","Data":[[] for _ in range(MCDU_CHARS)]}
@@ -111,7 +80,7 @@ class A340MCDUClient:
         self.def_id = def_id
         self.CA_NAME = client_area_name
         self.CA_ID = client_area_id
-        self.mobiflight, self.last_data, self.loop = MobiFlightClient(uri), None, None
+        self.mobiflight, self.dedup = MobiFlightSink(uri, font="AirbusThales"), FrameDeduplicator(client_area_name)
         logging.info(f"Connecting to {self.uri}")
 
     def setup(self):
@@ -131,29 +100,28 @@ class A340MCDUClient:
 
     def on_data(self, d:Any):
         if d.dwDefineID!=self.def_id or not hasattr(d,"dwData"): return
-        count=int(MCDU_DATA_SIZE/4)
-        try: data=struct.pack(f"{count}I",*d.dwData[:count])
-        except: data=b"".join(struct.pack("I",x) for x in d.dwData[:count])
-        if data==self.last_data: return
-        self.last_data=data
+        trace=start_trace()
+        data=client_data_bytes(d,MCDU_DATA_SIZE)
+        if not self.dedup.is_new(data): return
+        trace.mark("decode")
         json_data=create_mobi_json(data)
-        asyncio.run_coroutine_threadsafe(self.mobiflight.send(json_data), self.loop)
+        self.mobiflight.post_threadsafe(json_data,trace)
 
     async def run(self):
         try:
-            self.loop=asyncio.get_running_loop()
             task_ws=asyncio.create_task(self.mobiflight.run())
             await self.mobiflight.connected.wait()
-            if self.mobiflight.retries>=self.mobiflight.max_retries: return
+            if self.mobiflight.gave_up(): return
             if not self.setup(): return
             await asyncio.gather(task_ws)
         finally:
+            self.dedup.log_stats()
             await self.mobiflight.close()
             
 # --- Main ---
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
-    sc=SimConnectMobiFlight()
+    sc=replay_simconnect() or SimConnectMobiFlight()
 
     mcdu_cpt=A340MCDUClient(sc, CAPTAIN_MCDU_URL, A340_MCDU_CPT_DEFINITION, A340_MCDU_CPT_NAME, A340_CPT_MCDU_CLIENT_DATA_ID)
     mcdu_fo=A340MCDUClient(sc, FO_MCDU_URL, A340_MCDU_FO_DEFINITION, A340_MCDU_FO_NAME, A340_FO_MCDU_CLIENT_DATA_ID)
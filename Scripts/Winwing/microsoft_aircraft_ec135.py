@@ -10,13 +10,13 @@ import logging
 import logging.handlers
 import struct
 import ctypes
-from time import sleep
+import os
+import sys
+from time import monotonic, perf_counter, sleep
 from typing import List, Union
 from itertools import chain
 import asyncio
 import threading
-from websockets import connect
-from websockets.exceptions import WebSocketException as WsWebSocketException
 
 # ========================= SimConnectMobiFlight =========================
 from SimConnect import SimConnect
@@ -28,6 +28,13 @@ from SimConnect.Enum import (
     SIMCONNECT_UNUSED,
 )
 
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from simconnect_client_data import client_data_bytes, record_client_data  # pylint: disable=wrong-import-position,import-error
+from simconnect_replay import replay_simconnect  # pylint: disable=wrong-import-position,import-error
+from mobiflight_sink import MobiFlightSink  # pylint: disable=wrong-import-position,import-error
+from cdu_latency_metrics import NULL_TRACE, FrameTrace, start_trace  # pylint: disable=wrong-import-position,import-error
+
 class SimConnectMobiFlight(SimConnect):
     """
     Extends SimConnect to support MobiFlight client data handlers.
@@ -56,6 +63,7 @@ class SimConnectMobiFlight(SimConnect):
     def my_dispatch_proc(self, pData, cbData, pContext):
         dwID = pData.contents.dwID
         if dwID == SIMCONNECT_RECV_ID.SIMCONNECT_RECV_ID_CLIENT_DATA:
+            record_client_data(pData, cbData)
             client_data = ctypes.cast(pData, ctypes.POINTER(SIMCONNECT_RECV_CLIENT_DATA)).contents
             for handler in self.client_data_handlers:
                 handler(client_data)
@@ -89,7 +97,16 @@ class MobiFlightVariableRequests:
     variable subscriptions, and callbacks for MobiFlight LVARs. It provides methods
     to add variable definitions, subscribe to data changes, and process incoming
     client data from the simulator.
+
+    Variables can be registered one by one on first get(), which waits up to 500ms for each of them,
+    or all at once with add_variables() followed by a single wait_until_ready(). With packed=True the
+    whole MobiFlight.LVars area is read by one contiguous client data definition instead of one
+    definition and request per variable.
     """
+    # Definition and request id of the packed read, above the per-variable ids (the LVars area holds 1024 floats)
+    PACKED_DEFINITION_ID = 0x10000
+    LVARS_AREA_SIZE = 4096
+
     def __init__(self, simConnect: SimConnectMobiFlight):
         logging.info("MobiFlightVariableRequests __init__")
         self.sm = simConnect
@@ -103,6 +120,15 @@ class MobiFlightVariableRequests:
         self.DATA_STRING_SIZE = 256
         self.DATA_STRING_OFFSET = 0
         self.DATA_STRING_DEFINITION_ID = 0
+        # Bumped whenever an LVAR value changes, the condition wakes up threads waiting for a change
+        self.version = 0
+        self.changed = threading.Condition()
+        # perf_counter() of the last change, where the latency trace of the redraw starts
+        self.changed_at = None
+        # Set once every registered variable has received its first value
+        self.ready = threading.Event()
+        self.packed = False
+        self.packed_count = 0
         self.sm.register_client_data_handler(self.client_data_callback_handler)
         self.initialize_client_data_areas()
 
@@ -153,7 +179,7 @@ class MobiFlightVariableRequests:
         logging.info("initialize_client_data_areas")
         # LVars area
         self.sm.dll.MapClientDataNameToID(self.sm.hSimConnect, "MobiFlight.LVars".encode("ascii"), self.CLIENT_DATA_AREA_LVARS)
-        self.sm.dll.CreateClientData(self.sm.hSimConnect, self.CLIENT_DATA_AREA_LVARS, 4096, self.FLAG_DEFAULT)
+        self.sm.dll.CreateClientData(self.sm.hSimConnect, self.CLIENT_DATA_AREA_LVARS, self.LVARS_AREA_SIZE, self.FLAG_DEFAULT)
         # Command area
         self.sm.dll.MapClientDataNameToID(self.sm.hSimConnect, "MobiFlight.Command".encode("ascii"), self.CLIENT_DATA_AREA_CMD)
         self.sm.dll.CreateClientData(self.sm.hSimConnect, self.CLIENT_DATA_AREA_CMD, self.DATA_STRING_SIZE, self.FLAG_DEFAULT)
@@ -166,29 +192,85 @@ class MobiFlightVariableRequests:
 
     # ---- BUGFIXED handler: always set float_value on first frame, no dropping first 0.0 ----
     def client_data_callback_handler(self, client_data):
-        if client_data.dwDefineID in self.sim_vars:
-            data_bytes = struct.pack("I", client_data.dwData[0])
-            float_data = struct.unpack('<f', data_bytes)[0]
-            float_value = round(float_data, 5)
-            sim_var = self.sim_vars[client_data.dwDefineID]
-            if not sim_var.initialized:
-                sim_var.initialized = True
-            self.sim_vars[client_data.dwDefineID].float_value = float_value
-            logging.debug("client_data_callback_handler %s, raw=%s", sim_var, float_value)
+        if client_data.dwDefineID == self.PACKED_DEFINITION_ID:
+            count = self.packed_count
+            float_values = struct.unpack(f'<{count}f', client_data_bytes(client_data, 4 * count))
+            value_changed = False
+            for var_id, float_data in enumerate(float_values, start=1):
+                sim_var = self.sim_vars.get(var_id)
+                if sim_var is not None:
+                    value_changed |= self.update_value(sim_var, float_data)
+            self.notify_change(value_changed)
+        elif client_data.dwDefineID in self.sim_vars:
+            float_data = struct.unpack('<f', client_data_bytes(client_data, 4))[0]
+            self.notify_change(self.update_value(self.sim_vars[client_data.dwDefineID], float_data))
         else:
             logging.warning("client_data_callback_handler DefinitionID %s not found!", client_data.dwDefineID)
 
-    def get(self, variableString: str):
-        if variableString not in self.sim_var_name_to_id:
-            # add new variable
-            var_id = len(self.sim_vars) + 1
-            self.sim_vars[var_id] = SimVariable(var_id, variableString)
-            self.sim_var_name_to_id[variableString] = var_id
+    def update_value(self, sim_var, float_data):
+        """Stores a received value, returns True if it differs from the stored one."""
+        float_value = round(float_data, 5)
+        value_changed = not sim_var.initialized or sim_var.float_value != float_value
+        sim_var.initialized = True
+        sim_var.float_value = float_value
+        logging.debug("client_data_callback_handler %s, raw=%s", sim_var, float_value)
+        return value_changed
+
+    def notify_change(self, value_changed):
+        if value_changed:
+            with self.changed:
+                self.version += 1
+                self.changed_at = perf_counter()
+                self.changed.notify_all()
+        if not self.ready.is_set() and all(sim_var.initialized for sim_var in list(self.sim_vars.values())):
+            self.ready.set()
+
+    def register(self, variableString):
+        """Subscribes to a variable without waiting for its value."""
+        if variableString in self.sim_var_name_to_id:
+            return
+        var_id = len(self.sim_vars) + 1
+        self.sim_vars[var_id] = SimVariable(var_id, variableString)
+        self.sim_var_name_to_id[variableString] = var_id
+        self.ready.clear()
+        if not self.packed:
             # subscribe to variable data change
             offset = (var_id - 1) * ctypes.sizeof(ctypes.wintypes.FLOAT)
             self.add_to_client_data_definition(var_id, offset, ctypes.sizeof(ctypes.wintypes.FLOAT))
             self.subscribe_to_data_change(self.CLIENT_DATA_AREA_LVARS, var_id, var_id)
-            self.send_command("MF.SimVars.Add." + variableString)
+        self.send_command("MF.SimVars.Add." + variableString)
+
+    def add_variables(self, variable_strings, packed=False):
+        """
+        Registers all variables at once, without waiting for their values in between.
+        With packed=True all variables, including those registered later, are read with one contiguous definition.
+        """
+        self.packed = self.packed or packed
+        for variable_string in variable_strings:
+            self.register(variable_string)
+        if self.packed:
+            self.subscribe_packed()
+
+    def subscribe_packed(self):
+        """(Re)defines the packed read to cover all registered variables of the LVars area."""
+        count = len(self.sim_vars)
+        if count == self.packed_count:
+            return
+        if count * ctypes.sizeof(ctypes.wintypes.FLOAT) > self.LVARS_AREA_SIZE:
+            raise ValueError(f"{count} variables do not fit into the LVars client data area")
+        self.sm.dll.ClearClientDataDefinition(self.sm.hSimConnect, self.PACKED_DEFINITION_ID)
+        self.add_to_client_data_definition(self.PACKED_DEFINITION_ID, 0, count * ctypes.sizeof(ctypes.wintypes.FLOAT))
+        self.packed_count = count
+        self.subscribe_to_data_change(self.CLIENT_DATA_AREA_LVARS, self.PACKED_DEFINITION_ID, self.PACKED_DEFINITION_ID)
+
+    def wait_until_ready(self, timeout):
+        """Waits once for the first value of all registered variables, returns False on timeout."""
+        return self.ready.wait(timeout)
+
+    def get(self, variableString: str):
+        if variableString not in self.sim_var_name_to_id:
+            # add new variable
+            self.add_variables([variableString])
         # determine id and return value
         variable_id = self.sim_var_name_to_id[variableString]
         sim_var = self.sim_vars[variable_id]
@@ -206,6 +288,15 @@ class MobiFlightVariableRequests:
         logging.debug("get %s. wait_counter=%s, Return=%s", variableString, wait_counter, sim_var.float_value)
         return sim_var.float_value
 
+    def wait_for_change(self, seen_version, timeout):
+        """
+        Blocks until an LVAR value has changed since seen_version was read, or until the timeout has passed.
+        Returns the current version.
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != seen_version, timeout)
+            return self.version
+
     def set(self, variable_string):
         logging.debug("set: %s", variable_string)
         self.send_command("MF.SimVars.Set." + variable_string)
@@ -214,6 +305,7 @@ class MobiFlightVariableRequests:
         logging.info("clear_sim_variables")
         self.sim_vars.clear()
         self.sim_var_name_to_id.clear()
+        self.packed_count = 0
         self.send_command("MF.SimVars.Clear")
 
 # ========================= Logging =========================
@@ -345,13 +437,12 @@ def get_state(v) -> int:
 # ========================= Simple persistent WebSocket =========================
 class McduSocket:
     """
-    Persistent WebSocket sender using the `websockets` library (async) while keeping
+    Persistent WebSocket sender using the shared MobiFlightSink (async) while keeping
     a synchronous API for the rest of the script.
 
     - Runs an asyncio event loop in a background thread
-    - `send_grid(grid)` is synchronous and just queues the latest payload
+    - `send_grid(grid)` is synchronous and just posts the latest payload to the sink
     - Automatically reconnects
-    - Uses built-in ping/keepalive from `websockets`
     """
 
     def __init__(self, url: str, connect_timeout: float = 2.0):
@@ -359,14 +450,13 @@ class McduSocket:
         self.connect_timeout = connect_timeout
 
         self._loop = None
-        self._queue = None
+        self._sink = None
         self._ready = threading.Event()
-        self._stop = threading.Event()
 
         self._thread = threading.Thread(target=self._thread_main, name="McduSocketThread", daemon=True)
         self._thread.start()
 
-        # Wait briefly for loop/queue to exist (avoid first-send race)
+        # Wait briefly for loop/sink to exist (avoid first-send race)
         self._ready.wait(timeout=self.connect_timeout)
 
     def _thread_main(self):
@@ -374,9 +464,10 @@ class McduSocket:
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
             self._loop = loop
-            self._queue = asyncio.Queue()
+            # Reconnect forever with a short backoff, the sink keeps only the latest payload
+            self._sink = MobiFlightSink(self.url, max_retries=None, retry_delay=0.5)
             self._ready.set()
-            loop.run_until_complete(self._run())
+            loop.run_until_complete(self._sink.run())
         except Exception as e:
             logging.exception("MCDU thread crashed: %s", e)
         finally:
@@ -387,79 +478,62 @@ class McduSocket:
             except Exception:
                 pass
 
-    async def _run(self):
-        # Reconnect loop
-        while not self._stop.is_set():
-            try:
-                logging.info("Connecting to MCDU at %s", self.url)
-
-                # websockets keepalive is handled via ping_interval/ping_timeout
-                async with connect(
-                    self.url,
-                    open_timeout=self.connect_timeout,
-                    close_timeout=1.0,
-                    ping_interval=20.0,
-                    ping_timeout=10.0,
-                    max_queue=1,  # keep internal queue small
-                ) as ws:
-                    logging.info("MCDU connected.")
-
-                    while not self._stop.is_set():
-                        # Wait for next payload; we coalesce to "latest only"
-                        payload = await self._queue.get()
-
-                        # Drain any newer payloads (keep only the latest)
-                        try:
-                            while True:
-                                payload = self._queue.get_nowait()
-                        except asyncio.QueueEmpty:
-                            pass
-
-                        # Send
-                        await ws.send(payload)
-                        logging.debug("→ MCDU SEND %s bytes", len(payload))
-
-            except (OSError, WsWebSocketException, asyncio.TimeoutError) as e:
-                logging.debug("MCDU connection/send error: %s", e)
-                # Backoff a bit before reconnect
-                await asyncio.sleep(0.5)
-            except Exception as e:
-                # Unexpected error — log and retry
-                logging.exception("MCDU unexpected error: %s", e)
-                await asyncio.sleep(0.5)
-
-    def send_grid(self, grid: List[List[Cell]]):
+    def send_grid(self, grid: List[List[Cell]], trace: FrameTrace = NULL_TRACE):
+        trace.mark("render")
         payload = grid_to_payload(grid)
+        trace.mark("serialize")
 
         # If the thread/loop isn't ready yet, just drop the frame (next tick will resend)
-        if not self._ready.is_set() or self._loop is None or self._queue is None:
+        if not self._ready.is_set() or self._loop is None or self._sink is None:
             return
 
-        # Thread-safe enqueue into asyncio.Queue
+        # Thread-safe post into the sink's mailbox
         try:
-            self._loop.call_soon_threadsafe(self._queue.put_nowait, payload)
+            self._loop.call_soon_threadsafe(self._sink.enqueue, payload, trace)
         except Exception as e:
-            logging.debug("MCDU enqueue failed: %s", e)
+            logging.debug("MCDU post failed: %s", e)
 
     def close(self):
         # Optional explicit shutdown if you ever want it
-        self._stop.set()
         try:
-            if self._loop:
-                self._loop.call_soon_threadsafe(lambda: None)
+            if self._loop and self._sink:
+                asyncio.run_coroutine_threadsafe(self._sink.close(), self._loop)
         except Exception:
             pass
 
 # ========================= MAIN =========================
+# All LVARs read by the main loop, registered in one go at start
+EC135_LVARS = [
+    "(L:cdsPage)", "(L:brkCDS1)", "(L:engine1Fail)", "(L:engine1OilPress)", "(L:fadecFail1)",
+    "(L:fuelPress1)", "(L:eng1Idle)", "(L:train1)", "(L:trainIdle1)", "(L:eng1Manual)", "(L:twinsgrip1)",
+    "(L:fuelValve1)", "(L:primePump1)", "(L:degraded1)", "(L:redund1)", "(L:hydraulic1)", "(L:genDiscon1)",
+    "(L:inv1)", "(L:fireTest1Ext)", "(L:fireTest1)", "(L:bustie1)", "(L:starter1)", "(L:engine2Fail)",
+    "(L:engine2OilPress)", "(L:fadecFail2)", "(L:fuelPress2)", "(L:eng2Idle)", "(L:train2)", "(L:trainIdle2)",
+    "(L:eng2Manual)", "(L:twinsgrip2)", "(L:fuelValve2)", "(L:primePump2)", "(L:degraded2)", "(L:redund2)",
+    "(L:hydraulic2)", "(L:genDiscon2)", "(L:inv2)", "(L:fireTest2Ext)", "(L:fireTest2)", "(L:bustie2)",
+    "(L:starter2)", "(L:xmsnOilTemp)", "(L:rotorBrake)", "(L:autopilot)", "(L:fuelPumpAft)",
+    "(L:fuelPumpFwd)", "(L:batDisc)", "(L:extPower)", "(L:shedEmer)", "(L:pitotPilot)", "(L:pitotCoPilot)",
+    "(L:cdsSelfTestAcknoledge)", "(L:landLight)", "(L:landLightExtr)", "(L:airCond)",
+]
+
 if __name__ == "__main__":
     # Uncomment to log to file + console:
     # setup_logging("SimConnectMobiFlight.log")
 
     # SimConnect / MobiFlight var reader
-    sm = SimConnectMobiFlight()
+    sm = replay_simconnect() or SimConnectMobiFlight()
     vr = MobiFlightVariableRequests(sm)
     vr.clear_sim_variables()
 
+    # Register all LVARs at once and wait a single time for their first values,
+    # instead of waiting up to 500ms per LVAR on its first get()
+    started = monotonic()
+    vr.add_variables(EC135_LVARS, packed=True)
+    if not vr.wait_until_ready(timeout=5.0):
+        logging.warning("Not all LVARs received a value within 5 s, continuing anyway")
+    logging.info("Registered %s LVARs in %.2f s", len(EC135_LVARS), monotonic() - started)
+    first_frame_sent = False  # pylint: disable=invalid-name
+
     # MCDU socket (captain)
     MCDU_URL = "ws://127.0.0.1:8320/winwing/cdu-captain"
     mcdu = McduSocket(MCDU_URL)
@@ -478,9 +552,20 @@ if __name__ == "__main__":
 ##    client_data_callback_handler(), and subsequent vr.get() calls are simple
 ##    non-blocking dictionary reads.
 ##    Therefore, no external batching loop is required here.
+##
+##    The screen is only redrawn when an LVAR has changed: the version is read before the values,
+##    so a change during drawing triggers the next redraw right away. While nothing changes the
+##    loop sleeps in wait_for_change() and only redraws every SAFETY_REFRESH_INTERVAL seconds.
+
+    SAFETY_REFRESH_INTERVAL = 5.0
+    MIN_REDRAW_INTERVAL = 0.1  # bursts of LVAR changes are drawn at most 10 times per second
+    seen_version = -1
 
     while True:
         try:
+            # Safety refreshes redraw unchanged values, only redraws caused by a change are traced
+            trace = start_trace(vr.changed_at) if vr.version != seen_version else NULL_TRACE
+            seen_version = vr.version
             # HELPERS
             cds_page     = get_state(vr.get("(L:cdsPage)"))
             cds_breaker  = get_state(vr.get("(L:brkCDS1)"))
@@ -658,9 +743,13 @@ if __name__ == "__main__":
                     if txt:
                         put_text_center(grid, txt, r, colour="g", size=LARGE)
             # MCDU send
-            mcdu.send_grid(grid)
+            mcdu.send_grid(grid, trace)
+            if not first_frame_sent:
+                first_frame_sent = True  # pylint: disable=invalid-name
+                logging.info("Time to first frame: %.2f s", monotonic() - started)
 
         except Exception as e:
             logging.exception("Loop error: %s", e)
 
-        sleep(0.1)  # tick rate
+        sleep(MIN_REDRAW_INTERVAL)
+        vr.wait_for_change(seen_version, SAFETY_REFRESH_INTERVAL)
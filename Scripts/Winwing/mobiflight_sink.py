@@ -0,0 +1,274 @@
+"""
+Shared MobiFlight CDU display sink for the WinWing CDU scripts
+
+Every script converts the aircraft's CDU screen into a MobiFlight "Display" message and writes it to
+ws://localhost:8320/winwing/cdu-<captain|co-pilot|observer>. Awaiting the WebSocket write directly in the
+producer lets a slow MobiFlight back-pressure the simulator side, and every frame waiting for the write
+is already obsolete once a newer one has been rendered.
+
+MobiFlightSink decouples both sides with a single-slot mailbox per CDU:
+- post() / post_threadsafe() never block, a new frame replaces a frame that has not been sent yet
+- a dedicated sender task writes whatever frame is in the slot once the previous write has completed
+- run() keeps the connection, (re)sends the font and redelivers the last frame after a reconnect
+- a frame that failed to send is kept for the next connection unless a newer one has arrived
+
+Delta mode (see cdu_display_delta.py) is applied by the sender, so frames are posted in full.
+A frame can be posted with its FrameTrace (see cdu_latency_metrics.py), the sink marks it as serialized
+when posted and records it once the frame has been written to the socket.
+
+discover_endpoints() probes several CDU endpoints concurrently and hands the open probe connection to the
+sink of each available endpoint. MobiFlight does not acknowledge the font request, so instead of sleeping
+after it the sender holds back the first frame until the font settle time has passed. The settle time
+defaults to one second and can be changed with the environment variable MOBIFLIGHT_CDU_FONT_SETTLE_TIME.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Dict, Optional, TypeVar
+
+import websockets.asyncio.client as ws_client
+from websockets.exceptions import ConnectionClosed, InvalidStatus, WebSocketException
+
+from cdu_display_delta import DisplayDeltaEncoder, create_display_delta_encoder  # pylint: disable=import-error
+from cdu_latency_metrics import NULL_TRACE, FrameTrace, ensure_metrics_server  # pylint: disable=import-error
+
+FONT_SETTLE_ENV: str = "MOBIFLIGHT_CDU_FONT_SETTLE_TIME"
+# Time given to MobiFlight to load the font before the first frame is sent
+DEFAULT_FONT_SETTLE_TIME: float = 1.0
+RETRY_DELAY: float = 5.0
+PROBE_TIMEOUT: float = 2.0
+
+# Reference for the startup-to-first-frame time, the scripts import this module right at start
+STARTUP_TIME: float = time.monotonic()
+
+K = TypeVar("K")
+
+
+def font_message(font: str) -> str:
+    return json.dumps({"Target": "Font", "Data": font})
+
+
+def font_settle_time() -> float:
+    try:
+        return max(0.0, float(os.environ.get(FONT_SETTLE_ENV, DEFAULT_FONT_SETTLE_TIME)))
+    except ValueError:
+        return DEFAULT_FONT_SETTLE_TIME
+
+
+class MobiFlightSink:
+    """Latest-frame-wins connection to one MobiFlight CDU endpoint."""
+
+    def __init__(
+        self,
+        websocket_uri: str,
+        font: Optional[str] = None,
+        max_retries: Optional[int] = 3,
+        retry_delay: float = RETRY_DELAY,
+    ) -> None:
+        self.websocket_uri: str = websocket_uri
+        # Label of the latency metrics, e.g. cdu-captain
+        self.cdu_name: str = websocket_uri.rstrip("/").rsplit("/", 1)[-1]
+        self.font: Optional[str] = font
+        # None retries forever, which the X-Plane scripts rely on
+        self.max_retries: Optional[int] = max_retries
+        self.retry_delay: float = retry_delay
+        self.retries: int = 0
+        self.websocket: Optional[ws_client.ClientConnection] = None
+        # Connection opened by discover_endpoints(), used instead of connecting on the first run
+        self.adopted: Optional[ws_client.ClientConnection] = None
+        # Event loop time before which no frame is sent, as MobiFlight is still loading the font
+        self.ready_at: float = 0.0
+        self.connected: asyncio.Event = asyncio.Event()
+        self.display_delta: Optional[DisplayDeltaEncoder] = create_display_delta_encoder(websocket_uri)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # The mailbox: the newest frame not sent yet, and the frame the device currently shows
+        self.pending: Optional[str] = None
+        self.pending_trace: FrameTrace = NULL_TRACE
+        self.last_frame: Optional[str] = None
+        self.frame_ready: asyncio.Event = asyncio.Event()
+        self.closed: bool = False
+        # Set when MobiFlight reports the endpoint as not active, e.g. no device of that kind is attached
+        self.inactive: bool = False
+
+        self.posted: int = 0
+        self.sent: int = 0
+        self.coalesced: int = 0
+        self.failed: int = 0
+        ensure_metrics_server()
+
+    def gave_up(self) -> bool:
+        return self.inactive or (self.max_retries is not None and self.retries >= self.max_retries)
+
+    def adopt(self, websocket: ws_client.ClientConnection) -> None:
+        """Hands an already open connection to the sink, run() uses it instead of connecting."""
+        self.adopted = websocket
+
+    def is_connected(self) -> bool:
+        return self.websocket is not None and self.connected.is_set()
+
+    def post(self, message: str, trace: FrameTrace = NULL_TRACE) -> None:
+        """Hands a frame to the sender without waiting for it. Must be called on the event loop thread."""
+        trace.mark("serialize")
+        self.enqueue(message, trace)
+
+    def post_threadsafe(self, message: str, trace: FrameTrace = NULL_TRACE) -> None:
+        """Same as post() for producers running on other threads, e.g. SimConnect dispatch handlers."""
+        if self.loop is None:
+            return
+        trace.mark("serialize")
+        self.loop.call_soon_threadsafe(self.enqueue, message, trace)
+
+    def enqueue(self, message: str, trace: FrameTrace) -> None:
+        if self.closed or self.gave_up():
+            return
+        self.posted += 1
+        if self.pending is not None:
+            self.coalesced += 1
+        self.pending = message
+        self.pending_trace = trace
+        self.frame_ready.set()
+
+    async def run(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        while not self.closed and not self.gave_up():
+            try:
+                websocket: Optional[ws_client.ClientConnection] = self.adopted
+                self.adopted = None
+                if websocket is None:
+                    logging.info("Connecting to MobiFlight at %s", self.websocket_uri)
+                    websocket = await ws_client.connect(self.websocket_uri, ping_interval=None)
+                async with websocket:
+                    logging.info("MobiFlight connected at %s", self.websocket_uri)
+                    if self.font:
+                        await websocket.send(font_message(self.font))
+                        logging.info("Setting font: %s", self.font)
+                        self.ready_at = self.loop.time() + font_settle_time()
+                    if self.display_delta:
+                        self.display_delta.reset()
+                    self.websocket = websocket
+                    self.retries = 0
+                    self.connected.set()
+
+                    # The device may have been reset while disconnected, redeliver what it should show
+                    if self.pending is None and self.last_frame is not None:
+                        self.pending = self.last_frame
+                        self.pending_trace = NULL_TRACE
+                    if self.pending is not None:
+                        self.frame_ready.set()
+
+                    sender: asyncio.Task = asyncio.create_task(self.send_frames(websocket))
+                    try:
+                        async for _ in websocket:
+                            pass  # MobiFlight does not send anything the scripts need
+                    finally:
+                        sender.cancel()
+                logging.info("MobiFlight connection closed at %s", self.websocket_uri)
+            except asyncio.CancelledError:
+                raise
+            except InvalidStatus as e:
+                if e.response.status_code == 501:
+                    logging.info("MobiFlight WebSocket interface at %s not active. Stop trying.", self.websocket_uri)
+                    self.inactive = True
+                else:
+                    logging.info("MobiFlight WebSocket error at %s: %s", self.websocket_uri, e)
+            except Exception as e:
+                logging.info("MobiFlight WebSocket error at %s: %s", self.websocket_uri, e)
+            self.websocket = None
+            self.connected.clear()
+            if self.closed:
+                break
+            self.retries += 1
+            if self.gave_up():
+                break
+            await asyncio.sleep(self.retry_delay)
+
+        if self.gave_up() and not self.inactive:
+            logging.info("Max retries reached. Giving up connecting to MobiFlight at %s. "
+                         "If you only have one CDU attached, you can ignore this message.", self.websocket_uri)
+        # Unblock everyone waiting for the connection, they check gave_up() afterwards
+        self.connected.set()
+
+    async def send_frames(self, websocket: ws_client.ClientConnection) -> None:
+        while True:
+            await self.frame_ready.wait()
+            delay: float = self.ready_at - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.frame_ready.clear()
+            frame: Optional[str] = self.pending
+            trace: FrameTrace = self.pending_trace
+            self.pending = None
+            self.pending_trace = NULL_TRACE
+            if frame is None:
+                continue
+
+            message: Optional[str] = self.display_delta.encode(frame) if self.display_delta else frame
+            if message is not None:
+                try:
+                    await websocket.send(message)
+                except ConnectionClosed:
+                    self.failed += 1
+                    if self.pending is None:
+                        self.pending = frame
+                        self.pending_trace = trace
+                    return
+                except Exception as e:
+                    self.failed += 1
+                    logging.error("Failed to send frame to MobiFlight at %s: %s", self.websocket_uri, e)
+                    continue
+                self.sent += 1
+                trace.finish(self.cdu_name)
+                if self.sent == 1:
+                    logging.info("%s: first frame sent %.2f s after startup",
+                                 self.websocket_uri, time.monotonic() - STARTUP_TIME)
+            self.last_frame = frame
+
+    async def close(self) -> None:
+        self.closed = True
+        self.log_stats()
+        if self.websocket:
+            await self.websocket.close()
+            self.websocket = None
+            self.connected.clear()
+
+    def log_stats(self) -> None:
+        logging.info("%s: %s frames posted, %s sent, %s coalesced, %s failed",
+                     self.websocket_uri, self.posted, self.sent, self.coalesced, self.failed)
+        if self.display_delta:
+            self.display_delta.log_stats()
+
+
+async def probe_endpoint(websocket_uri: str, timeout: float = PROBE_TIMEOUT) -> Optional[ws_client.ClientConnection]:
+    """Returns an open connection to the endpoint, None if MobiFlight does not accept it within the timeout."""
+    try:
+        return await ws_client.connect(websocket_uri, ping_interval=None, open_timeout=timeout)
+    except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+        logging.warning("Attempted to probe CDU endpoint %s but device wasn't available: %s", websocket_uri, e)
+        return None
+
+
+async def discover_endpoints(
+    endpoints: Dict[K, str],
+    font: Optional[str] = None,
+    max_retries: Optional[int] = None,
+    timeout: float = PROBE_TIMEOUT,
+) -> Dict[K, MobiFlightSink]:
+    """Probes all endpoints concurrently and returns a sink holding the probe connection for every available one."""
+    started: float = time.monotonic()
+    connections = await asyncio.gather(*(probe_endpoint(uri, timeout) for uri in endpoints.values()))
+
+    sinks: Dict[K, MobiFlightSink] = {}
+    for (key, uri), websocket in zip(endpoints.items(), connections):
+        if websocket is None:
+            continue
+        logging.info("Discovered CDU device %s at endpoint %s", key, uri)
+        sink = MobiFlightSink(uri, font=font, max_retries=max_retries)
+        sink.adopt(websocket)
+        sinks[key] = sink
+
+    logging.info("Probed %s CDU endpoints in %.2f s", len(endpoints), time.monotonic() - started)
+    return sinks
@@ -5,12 +5,19 @@ import json
 import logging
 import asyncio
 import os
-import struct
-import websockets.asyncio.client as ws_client
+import sys
 from typing import Optional, List, Dict, Union, Any
 from SimConnect import SimConnect, Enum
 from SimConnect.Enum import SIMCONNECT_CLIENT_DATA_ID, SIMCONNECT_RECV_ID, SIMCONNECT_RECV_CLIENT_DATA
 
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from simconnect_client_data import client_data_bytes, record_client_data  # pylint: disable=wrong-import-position,import-error
+from simconnect_replay import replay_simconnect  # pylint: disable=wrong-import-position,import-error
+from cdu_frame_dedup import FrameDeduplicator  # pylint: disable=wrong-import-position,import-error
+from mobiflight_sink import MobiFlightSink  # pylint: disable=wrong-import-position,import-error
+from cdu_latency_metrics import start_trace  # pylint: disable=wrong-import-position,import-error
+
 
 class SimConnectMobiFlight(SimConnect):
 
@@ -39,6 +46,7 @@ class SimConnectMobiFlight(SimConnect):
     def my_dispatch_proc(self, pData, cbData, pContext):
         dwID = pData.contents.dwID
         if dwID == SIMCONNECT_RECV_ID.SIMCONNECT_RECV_ID_CLIENT_DATA:
+            record_client_data(pData, cbData)
             client_data = ctypes.cast(pData, ctypes.POINTER(SIMCONNECT_RECV_CLIENT_DATA)).contents
             for handler in self.client_data_handlers:
                 handler(client_data)
@@ -77,117 +85,129 @@ PMDG_CDU_1_ID: int = 0x4E473336
 PMDG_CDU_1_DEFINITION: int = 0x4E473339
 
 
-class MobiFlightClient:
-    def __init__(self, websocket_uri: str, max_retries: int = 3) -> None:
-        self.websocket: Optional[ws_client.ClientConnection] = None
-        self.connected: asyncio.Event = asyncio.Event()
-        self.websocket_uri: str = websocket_uri
-        self.retries: int = 0
-        self.max_retries: int = max_retries
+COLOR_MAP: Dict[int, str] = {
+    CDU_COLOR_WHITE: "w",
+    CDU_COLOR_CYAN: "c",
+    CDU_COLOR_GREEN: "g",
+    CDU_COLOR_MAGENTA: "m",
+    CDU_COLOR_AMBER: "a",
+    CDU_COLOR_RED: "r"
+}
+
+SYMBOL_MAP: Dict[str, str] = {
+    '\xA1': "\u2190",  # left arrow
+    '\xA2': "\u2192",  # right arrow
+    '\xA3': "\u2191",  # up arrow
+    '\xA4': "\u2193",  # down arrow
+    '\u00CA': "\u2610", # box
+}
+
+EMPTY_CELL_JSON: str = json.dumps([])
+
+
+def render_cell(symbol_byte: int, color: int, flags: int) -> List[Union[str, int]]:
+    """Converts a single PMDG cell (symbol, colour, flags) into a MobiFlight cell."""
+    symbol: str = chr(symbol_byte)
+    is_lowercase: bool = symbol.islower()
+    symbol = symbol.upper()
+
+    if symbol == ' ' or symbol == '\0':
+        return []
+
+    # Handle special characters
+    symbol = SYMBOL_MAP.get(symbol, symbol)
+
+    # Handle color based on flags
+    if flags & CDU_FLAG_UNUSED:
+        color_str: str = "e"  # Gray for unused
+    elif flags & CDU_FLAG_REVERSE:
+        color_str = "e"  # Gray for reverse video
+    else:
+        color_str = COLOR_MAP.get(color, "w")
+
+    return [
+        symbol,
+        color_str,
+        1 if (is_lowercase) or (flags & CDU_FLAG_SMALL_FONT) else 0
+    ]
+
+
+def cell_key(symbol_byte: int, color: int, flags: int) -> int:
+    """Packs the three cell bytes into a single int, used as key of CELL_JSON_TABLE."""
+    return symbol_byte | (color << 8) | (flags << 16)
+
+
+class CellJsonTable(dict):
+    """
+    Lookup table from packed cell bytes (see cell_key) to the finished JSON fragment of that cell.
+
+    The PMDG buffer only ever contains a small set of colours and flags, so the table is precomputed
+    for every symbol in combination with the documented colour and flag values.
+    Anything outside that range (undocumented colours or flag bits) is rendered on first use and memoized.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        for flags in range((CDU_FLAG_SMALL_FONT | CDU_FLAG_REVERSE | CDU_FLAG_UNUSED) + 1):
+            for color in COLOR_MAP:
+                for symbol_byte in range(256):
+                    self[cell_key(symbol_byte, color, flags)] = json.dumps(render_cell(symbol_byte, color, flags))
+
+    def __missing__(self, key: int) -> str:
+        value: str = json.dumps(render_cell(key & 0xFF, (key >> 8) & 0xFF, (key >> 16) & 0xFF))
+        self[key] = value
+        return value
+
+
+CELL_JSON_TABLE: CellJsonTable = CellJsonTable()
+
+# PMDG sends the cells in column-major order, MobiFlight expects them row-major.
+# SOURCE_OFFSETS[i] is the byte offset in the PMDG buffer of the i-th MobiFlight cell.
+SOURCE_OFFSETS: List[int] = [
+    (x * CDU_ROWS + y) * CDU_CELL_BYTE_COUNT
+    for y in range(CDU_ROWS)
+    for x in range(CDU_COLUMNS)
+]
+
+DISPLAY_JSON_PREFIX: str = '{"Target": "Display", "Data": ['
+DISPLAY_JSON_SUFFIX: str = ']}'
 
-    async def run(self) -> None:
-        while self.retries < self.max_retries:
-            try:
-                if self.websocket is None:
-                    logging.info("Connecting to MobiFlight at %s", self.websocket_uri)
-                    self.websocket = await ws_client.connect(self.websocket_uri, ping_interval=None)
-                    logging.info("MobiFlight connected at %s", self.websocket_uri)
-                    # Load font           
-                    fontName: str = "Boeing"
-                    await self.websocket.send(f'{{ "Target": "Font", "Data": "{fontName}" }}')
-                    logging.info(f"Setting font: {fontName}")
-                    await asyncio.sleep(1) # wait a second for font to be set
-                    self.connected.set()
-                await self.websocket.recv()
-            except Exception as e: 
-                self.retries += 1
-                logging.info(f"WebSocket error: {e} with retries {self.retries}")
-                self.websocket = None
-                self.connected.clear()
-            await asyncio.sleep(5)
-        logging.info("Max retries reached. Giving up connecting to MobiFlight at %s. If you only have one CDU attached, you can ignore this message.", self.websocket_uri)
-        self.connected.set()
-
-    async def send(self, data: str) -> None:
-        if self.websocket and self.connected.is_set():
-            await self.websocket.send(data)
-
-    async def close(self) -> None:
-        if self.websocket:
-            await self.websocket.close()
-            self.websocket = None
-            self.connected.clear()
 
 def create_mobi_json(data: bytes) -> str:
-    message: Dict[str, Union[str, List[List[Union[str, int]]]]] = {
-        "Target": "Display",
-        "Data": [[] for _ in range(CDU_CELLS)]
-    }
-    
-    # Process data in column-major order as received from PMDG
-    for x in range(CDU_COLUMNS):
-        for y in range(CDU_ROWS):
-            src_idx: int = (x * CDU_ROWS + y) * CDU_CELL_BYTE_COUNT
-            dst_idx: int = y * CDU_COLUMNS + x
-            
-            if src_idx + 2 >= len(data):
-                message["Data"][dst_idx] = []
-                continue
-                
-            try:
-                symbol: str = chr(data[src_idx])
-                is_lowercase: bool = symbol.islower()
-                symbol = symbol.upper()
-                color: int = data[src_idx + 1]
-                flags: int = data[src_idx + 2]
-
-                if symbol == ' ' or symbol == '\0':
-                    message["Data"][dst_idx] = []
-                else:
-                    # Handle special characters
-                    if symbol == '\xA1': symbol = "\u2190"  # left arrow
-                    elif symbol == '\xA2': symbol = "\u2192"  # right arrow
-                    elif symbol == '\xA3': symbol = "\u2191"  # up arrow
-                    elif symbol == '\xA4': symbol = "\u2193"  # down arrow
-                    elif symbol == '\u00CA': symbol = "\u2610" # box
-                    
-                    # Handle color based on flags
-                    if flags & CDU_FLAG_UNUSED:
-                        color_str: str = "e"  # Gray for unused
-                    elif flags & CDU_FLAG_REVERSE:
-                        color_str = "e"  # Gray for reverse video
-                    else:
-                        color_str = {
-                            CDU_COLOR_WHITE: "w",
-                            CDU_COLOR_CYAN: "c",
-                            CDU_COLOR_GREEN: "g",
-                            CDU_COLOR_MAGENTA: "m",
-                            CDU_COLOR_AMBER: "a",
-                            CDU_COLOR_RED: "r"
-                        }.get(color, "w")
-
-                    message["Data"][dst_idx] = [
-                        symbol,
-                        color_str,
-                        1 if (is_lowercase) or (flags & CDU_FLAG_SMALL_FONT) else 0
-                    ]
-            except (ValueError, TypeError, IndexError) as e:
-                message["Data"][dst_idx] = []
-                logging.debug(f"Error processing cell: {e}")
-    
-    return json.dumps(message)
+    """
+    Converts a PMDG CDU buffer into the MobiFlight display JSON.
+
+    Every cell is looked up in CELL_JSON_TABLE and the fragments are joined, so no per-character
+    processing or JSON encoding happens per frame. The output is identical to json.dumps of the message.
+    """
+    table: CellJsonTable = CELL_JSON_TABLE
+
+    if len(data) >= CDU_CELLS * CDU_CELL_BYTE_COUNT:
+        cells: List[str] = [
+            table[data[offset] | (data[offset + 1] << 8) | (data[offset + 2] << 16)]
+            for offset in SOURCE_OFFSETS
+        ]
+    else:
+        # Incomplete buffer, cells that are not covered stay empty
+        cells = [
+            table[data[offset] | (data[offset + 1] << 8) | (data[offset + 2] << 16)]
+            if offset + 2 < len(data) else EMPTY_CELL_JSON
+            for offset in SOURCE_OFFSETS
+        ]
+
+    return DISPLAY_JSON_PREFIX + ", ".join(cells) + DISPLAY_JSON_SUFFIX
 
 class PMDGCDUClient:
     def __init__(self, sc_mobiflight: SimConnectMobiFlight, websocket_uri: str, cdu_name: str, cdu_id: int, cdu_definition: int) -> None:
         self.sc_mobiflight: SimConnectMobiFlight = sc_mobiflight
-        self.mobiflight: MobiFlightClient = MobiFlightClient(websocket_uri)
-        self.event_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.mobiflight: MobiFlightSink = MobiFlightSink(websocket_uri, font="Boeing")
         self.cdu_definition: int = cdu_definition
         self.cdu_name: str = cdu_name
         self.cdu_id: int = cdu_id
+        self.dedup: FrameDeduplicator = FrameDeduplicator(cdu_name)
 
     def failed_to_connect(self) -> bool:
-        return self.mobiflight.retries >= self.mobiflight.max_retries
+        return self.mobiflight.gave_up()
 
     def setup_simconnect(self) -> bool:
         try:
@@ -229,21 +249,17 @@ class PMDGCDUClient:
 
     def handle_cdu_data(self, client_data: Any) -> None:
         try:
-            if client_data.dwDefineID == self.cdu_definition and hasattr(client_data, 'dwData'):                
-                int_count : int = int(CDU_COLUMNS * CDU_ROWS * CDU_CELL_BYTE_COUNT / 4)              
-                if len(client_data.dwData) >= int_count:
-                    data_list : bytearray = bytearray()                  
-                    for i in range(int_count): 
-                        my_bytes : bytes = struct.pack("I", client_data.dwData[i])
-                        data_list.extend(my_bytes)                
-                    data: bytes = bytes(data_list)                                       
-                    asyncio.run_coroutine_threadsafe(self.mobiflight.send(create_mobi_json(data)), self.event_loop)
+            if client_data.dwDefineID == self.cdu_definition and hasattr(client_data, 'dwData'):
+                trace = start_trace()
+                data: bytes = client_data_bytes(client_data, CDU_CELLS * CDU_CELL_BYTE_COUNT)
+                if self.dedup.is_new(data):
+                    trace.mark("decode")
+                    self.mobiflight.post_threadsafe(create_mobi_json(data), trace)
         except Exception as e:
             logging.error(f"Error handling CDU data: {e}")
         
 
     async def run(self) -> None:
-        self.event_loop = asyncio.get_running_loop()
         logging.info("Starting CDU client")
         
         try:
@@ -265,6 +281,7 @@ class PMDGCDUClient:
         except Exception as e:
             logging.error(f"Error: {e}")
         finally:
+            self.dedup.log_stats()
             await self.mobiflight.close()
 
 class PMDGConfiguration:
@@ -389,7 +406,7 @@ if __name__ == "__main__":
     ini_configurator = PMDGConfiguration()
     ini_configurator.verify_sdk_config()
     
-    sc_mobiflight: SimConnectMobiFlight = SimConnectMobiFlight()
+    sc_mobiflight = replay_simconnect() or SimConnectMobiFlight()
     captain_client: PMDGCDUClient = PMDGCDUClient(sc_mobiflight, CAPTAIN_CDU_URL, PMDG_CDU_0_NAME, PMDG_CDU_0_ID, PMDG_CDU_0_DEFINITION)
     co_pilot_client: PMDGCDUClient = PMDGCDUClient(sc_mobiflight, CO_PILOT_CDU_URL, PMDG_CDU_1_NAME, PMDG_CDU_1_ID, PMDG_CDU_1_DEFINITION)
     
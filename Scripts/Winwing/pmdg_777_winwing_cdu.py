@@ -5,12 +5,19 @@ import json
 import logging
 import asyncio
 import os
-import struct
-import websockets.asyncio.client as ws_client
+import sys
 from typing import Optional, List, Dict, Union, Any
 from SimConnect import SimConnect, Enum
 from SimConnect.Enum import SIMCONNECT_CLIENT_DATA_ID, SIMCONNECT_RECV_ID, SIMCONNECT_RECV_CLIENT_DATA
 
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from simconnect_client_data import client_data_bytes, record_client_data  # pylint: disable=wrong-import-position,import-error
+from simconnect_replay import replay_simconnect  # pylint: disable=wrong-import-position,import-error
+from cdu_frame_dedup import FrameDeduplicator  # pylint: disable=wrong-import-position,import-error
+from mobiflight_sink import MobiFlightSink  # pylint: disable=wrong-import-position,import-error
+from cdu_latency_metrics import start_trace  # pylint: disable=wrong-import-position,import-error
+
 
 class SimConnectMobiFlight(SimConnect):
 
@@ -39,6 +46,7 @@ class SimConnectMobiFlight(SimConnect):
     def my_dispatch_proc(self, pData, cbData, pContext):
         dwID = pData.contents.dwID
         if dwID == SIMCONNECT_RECV_ID.SIMCONNECT_RECV_ID_CLIENT_DATA:
+            record_client_data(pData, cbData)
             client_data = ctypes.cast(pData, ctypes.POINTER(SIMCONNECT_RECV_CLIENT_DATA)).contents
             for handler in self.client_data_handlers:
                 handler(client_data)
@@ -82,47 +90,6 @@ PMDG_CDU_2_ID: int = 0x4E477837
 PMDG_CDU_2_DEFINITION: int = 0x4E47783A
 
 
-class MobiFlightClient:
-    def __init__(self, websocket_uri: str, max_retries: int = 3) -> None:
-        self.websocket: Optional[ws_client.ClientConnection] = None
-        self.connected: asyncio.Event = asyncio.Event()
-        self.websocket_uri: str = websocket_uri
-        self.retries: int = 0
-        self.max_retries: int = max_retries
-
-    async def run(self) -> None:
-        while self.retries < self.max_retries:
-            try:
-                if self.websocket is None:
-                    logging.info("Connecting to MobiFlight at %s", self.websocket_uri)
-                    self.websocket = await ws_client.connect(self.websocket_uri, ping_interval=None)
-                    logging.info("MobiFlight connected at %s", self.websocket_uri)
-                    # Load font           
-                    fontName: str = "Boeing"
-                    await self.websocket.send(f'{{ "Target": "Font", "Data": "{fontName}" }}')
-                    logging.info(f"Setting font: {fontName}")
-                    await asyncio.sleep(1) # wait a second for font to be set
-                    self.connected.set()
-                await self.websocket.recv()
-            except Exception as e: 
-                self.retries += 1
-                logging.info(f"WebSocket error: {e} with retries {self.retries}")
-                self.websocket = None
-                self.connected.clear()
-            await asyncio.sleep(5)
-        logging.info("Max retries reached. Giving up connecting to MobiFlight at %s. If you only have one CDU attached, you can ignore this message.", self.websocket_uri)
-        self.connected.set()
-
-    async def send(self, data: str) -> None:
-        if self.websocket and self.connected.is_set():
-            await self.websocket.send(data)
-
-    async def close(self) -> None:
-        if self.websocket:
-            await self.websocket.close()
-            self.websocket = None
-            self.connected.clear()
-
 def create_mobi_json(data: bytes) -> str:
     message: Dict[str, Union[str, List[List[Union[str, int]]]]] = {
         "Target": "Display",
@@ -185,14 +152,14 @@ def create_mobi_json(data: bytes) -> str:
 class PMDGCDUClient:
     def __init__(self, sc_mobiflight: SimConnectMobiFlight, websocket_uri: str, cdu_name: str, cdu_id: int, cdu_definition: int) -> None:
         self.sc_mobiflight: SimConnectMobiFlight = sc_mobiflight
-        self.mobiflight: MobiFlightClient = MobiFlightClient(websocket_uri)
-        self.event_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.mobiflight: MobiFlightSink = MobiFlightSink(websocket_uri, font="Boeing")
         self.cdu_definition: int = cdu_definition
         self.cdu_name: str = cdu_name
         self.cdu_id: int = cdu_id
+        self.dedup: FrameDeduplicator = FrameDeduplicator(cdu_name)
 
     def failed_to_connect(self) -> bool:
-        return self.mobiflight.retries >= self.mobiflight.max_retries
+        return self.mobiflight.gave_up()
 
     def setup_simconnect(self) -> bool:
         try:
@@ -233,20 +200,16 @@ class PMDGCDUClient:
 
     def handle_cdu_data(self, client_data: Any) -> None:
         try:
-            if client_data.dwDefineID == self.cdu_definition and hasattr(client_data, 'dwData'):                
-                int_count : int = int(CDU_COLUMNS * CDU_ROWS * CDU_CELL_BYTE_COUNT / 4)              
-                if len(client_data.dwData) >= int_count:
-                    data_list : bytearray = bytearray()                  
-                    for i in range(int_count): 
-                        my_bytes : bytes = struct.pack("I", client_data.dwData[i])
-                        data_list.extend(my_bytes)                
-                    data: bytes = bytes(data_list)                                       
-                    asyncio.run_coroutine_threadsafe(self.mobiflight.send(create_mobi_json(data)), self.event_loop)
+            if client_data.dwDefineID == self.cdu_definition and hasattr(client_data, 'dwData'):
+                trace = start_trace()
+                data: bytes = client_data_bytes(client_data, CDU_CELLS * CDU_CELL_BYTE_COUNT)
+                if self.dedup.is_new(data):
+                    trace.mark("decode")
+                    self.mobiflight.post_threadsafe(create_mobi_json(data), trace)
         except Exception as e:
             logging.error(f"Error handling CDU data: {e}")
 
     async def run(self) -> None:
-        self.event_loop = asyncio.get_running_loop()
         logging.info("Starting CDU client")
         
         try:
@@ -266,6 +229,7 @@ class PMDGCDUClient:
         except Exception as e:
             logging.error(f"Error: {e}")
         finally:
+            self.dedup.log_stats()
             await self.mobiflight.close()
 
 class PMDGConfiguration:
@@ -390,7 +354,7 @@ if __name__ == "__main__":
     ini_configurator = PMDGConfiguration()
     ini_configurator.verify_sdk_config()
     
-    sc_mobiflight: SimConnectMobiFlight = SimConnectMobiFlight()
+    sc_mobiflight = replay_simconnect() or SimConnectMobiFlight()
     captain_client: PMDGCDUClient = PMDGCDUClient(sc_mobiflight, CAPTAIN_CDU_URL, PMDG_CDU_0_NAME, PMDG_CDU_0_ID, PMDG_CDU_0_DEFINITION)
     co_pilot_client: PMDGCDUClient = PMDGCDUClient(sc_mobiflight, CO_PILOT_CDU_URL, PMDG_CDU_1_NAME, PMDG_CDU_1_ID, PMDG_CDU_1_DEFINITION)
     observer_client: PMDGCDUClient = PMDGCDUClient(sc_mobiflight, OBSERVER_CDU_URL, PMDG_CDU_2_NAME, PMDG_CDU_2_ID, PMDG_CDU_2_DEFINITION)
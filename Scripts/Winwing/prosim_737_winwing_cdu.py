@@ -1,14 +1,22 @@
+from functools import lru_cache
 from pathlib import Path
 from typing import Callable, Optional
 import json
+import sys
 import logging
+import os
 import asyncio
-import websockets
 import xml.etree.ElementTree as ET
 import re
 from gql import Client, gql
 from gql.transport.websockets import WebsocketsTransport
 
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mobiflight_sink import MobiFlightSink  # pylint: disable=wrong-import-position,import-error
+from cdu_latency_metrics import NULL_TRACE, FrameTrace, start_trace  # pylint: disable=wrong-import-position,import-error
+from cdu_feed_recording import GRAPHQL_CHANNEL, ReplayGraphQLSession, feed_recorder, feed_replay  # pylint: disable=wrong-import-position,import-error
+
 # Connection settings for ProSim GraphQL
 GRAPHQL_URL = "ws://localhost:5000/graphql"
 
@@ -20,47 +28,6 @@ CO_PILOT_CDU_URL: str = "ws://localhost:8320/winwing/cdu-co-pilot"
 CDU_COLUMNS: int = 24
 CDU_ROWS: int = 14
 
-class MobiFlightClient:
-    def __init__(self, websocket_uri: str, max_retries: int = 3) -> None:
-        self.websocket: Optional[websockets.ClientConnection] = None
-        self.connected: asyncio.Event = asyncio.Event()
-        self.websocket_uri: str = websocket_uri
-        self.retries: int = 0
-        self.max_retries: int = max_retries
-
-    async def run(self) -> None:
-        while self.retries < self.max_retries:
-            try:
-                if self.websocket is None:
-                    logging.info("Connecting to MobiFlight at %s", self.websocket_uri)
-                    self.websocket = await websockets.connect(self.websocket_uri, ping_interval=None)
-                    logging.info("MobiFlight connected")
-                    # Load font           
-                    fontName: str = "Boeing"
-                    await self.websocket.send(f'{{ "Target": "Font", "Data": "{fontName}" }}')
-                    logging.info(f"Setting font: {fontName}")
-                    await asyncio.sleep(1) # wait a second for font to be set
-                    self.connected.set()
-                await self.websocket.recv()
-            except Exception as e: 
-                self.retries += 1
-                logging.error(f"WebSocket error: {e} with retries {self.retries}")
-                self.websocket = None
-                self.connected.clear()
-            await asyncio.sleep(5)
-        logging.error("Max retries reached. Giving up connecting to MobiFlight at %s", self.websocket_uri)
-        self.connected.set()
-
-    async def send(self, data: str) -> None:
-        if self.websocket and self.connected.is_set():
-            await self.websocket.send(data)
-
-    async def close(self) -> None:
-        if self.websocket:
-            await self.websocket.close()
-            self.websocket = None
-            self.connected.clear()
-
 def add_empty_row(data_array):
     """Add an empty row of 24 columns to the data array"""
     for _ in range(CDU_COLUMNS):
@@ -93,25 +60,106 @@ DEFAULT_COLOR = 'w'  # White
 DEFAULT_SIZE = 0     # Large text
 DEFAULT_ALIGN = 'l'  # Left alignment
 
-def get_visible_length(text):
+# Characters replaced in <line> texts, an empty tag "[]" is shown as empty box as well
+LINE_SUBSTITUTES = {
+    '#': '\u2610',  # Empty box
+    '`': '\u00B0',  # Degree symbol
+}
+EMPTY_BOX = '\u2610'
+
+# Tokens of the ProSim markup: a complete [tag], an unterminated tag running to the end, or a run of plain characters
+CDU_TOKEN_REGEX = re.compile(r'\[([^\]]*)\]|\[(.*)|([^\[]+)', re.DOTALL)
+
+# Distinct <line> texts kept rendered, ProSim resends all lines of a page on every change
+LINE_CACHE_SIZE = 1024
+
+EMPTY_ROW = tuple([] for _ in range(CDU_COLUMNS))
+
+def apply_format_tag(tag, state, format_stack, default_state):
     """
-    Calculate the visible length of text after removing formatting tags
+    Apply a formatting tag to the current format
     
     Args:
-        text: Text that may contain formatting tags
+        tag: The text between the brackets, only its first character is significant
+        state: The current (color, size, alignment)
+        format_stack: Formats saved by the opening tags so far
+        default_state: The format to fall back to if an end tag has no matching start tag
         
     Returns:
-        int: The number of visible characters
+        The (color, size, alignment) after the tag
     """
-    # Remove format tags by pattern
-    # Match [anything] including [/anything]
-    pattern = r'\[[^\]]*\]'
-    clean_text = re.sub(pattern, '', text)
-    return len(clean_text)
+    code = tag[:1]
+    if code == '/':
+        # End tag - pop format from stack if available, revert to defaults otherwise
+        return format_stack.pop() if format_stack else default_state
+    if code == 's':  # Small text
+        format_stack.append(state)
+        return (state[0], 1, state[2])
+    if code == 'm':  # Centered text
+        format_stack.append(state)
+        return (state[0], state[1], 'm')
+    if code in COLOR_CODES:  # Color code
+        format_stack.append(state)
+        return (COLOR_CODES[code], state[1], state[2])
+    return state
+
+def format_cdu_text(text, default_state, substitute=False):
+    """
+    Convert text with formatting tags to display cells in a single pass
+    
+    Args:
+        text: The text to process
+        default_state: The default (color, size, alignment)
+        substitute: Replace the special characters used in <line> texts
+        
+    Returns:
+        tuple: The cells, the number of visible characters (text outside of complete tags)
+               and the alignment in effect at the end of the text
+    """
+    cells = []
+    visible_length = 0
+    state = default_state
+    format_stack = []
+
+    for match in CDU_TOKEN_REGEX.finditer(text):
+        chars = match.group(3)
+        if chars is not None:
+            color, size = state[0], state[1]
+            if substitute:
+                cells.extend([] if c == ' ' else [LINE_SUBSTITUTES.get(c, c), color, size] for c in chars)
+            else:
+                cells.extend([] if c == ' ' else [c, color, size] for c in chars)
+            visible_length += len(chars)
+        elif match.group(1) is not None:
+            tag = match.group(1)
+            if substitute and not tag:
+                cells.append([EMPTY_BOX, state[0], state[1]])
+                visible_length += 1
+            else:
+                state = apply_format_tag(tag, state, format_stack, default_state)
+        else:
+            # Unterminated tag, the rest of the text is skipped but counts as visible
+            state = apply_format_tag(match.group(2), state, format_stack, default_state)
+            visible_length += len(match.group(0))
+
+    return cells, visible_length, state[2]
+
+def append_cells(row_data, cells, alignment):
+    """Append cells to a row, centering them first if the text ended with centered alignment"""
+    if alignment == 'm' and cells:
+        # Calculate visible text length (excluding empty slots)
+        visible_length = sum(1 for item in cells if item)
+        
+        # Add padding at the beginning of the row
+        padding = max(0, (CDU_COLUMNS - visible_length) // 2)
+        row_data.extend([] for _ in range(padding))
+    
+    row_data.extend(cells)
+    return row_data
 
-def process_text_with_format(text, row_data, default_format, default_size, default_alignment=DEFAULT_ALIGN):
+def process_text_with_format(text, row_data, default_format, default_size, default_alignment=DEFAULT_ALIGN, substitute=False):
     """
-    Process text with formatting tags using a fast direct approach
+    Process text with formatting tags and append it to a row
     
     Args:
         text: The text to process
@@ -119,88 +167,56 @@ def process_text_with_format(text, row_data, default_format, default_size, defau
         default_format: The default color format to use ('w' for white)
         default_size: The default size to use (0 for large, 1 for small)
         default_alignment: The default alignment to use ('l' for left, 'm' for middle/center)
+        substitute: Replace the special characters used in <line> texts
         
     Returns:
         The row_data array with formatted text elements added
     """
-    # Create a new row data array to work with
-    local_row_data = []
-    
-    # Current state
-    color = default_format
-    size = default_size
-    alignment = default_alignment  # Track text alignment (l=left, m=middle/center)
+    cells, _, alignment = format_cdu_text(text, (default_format, default_size, default_alignment), substitute)
+    return append_cells(row_data, cells, alignment)
+
+@lru_cache(maxsize=LINE_CACHE_SIZE)
+def render_line(line_text):
+    """
+    Convert the text of a <line> element to the 24 cells of a display row
     
-    # Simple format stack for nested formats (color, size, alignment)
-    format_stack = []
+    Results are cached per distinct line text and shared between frames, they must not be modified.
     
-    i = 0
-
-    while i < len(text):
-        if text[i] == '[':
-            # Move to the character after the opening bracket
-            i += 1
-            if i < len(text):
-                if text[i] == '/':
-                    # End tag - pop format from stack if available
-                    if format_stack:
-                        color, size, alignment = format_stack.pop()
-                    else:
-                        # No matching start tag, revert to defaults
-                        color = default_format
-                        size = default_size
-                        alignment = default_alignment
-                elif text[i] == 's':  # Small text
-                    # Push current format to stack
-                    format_stack.append((color, size, alignment))
-                    size = 1
-                elif text[i] == 'm':  # Centered text
-                    # Push current format to stack
-                    format_stack.append((color, size, alignment))
-                    alignment = 'm'
-                elif text[i] in COLOR_CODES:  # Color code
-                    # Push current format to stack
-                    format_stack.append((color, size, alignment))
-                    color = COLOR_CODES[text[i]]
-                
-                # Find and skip to after the closing bracket
-                while i < len(text) and text[i] != ']':
-                    i += 1
-            
-            # Move past the closing bracket
-            i += 1
-            continue
-        
-        # Process special characters
-        if i < len(text):
-            if text[i] == ' ':
-                # Space
-                local_row_data.append([])
-            else:
-                # Regular character
-                local_row_data.append([text[i], color, size])
+    Args:
+        line_text: The text of the <line> element, "¨" for an empty line
         
-        i += 1
+    Returns:
+        tuple: Exactly 24 cells
+    """
+    # If just a delimiter or empty, create an empty row
+    if line_text == "¨" or not line_text:
+        return EMPTY_ROW
     
-    # Handle centered text by adding appropriate padding
-    if alignment == 'm' and local_row_data:
-        # Calculate visible text length (excluding empty slots)
-        visible_length = sum(1 for item in local_row_data if item)
-        
-        # Calculate padding needed at the beginning
-        padding = max(0, (CDU_COLUMNS - visible_length) // 2)
+    # Process line with potential left and right parts
+    parts = line_text.split("¨")
+    row_data = []
+    
+    # Check if the whole line should be centered (has [m] tag at the beginning)
+    if parts[0].strip().startswith('[m]'):
+        # Process the entire line as centered text without splitting
+        process_text_with_format(line_text.replace('¨', ' '), row_data, 'w', 0, 'm', substitute=True)
+    else:
+        # Process left part
+        if parts[0]:
+            process_text_with_format(parts[0], row_data, 'w', 0, 'l', substitute=True)
         
-        # Add padding at the beginning of the row
-        if padding > 0:
-            padding_elements = [[] for _ in range(padding)]
-            # Add existing row data for proper appending
-            final_data = padding_elements + local_row_data
-            row_data.extend(final_data)
-            return row_data
+        # Process right part if exists, it ends at the last column
+        if len(parts) > 1:
+            cells, visible_length, alignment = format_cdu_text(parts[1], ('w', 0, 'l'), substitute=True)
+            pad_to_position(row_data, CDU_COLUMNS - visible_length)
+            append_cells(row_data, cells, alignment)
     
-    # For non-centered text, just append to the row_data
-    row_data.extend(local_row_data)
-    return row_data
+    pad_to_position(row_data, CDU_COLUMNS)
+    return tuple(row_data[:CDU_COLUMNS])
+
+def log_line_cache_stats():
+    info = render_line.cache_info()  # pylint: disable=no-value-for-parameter
+    logging.info("Line cache: %s hits, %s misses, %s/%s entries", info.hits, info.misses, info.currsize, info.maxsize)
 
 def create_mobi_json(xml_string):
     """
@@ -241,8 +257,8 @@ def create_mobi_json(xml_string):
                 # Calculate available width (total width minus title page width)
                 available_width = CDU_COLUMNS - len(title_page)
                 
-                # Calculate the visible length of the title (without formatting tags)
-                visible_title_length = get_visible_length(title_to_center)
+                # Format the title and get its visible length (without formatting tags) in one go
+                cells, visible_title_length, alignment = format_cdu_text(title_to_center, ('w', 0, 'l'))
                 
                 # Calculate centering padding
                 padding = max(0, (available_width - visible_title_length) // 2)
@@ -252,7 +268,7 @@ def create_mobi_json(xml_string):
                     row_data.append([])
                 
                 # Now add the actual title text
-                process_text_with_format(title_to_center, row_data, 'w', 0, 'l')
+                append_cells(row_data, cells, alignment)
             
             # Title page (right-aligned)
             pad_to_position(row_data, CDU_COLUMNS - len(title_page))
@@ -262,45 +278,9 @@ def create_mobi_json(xml_string):
             add_row_to_message(row_data, message["Data"])
             row_count += 1
         
-        # Process normal lines
+        # Process normal lines, each distinct line text is rendered only once
         for line_elem in root.findall('line'):
-            line_text = line_elem.text or "¨"
-            line_text = line_text.replace('#', '\u2610')  # Replace empty box with Unicode character
-            line_text = line_text.replace('[]', '\u2610')  # Replace empty box with Unicode character
-            line_text = line_text.replace('`', '\u00B0')  # Replace unicode for degree symbol
-
-            
-            # If just a delimiter or empty, create an empty row
-            if line_text == "¨" or not line_text:
-                add_empty_row(message["Data"])
-                row_count += 1
-                continue
-            
-            # Process line with potential left and right parts
-            parts = line_text.split("¨")
-            row_data = []
-            
-            # Check if the whole line should be centered (has [m] tag at the beginning)
-            if parts[0].strip().startswith('[m]'):
-                # Process the entire line as centered text without splitting
-                full_line = line_text.replace('¨', ' ')  # Replace delimiter with space
-                process_text_with_format(full_line, row_data, 'w', 0, 'm')
-                add_row_to_message(row_data, message["Data"])
-                row_count += 1
-                continue
-            
-            # Process left part (if not a centered line)
-            if parts[0]:
-                process_text_with_format(parts[0], row_data, 'w', 0, 'l')
-            
-            # Process right part if exists
-            if len(parts) > 1:
-                # Calculate where to start the right part using the visible length
-                right_part_visible_length = get_visible_length(parts[1])
-                pad_to_position(row_data, CDU_COLUMNS - right_part_visible_length)
-                process_text_with_format(parts[1], row_data, 'w', 0, 'l')
-            
-            add_row_to_message(row_data, message["Data"])
+            message["Data"].extend(render_line(line_elem.text or "¨"))
             row_count += 1
         
         # Process scratchpad (last row)
@@ -342,8 +322,12 @@ class ProSimGraphQLClient:
             bool: True if connection was successful, False otherwise
         """
         try:
-            logging.info(f"Connecting to ProSim GraphQL at {GRAPHQL_URL}")
-            self.session = await self.client.connect_async(reconnecting=True)
+            replay = feed_replay()
+            if replay is not None:
+                self.session = ReplayGraphQLSession(replay)
+            else:
+                logging.info(f"Connecting to ProSim GraphQL at {GRAPHQL_URL}")
+                self.session = await self.client.connect_async(reconnecting=True)
             self.connected = True
             logging.info("Successfully connected to ProSim GraphQL")
             return True
@@ -368,7 +352,7 @@ class ProSimGraphQLClient:
             logging.error(f"Error disconnecting from ProSim GraphQL: {e}")
             return False
 
-    async def subscribe_to_datarefs(self, dataref_names: list[str], callback: Callable[[str, str], None]) -> None:
+    async def subscribe_to_datarefs(self, dataref_names: list[str], callback: Callable[[str, str, FrameTrace], None]) -> None:
         """
         Subscribe to ProSim datarefs using GraphQL subscription
         
@@ -391,12 +375,15 @@ class ProSimGraphQLClient:
             """
         )
         params = {"names": dataref_names}
+        recorder = feed_recorder()
 
         try:
             async for result in self.session.subscribe(subscription, variable_values=params, operation_name="OnDataRefChanged"):
                 if "dataRefs" in result:
+                    trace = start_trace()
+                    recorder.record(GRAPHQL_CHANNEL, json.dumps(result))
                     # Create a task for the callback to handle it asynchronously
-                    task = asyncio.create_task(callback(result["dataRefs"]["name"], result["dataRefs"]["value"]))
+                    task = asyncio.create_task(callback(result["dataRefs"]["name"], result["dataRefs"]["value"], trace))
                     # Add task to the set of tracked tasks
                     self._callback_tasks.add(task)
                     # Remove task from set when done
@@ -422,7 +409,7 @@ class ProSimCDUClient:
             cdu_dataref_name: The dataref name for this CDU's display data
         """
         self.prosim_client = prosim_client
-        self.mobiflight = MobiFlightClient(websocket_uri)
+        self.mobiflight = MobiFlightSink(websocket_uri, font="Boeing")
         self.event_loop = None
         self.cdu_name = cdu_name
         self.cdu_dataref_name = cdu_dataref_name
@@ -432,7 +419,7 @@ class ProSimCDUClient:
 
     def failed_to_connect(self) -> bool:
         """Check if MobiFlight client failed to connect after max retries"""
-        return self.mobiflight.retries >= self.mobiflight.max_retries
+        return self.mobiflight.gave_up()
 
     async def setup_prosim(self) -> bool:
         """
@@ -453,18 +440,19 @@ class ProSimCDUClient:
             logging.error(f"ProSim GraphQL setup failed for {self.cdu_name}: {e}")
             return False
 
-    async def handle_dataref_update(self, dataref_name: str, value: str) -> None:
+    async def handle_dataref_update(self, dataref_name: str, value: str, trace: FrameTrace = NULL_TRACE) -> None:
         """
         Handle dataref updates from ProSim GraphQL
         
         Args:
             dataref_name: Name of the dataref that was updated
             value: New value of the dataref
+            trace: Latency trace started when the update was received
         """
         if dataref_name == self.cdu_dataref_name and value != self.last_cdu_data:
             try:
                 json_data = create_mobi_json(value)
-                await self.mobiflight.send(json_data)
+                self.mobiflight.post(json_data, trace)
                 self.last_cdu_data = value
             except Exception as e:
                 logging.error(f"Error processing CDU data for {self.cdu_name}: {e}")
@@ -560,4 +548,5 @@ if __name__ == "__main__":
         # Clean up resources
         asyncio.run(cleanup(prosim_client if 'prosim_client' in locals() else None))
         
+        log_line_cache_stats()
         logging.info("Application terminated")
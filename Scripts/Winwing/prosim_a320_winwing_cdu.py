@@ -1,13 +1,20 @@
 from pathlib import Path
 from typing import Callable, Optional
 import json
+import sys
 import logging
+import os
 import asyncio
-import websockets
 import xml.etree.ElementTree as ET
 from gql import Client, gql
 from gql.transport.websockets import WebsocketsTransport
 
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mobiflight_sink import MobiFlightSink  # pylint: disable=wrong-import-position,import-error
+from cdu_latency_metrics import NULL_TRACE, FrameTrace, start_trace  # pylint: disable=wrong-import-position,import-error
+from cdu_feed_recording import GRAPHQL_CHANNEL, ReplayGraphQLSession, feed_recorder, feed_replay  # pylint: disable=wrong-import-position,import-error
+
 # Connection settings for ProSim GraphQL
 GRAPHQL_URL = "ws://localhost:5000/graphql"
 
@@ -29,47 +36,6 @@ CO_PILOT_CDU_URL: str = "ws://localhost:8320/winwing/cdu-co-pilot"
 CDU_COLUMNS: int = 24
 CDU_ROWS: int = 14
 
-class MobiFlightClient:
-    def __init__(self, websocket_uri: str, max_retries: int = 3) -> None:
-        self.websocket: Optional[websockets.ClientConnection] = None
-        self.connected: asyncio.Event = asyncio.Event()
-        self.websocket_uri: str = websocket_uri
-        self.retries: int = 0
-        self.max_retries: int = max_retries
-
-    async def run(self) -> None:
-        while self.retries < self.max_retries:
-            try:
-                if self.websocket is None:
-                    logging.info("Connecting to MobiFlight at %s", self.websocket_uri)
-                    self.websocket = await websockets.connect(self.websocket_uri, ping_interval=None)
-                    logging.info("MobiFlight connected")
-                    # Load font           
-                    fontName: str = "AirbusThales"
-                    await self.websocket.send(f'{{ "Target": "Font", "Data": "{fontName}" }}')
-                    logging.info(f"Setting font: {fontName}")
-                    await asyncio.sleep(1) # wait a second for font to be set
-                    self.connected.set()
-                await self.websocket.recv()
-            except Exception as e: 
-                self.retries += 1
-                logging.error(f"WebSocket error: {e} with retries {self.retries}")
-                self.websocket = None
-                self.connected.clear()
-            await asyncio.sleep(5)
-        logging.error("Max retries reached. Giving up connecting to MobiFlight at %s", self.websocket_uri)
-        self.connected.set()
-
-    async def send(self, data: str) -> None:
-        if self.websocket and self.connected.is_set():
-            await self.websocket.send(data)
-
-    async def close(self) -> None:
-        if self.websocket:
-            await self.websocket.close()
-            self.websocket = None
-            self.connected.clear()
-
 def create_mobi_json(xml_string):
     message =  {}
     message["Target"] = "Display"
@@ -123,8 +89,12 @@ class ProSimGraphQLClient:
             bool: True if connection was successful, False otherwise
         """
         try:
-            logging.info(f"Connecting to ProSim GraphQL at {GRAPHQL_URL}")
-            self.session = await self.client.connect_async(reconnecting=True)
+            replay = feed_replay()
+            if replay is not None:
+                self.session = ReplayGraphQLSession(replay)
+            else:
+                logging.info(f"Connecting to ProSim GraphQL at {GRAPHQL_URL}")
+                self.session = await self.client.connect_async(reconnecting=True)
             self.connected = True
             logging.info("Successfully connected to ProSim GraphQL")
             return True
@@ -149,7 +119,7 @@ class ProSimGraphQLClient:
             logging.error(f"Error disconnecting from ProSim GraphQL: {e}")
             return False
 
-    async def subscribe_to_datarefs(self, dataref_names: list[str], callback: Callable[[str, str], None]) -> None:
+    async def subscribe_to_datarefs(self, dataref_names: list[str], callback: Callable[[str, str, FrameTrace], None]) -> None:
         """
         Subscribe to ProSim datarefs using GraphQL subscription
         
@@ -172,12 +142,15 @@ class ProSimGraphQLClient:
             """
         )
         params = {"names": dataref_names}
+        recorder = feed_recorder()
 
         try:
             async for result in self.session.subscribe(subscription, variable_values=params, operation_name="OnDataRefChanged"):
                 if "dataRefs" in result:
+                    trace = start_trace()
+                    recorder.record(GRAPHQL_CHANNEL, json.dumps(result))
                     # Create a task for the callback to handle it asynchronously
-                    task = asyncio.create_task(callback(result["dataRefs"]["name"], result["dataRefs"]["value"]))
+                    task = asyncio.create_task(callback(result["dataRefs"]["name"], result["dataRefs"]["value"], trace))
                     # Add task to the set of tracked tasks
                     self._callback_tasks.add(task)
                     # Remove task from set when done
@@ -189,7 +162,7 @@ class ProSimGraphQLClient:
 class ProSimCDUClient:
     def __init__(self, prosim_client: ProSimGraphQLClient, websocket_uri: str, cdu_name: str, cdu_dataref_name: str) -> None:
         self.prosim_client: ProSimGraphQLClient = prosim_client
-        self.mobiflight: MobiFlightClient = MobiFlightClient(websocket_uri)
+        self.mobiflight: MobiFlightSink = MobiFlightSink(websocket_uri, font="AirbusThales")
         self.event_loop: Optional[asyncio.AbstractEventLoop] = None
         self.cdu_name: str = cdu_name
         self.cdu_dataref_name: str = cdu_dataref_name
@@ -197,7 +170,7 @@ class ProSimCDUClient:
         self._callback_tasks = set()  # Keep track of callback tasks
 
     def failed_to_connect(self) -> bool:
-        return self.mobiflight.retries >= self.mobiflight.max_retries
+        return self.mobiflight.gave_up()
 
     async def setup_prosim(self) -> bool:
         try:
@@ -211,18 +184,19 @@ class ProSimCDUClient:
             logging.error(f"ProSim GraphQL setup failed for {self.cdu_name}: {e}")
             return False
 
-    async def handle_dataref_update(self, dataref_name: str, value: str) -> None:
+    async def handle_dataref_update(self, dataref_name: str, value: str, trace: FrameTrace = NULL_TRACE) -> None:
         """
         Handle dataref updates from ProSim GraphQL
         
         Args:
             dataref_name: Name of the dataref that was updated
             value: New value of the dataref
+            trace: Latency trace started when the update was received
         """
         if dataref_name == self.cdu_dataref_name and value != self.last_cdu_data:
             try:
                 json_data = create_mobi_json(value)
-                await self.mobiflight.send(json_data)
+                self.mobiflight.post(json_data, trace)
                 self.last_cdu_data = value
             except Exception as e:
                 logging.error(f"Error processing CDU data for {self.cdu_name}: {e}")
@@ -19,12 +19,21 @@ MD80 CDU Characteristics:
 import asyncio
 import json
 import logging
-import urllib.request
+import os
+import sys
 import websockets
 from enum import StrEnum
 from typing import List, Dict
 import base64
 
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mobiflight_sink import MobiFlightSink, discover_endpoints  # pylint: disable=wrong-import-position,import-error
+from xplane_dataref_cache import load_dataref_mapping  # pylint: disable=wrong-import-position,import-error
+from state_mailbox import StateMailbox  # pylint: disable=wrong-import-position,import-error
+from cdu_latency_metrics import start_trace  # pylint: disable=wrong-import-position,import-error
+from cdu_feed_recording import XPLANE_CHANNEL, XPLANE_DATAREFS_CHANNEL, connect_websocket, feed_recorder  # pylint: disable=wrong-import-position,import-error
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -37,7 +46,7 @@ VIRTUAL_CDU_WIDTH = 30  # MD80 virtual CDU width in X-Plane
 # WebSocket Configuration
 WEBSOCKET_HOST = "localhost"
 WEBSOCKET_PORT = 8320
-BASE_REST_URL = "http://localhost:8086/api/v2/datarefs"
+BASE_API_URL = "http://localhost:8086/api"
 BASE_WEBSOCKET_URI = f"ws://{WEBSOCKET_HOST}:8086/api/v2"
 
 # MobiFlight WebSocket endpoint for the single MD80 MCDU
@@ -76,31 +85,33 @@ def get_char(char: str) -> str:
     return CHAR_MAP.get(char, char)
 
 
-def fetch_dataref_ids(device: CduDevice) -> Dict[int, str]:
+def select_line_datarefs(device: CduDevice, datarefs: List[dict]) -> Dict[int, str]:
+    """Selects the CDU line datarefs from the full X-Plane dataref list"""
+    line_datarefs = set(device.get_line_datarefs())
+    dataref_map = {}
+    for dataref_entry in datarefs:
+        dataref_name = str(dataref_entry.get("name", ""))
+        if dataref_name in line_datarefs:
+            dataref_map[int(dataref_entry.get("id", 0))] = dataref_name
+    return dataref_map
+
+
+async def fetch_dataref_ids(device: CduDevice) -> Dict[int, str]:
     """
-    Fetch dataref IDs from X-Plane for the CDU lines
+    Fetch dataref IDs from X-Plane for the CDU lines, reusing the cached IDs while they are valid
     Returns a mapping of dataref ID to dataref name
     """
     try:
-        with urllib.request.urlopen(BASE_REST_URL, timeout=5) as response:
-            response_json = json.load(response)
-            
-            dataref_map = {}
-            line_datarefs = device.get_line_datarefs()
-            
-            for dataref_entry in response_json.get("data", []):
-                dataref_name = str(dataref_entry.get("name", ""))
-                dataref_id = int(dataref_entry.get("id", 0))
-                
-                # Check if this dataref is one of our CDU lines
-                if dataref_name in line_datarefs:
-                    dataref_map[dataref_id] = dataref_name
-                    logging.info(f"Found dataref: {dataref_name} with ID {dataref_id}")
-            
-            if not dataref_map:
-                logging.warning("No CDU datarefs found! Check the dataref paths.")
-            
-            return dataref_map
+        dataref_map = await load_dataref_mapping(
+            f"rotate_md80/{device}", lambda datarefs: select_line_datarefs(device, datarefs), BASE_API_URL
+        )
+        for dataref_id, dataref_name in dataref_map.items():
+            logging.info(f"Found dataref: {dataref_name} with ID {dataref_id}")
+
+        if not dataref_map:
+            logging.warning("No CDU datarefs found! Check the dataref paths.")
+
+        return dataref_map
     except Exception as e:
         logging.error(f"Error fetching dataref mapping: {e}")
         return {}
@@ -170,52 +181,49 @@ def generate_display_json(cdu_lines: List[str]) -> str:
     return json.dumps({"Target": "Display", "Data": display_data})
 
 
-async def handle_device_update(queue: asyncio.Queue, device: CduDevice):
+async def handle_device_update(mailbox: StateMailbox, device: CduDevice, sink: MobiFlightSink):
     """
     Handles sending display updates to MobiFlight
-    Reads from the queue and sends formatted data to the CDU hardware
+    Takes the newest CDU lines from the mailbox and sends formatted data to the CDU hardware
     """
     last_run_time = 0
     rate_limit_time = 0.1  # Rate limiting to prevent overwhelming the connection
     
-    endpoint = device.get_endpoint()
-    logging.info(f"Connecting to MobiFlight CDU at {endpoint}")
-    
-    async for websocket in websockets.connect(endpoint):
-        logging.info("Successfully connected to MobiFlight CDU")
+    # The sink reconnects on its own and redelivers the latest display after a reconnect
+    sink_task = asyncio.create_task(sink.run())
+    try:
         while True:
-            try:
-                cdu_lines = await queue.get()
-                
-                # Rate limiting
-                elapsed = asyncio.get_event_loop().time() - last_run_time
-                if elapsed < rate_limit_time:
-                    await asyncio.sleep(rate_limit_time - elapsed)
-                
-                # Generate and send display data
-                display_json = generate_display_json(cdu_lines)
-                await websocket.send(display_json)
-                last_run_time = asyncio.get_event_loop().time()
-                
-            except websockets.exceptions.ConnectionClosed:
-                logging.error("MobiFlight connection lost. Attempting to reconnect...")
-                await queue.put(cdu_lines)  # Put data back in queue
-                break
-            except Exception as e:
-                logging.error(f"Error sending to MobiFlight: {e}")
+            await mailbox.wait()
 
+            # Rate limiting
+            elapsed = asyncio.get_event_loop().time() - last_run_time
+            if elapsed < rate_limit_time:
+                await asyncio.sleep(rate_limit_time - elapsed)
+
+            # States that arrived during the rate limit supersede the one that woke us up
+            cdu_lines, trace = mailbox.get_traced_nowait()
+
+            # Generate and send display data
+            display_json = generate_display_json(cdu_lines)
+            sink.post(display_json, trace)
+            last_run_time = asyncio.get_event_loop().time()
+    finally:
+        sink_task.cancel()
+        mailbox.log_stats()
+        await sink.close()
 
-async def handle_dataref_updates(queue: asyncio.Queue, device: CduDevice):
+
+async def handle_dataref_updates(mailbox: StateMailbox, device: CduDevice):
     """
     Handles receiving dataref updates from X-Plane
-    Subscribes to CDU line datarefs and pushes updates to the queue
+    Subscribes to CDU line datarefs and hands the current lines to the mailbox
     """
     # Initialize lines with empty strings
     current_cdu_lines = [''] * CDU_ROWS
     last_sent_lines = None
     
     # Get dataref mapping
-    dataref_map = fetch_dataref_ids(device)
+    dataref_map = await fetch_dataref_ids(device)
     if not dataref_map:
         logging.error("No datarefs found. Exiting dataref handler.")
         return
@@ -223,7 +231,8 @@ async def handle_dataref_updates(queue: asyncio.Queue, device: CduDevice):
     logging.info(f"Monitoring {len(dataref_map)} CDU line datarefs")
     logging.info("Connecting to X-Plane WebSocket server")
     
-    async for websocket in websockets.connect(BASE_WEBSOCKET_URI):
+    recorder = feed_recorder()
+    async for websocket in connect_websocket(BASE_WEBSOCKET_URI, XPLANE_CHANNEL):
         logging.info("Successfully connected to X-Plane WebSocket server")
         try:
             # Subscribe to all CDU line datarefs
@@ -236,9 +245,13 @@ async def handle_dataref_updates(queue: asyncio.Queue, device: CduDevice):
             })
             await websocket.send(subscribe_msg)
             logging.info(f"Subscribed to {len(dataref_map)} datarefs")
+            # The IDs are only valid within the X-Plane session, a replay needs their names
+            recorder.record(XPLANE_DATAREFS_CHANNEL, json.dumps([{"id": i, "name": name} for i, name in dataref_map.items()]))
             
             while True:
                 message = await websocket.recv()
+                trace = start_trace()
+                recorder.record(XPLANE_CHANNEL, message)
                 data = json.loads(message)
                 
                 if "data" not in data:
@@ -277,7 +290,8 @@ async def handle_dataref_updates(queue: asyncio.Queue, device: CduDevice):
                 # Only send update if display has changed
                 if current_cdu_lines != last_sent_lines:
                     last_sent_lines = current_cdu_lines.copy()
-                    await queue.put(current_cdu_lines.copy())
+                    trace.mark("decode")
+                    mailbox.put(current_cdu_lines.copy(), trace)
                     
         except websockets.exceptions.ConnectionClosed:
             logging.error("X-Plane WebSocket connection lost. Attempting to reconnect...")
@@ -287,18 +301,6 @@ async def handle_dataref_updates(queue: asyncio.Queue, device: CduDevice):
             await asyncio.sleep(5)  # Wait before retry
 
 
-async def check_device_availability(device: CduDevice) -> bool:
-    """Check if the MobiFlight CDU device is available"""
-    try:
-        endpoint = device.get_endpoint()
-        async with websockets.connect(endpoint) as ws:
-            logging.info(f"CDU device available at {endpoint}")
-            return True
-    except Exception as e:
-        logging.warning(f"CDU device not available at {device.get_endpoint()}: {e}")
-        return False
-
-
 async def main():
     """Main entry point for the MD80 MCDU integration"""
     logging.info("Starting MD80 MCDU MobiFlight Integration")
@@ -306,17 +308,18 @@ async def main():
     # Check if device is available
     device = CduDevice.MD80_MCDU
     
-    if not await check_device_availability(device):
+    sinks = await discover_endpoints({device: device.get_endpoint()})
+    if device not in sinks:
         logging.error("MobiFlight CDU device not available. Please check MobiFlight is running.")
         return
     
-    # Create communication queue
-    queue = asyncio.Queue()
+    # Only the newest CDU lines are kept for the display
+    mailbox = StateMailbox(f"{device} lines")
     
     # Start handler tasks
     tasks = [
-        asyncio.create_task(handle_dataref_updates(queue, device)),
-        asyncio.create_task(handle_device_update(queue, device))
+        asyncio.create_task(handle_dataref_updates(mailbox, device)),
+        asyncio.create_task(handle_device_update(mailbox, device, sinks[device]))
     ]
     
     logging.info("MD80 MCDU integration started successfully")
@@ -0,0 +1,62 @@
+"""
+Shared helpers for reading SimConnect client data areas in the WinWing CDU scripts
+
+SimConnect delivers client data as SIMCONNECT_RECV_CLIENT_DATA, where `dwData` is declared by the
+Python SimConnect wrapper as a fixed DWORD array. Rebuilding the payload from that array one uint32 at a time
+(`struct.pack("I", ...)` per element) costs several hundred Python operations per frame, and it runs on the
+SimConnect dispatch thread at visual-frame rate.
+
+The helpers below access the payload directly at the address of `dwData`:
+- client_data_bytes() copies the requested number of bytes with a single memcpy (ctypes.string_at)
+- client_data_view() returns a zero-copy memoryview over the same memory
+
+The memory behind a SIMCONNECT_RECV_CLIENT_DATA belongs to SimConnect and is only valid while the dispatch
+callback is running. A memoryview must therefore never be kept or handed over to another thread,
+use client_data_bytes() for anything that outlives the callback.
+
+record_client_data() appends the received structure as it is to the feed recording (see cdu_feed_recording.py)
+if recording is enabled, simconnect_replay.py delivers it again.
+"""
+
+import ctypes
+from typing import Any
+
+from SimConnect.Enum import SIMCONNECT_RECV_CLIENT_DATA
+
+from cdu_feed_recording import feed_recorder  # pylint: disable=import-error
+
+# Offset of the payload within the received structure
+CLIENT_DATA_OFFSET: int = SIMCONNECT_RECV_CLIENT_DATA.dwData.offset
+# Upper bound of the payload size as declared by the SimConnect wrapper
+CLIENT_DATA_MAX_SIZE: int = SIMCONNECT_RECV_CLIENT_DATA.dwData.size
+# Channel of the recorded client data
+CLIENT_DATA_CHANNEL: str = "simconnect/client_data"
+
+
+def client_data_address(client_data: Any) -> int:
+    """Returns the memory address of the first payload byte of a SIMCONNECT_RECV_CLIENT_DATA."""
+    return ctypes.addressof(client_data) + CLIENT_DATA_OFFSET
+
+
+def client_data_bytes(client_data: Any, size: int) -> bytes:
+    """Copies the first `size` bytes of the client data payload in one operation."""
+    if not 0 <= size <= CLIENT_DATA_MAX_SIZE:
+        raise ValueError(f"Invalid client data size {size}, expected 0..{CLIENT_DATA_MAX_SIZE}")
+    return ctypes.string_at(client_data_address(client_data), size)
+
+
+def client_data_view(client_data: Any, size: int) -> memoryview:
+    """
+    Returns a zero-copy view on the first `size` bytes of the client data payload.
+    Only valid for the duration of the dispatch callback, see module docstring.
+    """
+    if not 0 <= size <= CLIENT_DATA_MAX_SIZE:
+        raise ValueError(f"Invalid client data size {size}, expected 0..{CLIENT_DATA_MAX_SIZE}")
+    return memoryview((ctypes.c_ubyte * size).from_address(client_data_address(client_data))).cast("B")
+
+
+def record_client_data(received: Any, size: int) -> None:
+    """Records the received structure (pData and cbData of the dispatch callback) if recording is enabled."""
+    recorder = feed_recorder()
+    if recorder.enabled:
+        recorder.record(CLIENT_DATA_CHANNEL, ctypes.string_at(received, size))
@@ -0,0 +1,442 @@
+"""
+SimConnect test double for profiling and load testing the SimConnect based WinWing CDU scripts
+
+With MOBIFLIGHT_CDU_SIMCONNECT set, the scripts use SimConnectDouble instead of their SimConnectMobiFlight
+(see replay_simconnect() in simconnect_replay.py), so their client data handlers run on any system, including
+Linux without MSFS. Like SimConnect, it:
+- keeps the client data areas (MapClientDataNameToID), definitions (AddToClientDataDefinition,
+  ClearClientDataDefinition) and requests (RequestClientData) of the script, every other call is accepted
+- delivers a SIMCONNECT_RECV_CLIENT_DATA for every request on a separate thread, like SimConnect's dispatch
+  thread, every visual frame, once or every second as requested. With SIMCONNECT_CLIENT_DATA_REQUEST_FLAG_CHANGED
+  only data that differs from the last delivered one is sent
+- stands in for the MobiFlight WASM module: "MF.SimVars.Add.<name>" commands written to MobiFlight.Command
+  add a float to the MobiFlight.LVars area, "MF.SimVars.Clear" removes them all
+
+MOBIFLIGHT_CDU_SIMCONNECT selects the delivered data:
+- "corpus": the screens of the benchmark corpus (benchmarks/corpus, see build_corpus.py) of the aircraft owning the
+  client data area, PMDG 737/777, CRJ, MaddogX, A340 or MD-11. The LVARs cycle through the values 0, 1 and 2.
+- a recording (see cdu_feed_recording.py): the recorded client data of each definition
+- a corpus file: its frames for every client data area
+Every requester starts at a different screen, so the CDUs do not all show the same one.
+
+MOBIFLIGHT_CDU_SIMCONNECT_RATE sets the visual frames per second (default 60), MOBIFLIGHT_CDU_SIMCONNECT_HOLD the
+frames every screen is held (default 1, a new screen every frame) and MOBIFLIGHT_CDU_SIMCONNECT_DURATION stops the
+script after that many seconds as if Ctrl+C had been pressed. The delivered frames and the time the handlers took
+are logged every REPORT_INTERVAL seconds. tools/run_simconnect_double.py sets the variables and starts a script.
+"""
+
+import _thread
+import asyncio
+import base64
+import ctypes
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from SimConnect.Enum import SIMCONNECT_RECV_CLIENT_DATA, SIMCONNECT_RECV_ID
+
+from cdu_feed_recording import read_recording  # pylint: disable=import-error
+from simconnect_client_data import CLIENT_DATA_CHANNEL, CLIENT_DATA_MAX_SIZE, CLIENT_DATA_OFFSET  # pylint: disable=import-error
+
+SIMCONNECT_ENV: str = "MOBIFLIGHT_CDU_SIMCONNECT"
+RATE_ENV: str = "MOBIFLIGHT_CDU_SIMCONNECT_RATE"
+HOLD_ENV: str = "MOBIFLIGHT_CDU_SIMCONNECT_HOLD"
+DURATION_ENV: str = "MOBIFLIGHT_CDU_SIMCONNECT_DURATION"
+
+CORPUS_SOURCE: str = "corpus"
+CORPUS_DIR: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "corpus")
+# Corpus of the client data areas by the start of their name
+CORPUS_FILES: Dict[str, str] = {
+    "PMDG_NG3_CDU_": "pmdg_737.json",
+    "PMDG_777X_CDU_": "pmdg_777.json",
+    "ASCRJ CDU": "aerosoft_crj.json",
+    "MaddogX CDU": "maddogx.json",
+    "A340MCDU": "ini_a340.json",
+    "iniAirbusMCDU": "ini_a340.json",
+    "MD11MCDU": "tfdi_md11.json",
+}
+
+# Client data areas of the MobiFlight WASM module
+LVARS_AREA: str = "MobiFlight.LVars"
+COMMAND_AREA: str = "MobiFlight.Command"
+LVAR_ADD_COMMAND: str = "MF.SimVars.Add."
+LVAR_CLEAR_COMMAND: str = "MF.SimVars.Clear"
+LVAR_VALUES: List[float] = [0.0, 1.0, 2.0]
+
+# SIMCONNECT_CLIENT_DATA_PERIOD and SIMCONNECT_CLIENT_DATA_REQUEST_FLAG
+PERIOD_NEVER: int = 0
+PERIOD_ONCE: int = 1
+PERIOD_SECOND: int = 4
+FLAG_CHANGED: int = 1
+
+DEFAULT_RATE: float = 60.0
+REPORT_INTERVAL: float = 5.0
+# Frames are skipped if the handlers fall further behind, like SimConnect does not queue visual frames
+MAX_LAG: float = 1.0
+
+# dwDefineID within a recorded structure, a DWORD is 8 bytes wide outside of Windows
+DEFINE_ID_OFFSET: int = SIMCONNECT_RECV_CLIENT_DATA.dwDefineID.offset
+DEFINE_ID_END: int = DEFINE_ID_OFFSET + SIMCONNECT_RECV_CLIENT_DATA.dwDefineID.size
+
+ClientDataHandler = Callable[[Any], None]
+
+
+class ClientDataRequest(NamedTuple):
+    area_id: int
+    request_id: int
+    define_id: int
+    period: int
+    flags: int
+    # Order in which the requests were made, selects the first screen
+    ordinal: int
+
+
+def enum_value(value: Any) -> int:
+    """The scripts pass the SimConnect enums as members or plain ints."""
+    return int(getattr(value, "value", value))
+
+
+def client_data_structure(request: ClientDataRequest, payload: bytes) -> bytes:
+    """A received SIMCONNECT_RECV_CLIENT_DATA as SimConnect writes it, header and payload."""
+    received = SIMCONNECT_RECV_CLIENT_DATA()
+    received.dwSize = CLIENT_DATA_OFFSET + len(payload)
+    received.dwID = enum_value(SIMCONNECT_RECV_ID.SIMCONNECT_RECV_ID_CLIENT_DATA)
+    received.dwRequestID = request.request_id
+    received.dwDefineID = request.define_id
+    received.dwentrynumber = 1
+    received.dwoutof = 1
+    received.dwDefineCount = 1
+    return ctypes.string_at(ctypes.addressof(received), CLIENT_DATA_OFFSET) + payload
+
+
+def load_corpus_frames(path: str) -> List[bytes]:
+    with open(path, "r", encoding="utf-8") as file:
+        return [base64.b64decode(frame) for frame in json.load(file)["frames"]]
+
+
+def load_recorded_frames(path: str) -> Dict[int, List[bytes]]:
+    """The recorded client data payloads by definition ID, without consecutive repeats."""
+    frames: Dict[int, List[bytes]] = {}
+    for frame in read_recording(path):
+        if frame.channel != CLIENT_DATA_CHANNEL or len(frame.payload) < CLIENT_DATA_OFFSET:
+            continue
+        define_id: int = int.from_bytes(frame.payload[DEFINE_ID_OFFSET:DEFINE_ID_END], sys.byteorder)
+        payloads: List[bytes] = frames.setdefault(define_id, [])
+        payload: bytes = frame.payload[CLIENT_DATA_OFFSET:]
+        if not payloads or payloads[-1] != payload:
+            payloads.append(payload)
+    return frames
+
+
+class DoubleStats:
+    """What has been delivered since the last report."""
+
+    def __init__(self) -> None:
+        self.started: float = time.monotonic()
+        self.frames: int = 0
+        self.delivered: int = 0
+        self.unchanged: int = 0
+        self.behind: int = 0
+        self.handler_time: float = 0.0
+        self.handler_max: float = 0.0
+
+    def summary(self, requests: int) -> str:
+        duration: float = max(time.monotonic() - self.started, 1e-9)
+        average: float = self.handler_time / self.delivered * 1000 if self.delivered else 0.0
+        return (f"{self.frames / duration:.1f} visual frames/s, {self.delivered / duration:.1f} client data/s to "
+                f"{requests} requests, {self.unchanged} unchanged not sent, {self.behind} frames behind, "
+                f"handlers {average:.3f} ms average, {self.handler_max * 1000:.3f} ms max, "
+                f"{self.handler_time / duration * 100:.1f} % busy")
+
+
+class SimulatedDll:
+    """Keeps the client data setup of the script, accepts and counts every other SimConnect function call."""
+
+    def __init__(self, double: "SimConnectDouble") -> None:
+        self.double: "SimConnectDouble" = double
+        self.calls: Dict[str, int] = {}
+
+    def count(self, name: str) -> None:
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def MapClientDataNameToID(self, _handle: Any, name: bytes, area_id: Any) -> int:  # pylint: disable=invalid-name
+        self.count("MapClientDataNameToID")
+        self.double.map_area(name.decode("utf-8", errors="replace"), enum_value(area_id))
+        return 0
+
+    def AddToClientDataDefinition(self, _handle: Any, define_id: Any, offset: int, size: int, *_args: Any) -> int:  # pylint: disable=invalid-name
+        self.count("AddToClientDataDefinition")
+        self.double.add_to_definition(enum_value(define_id), offset, size)
+        return 0
+
+    def ClearClientDataDefinition(self, _handle: Any, define_id: Any) -> int:  # pylint: disable=invalid-name
+        self.count("ClearClientDataDefinition")
+        self.double.clear_definition(enum_value(define_id))
+        return 0
+
+    def RequestClientData(self, _handle: Any, area_id: Any, request_id: Any, define_id: Any,  # pylint: disable=invalid-name
+                          period: Any = PERIOD_ONCE, flags: Any = 0, *_args: Any) -> int:
+        self.count("RequestClientData")
+        self.double.request(enum_value(area_id), enum_value(request_id), enum_value(define_id), enum_value(period), enum_value(flags))
+        return 0
+
+    def SetClientData(self, _handle: Any, area_id: Any, _define_id: Any, _flags: Any, _reserved: Any,  # pylint: disable=invalid-name
+                      size: int, data: bytes) -> int:
+        self.count("SetClientData")
+        self.double.set_client_data(enum_value(area_id), bytes(data)[:size])
+        return 0
+
+    def __getattr__(self, name: str) -> Callable[..., int]:
+        def call(*_args: Any) -> int:
+            self.count(name)
+            return 0  # S_OK
+        return call
+
+
+class SimConnectDouble:
+    """Delivers corpus, recorded or LVAR client data to the registered handlers at visual-frame rate."""
+
+    def __init__(self, source: str, rate: float = DEFAULT_RATE, hold: int = 1, duration: float = 0.0) -> None:
+        self.source: str = source
+        self.rate: float = rate
+        self.hold: int = hold
+        self.duration: float = duration
+        self.dll: SimulatedDll = SimulatedDll(self)
+        self.hSimConnect: Optional[int] = None  # pylint: disable=invalid-name
+        self.client_data_handlers: List[ClientDataHandler] = []
+        self.lock: threading.RLock = threading.RLock()
+        self.areas: Dict[int, str] = {}
+        # (offset, size) of every part of a definition
+        self.definitions: Dict[int, List[Tuple[int, int]]] = {}
+        self.requests: Dict[int, ClientDataRequest] = {}
+        self.lvars: List[str] = []
+        # Complete structures to deliver per request ID, built on first use
+        self.frames: Dict[int, Optional[List[bytes]]] = {}
+        # Index of the last delivered frame per request ID
+        self.last_delivered: Dict[int, int] = {}
+        self.recorded: Optional[Dict[int, List[bytes]]] = None
+        self.corpus: Dict[str, List[bytes]] = {}
+        # SimConnect reuses its receive buffer, so does the double
+        self.buffer = ctypes.create_string_buffer(ctypes.sizeof(SIMCONNECT_RECV_CLIENT_DATA))
+        self.client_data = SIMCONNECT_RECV_CLIENT_DATA.from_buffer(self.buffer)
+        self.thread: Optional[threading.Thread] = None
+        self.stopped: threading.Event = threading.Event()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stats: DoubleStats = DoubleStats()
+        self.delivered: int = 0
+
+    def map_area(self, name: str, area_id: int) -> None:
+        with self.lock:
+            self.areas[area_id] = name
+
+    def add_to_definition(self, define_id: int, offset: int, size: int) -> None:
+        with self.lock:
+            self.definitions.setdefault(define_id, []).append((offset, size))
+            self.invalidate(lambda request: request.define_id == define_id)
+
+    def clear_definition(self, define_id: int) -> None:
+        with self.lock:
+            self.definitions.pop(define_id, None)
+            self.invalidate(lambda request: request.define_id == define_id)
+
+    def request(self, area_id: int, request_id: int, define_id: int, period: int, flags: int) -> None:
+        with self.lock:
+            if period == PERIOD_NEVER:
+                self.requests.pop(request_id, None)
+                return
+            self.requests[request_id] = ClientDataRequest(area_id, request_id, define_id, period, flags, len(self.requests))
+            self.invalidate(lambda request: request.request_id == request_id)
+
+    def set_client_data(self, area_id: int, data: bytes) -> None:
+        if self.areas.get(area_id) != COMMAND_AREA:
+            return
+        command: str = data.split(b"\0", 1)[0].decode("ascii", errors="replace")
+        with self.lock:
+            if command.startswith(LVAR_ADD_COMMAND):
+                self.lvars.append(command[len(LVAR_ADD_COMMAND):])
+            elif command == LVAR_CLEAR_COMMAND:
+                self.lvars.clear()
+            else:
+                return
+            self.invalidate(lambda request: self.areas.get(request.area_id) == LVARS_AREA)
+
+    def invalidate(self, affected: Callable[[ClientDataRequest], bool]) -> None:
+        for request in self.requests.values():
+            if affected(request):
+                self.frames.pop(request.request_id, None)
+                self.last_delivered.pop(request.request_id, None)
+
+    def definition_size(self, define_id: int) -> int:
+        return sum(size for _, size in self.definitions.get(define_id, []))
+
+    def lvar_payloads(self, define_id: int) -> List[bytes]:
+        """The LVars area read by the definition, once for every value the LVARs cycle through."""
+        payloads: List[bytes] = []
+        for phase in range(len(LVAR_VALUES)):
+            area = bytearray(max(4 * len(self.lvars), max((offset + size for offset, size in self.definitions[define_id]), default=0)))
+            for index in range(len(self.lvars)):
+                struct.pack_into("<f", area, 4 * index, LVAR_VALUES[(index + phase) % len(LVAR_VALUES)])
+            payloads.append(b"".join(bytes(area[offset:offset + size]) for offset, size in self.definitions[define_id]))
+        return payloads
+
+    def corpus_payloads(self, area: str) -> Optional[List[bytes]]:
+        if self.source != CORPUS_SOURCE:
+            path: str = self.source
+        else:
+            name: Optional[str] = next((file for prefix, file in CORPUS_FILES.items() if area.startswith(prefix)), None)
+            if name is None:
+                return None
+            path = os.path.join(CORPUS_DIR, name)
+        if path not in self.corpus:
+            self.corpus[path] = load_corpus_frames(path)
+        return self.corpus[path]
+
+    def payloads(self, request: ClientDataRequest) -> Optional[List[bytes]]:
+        area: str = self.areas.get(request.area_id, "")
+        if request.define_id not in self.definitions:
+            return None
+        if area == LVARS_AREA:
+            return self.lvar_payloads(request.define_id) if self.lvars else None
+        if area == COMMAND_AREA or area.startswith("MobiFlight."):
+            return None
+        if self.source.endswith(".json") or self.source == CORPUS_SOURCE:
+            return self.corpus_payloads(area)
+        if self.recorded is None:
+            self.recorded = load_recorded_frames(self.source)
+        return self.recorded.get(request.define_id)
+
+    def request_frames(self, request: ClientDataRequest) -> Optional[List[bytes]]:
+        if request.request_id not in self.frames:
+            try:
+                payloads: Optional[List[bytes]] = self.payloads(request)
+            except (OSError, ValueError, KeyError) as e:
+                logging.error("No client data for %s: %s", self.areas.get(request.area_id), e)
+                payloads = None
+            size: int = min(self.definition_size(request.define_id), CLIENT_DATA_MAX_SIZE)
+            if payloads:
+                self.frames[request.request_id] = [
+                    client_data_structure(request, payload[:size].ljust(size, b"\0")) for payload in payloads
+                ]
+            else:
+                logging.info("No client data to deliver for area %s, definition %s",
+                             self.areas.get(request.area_id), request.define_id)
+                self.frames[request.request_id] = None
+        return self.frames[request.request_id]
+
+    def register_client_data_handler(self, handler: ClientDataHandler) -> None:
+        if handler not in self.client_data_handlers:
+            logging.info("Register new client data handler")
+            self.client_data_handlers.append(handler)
+        if self.thread is None:
+            try:
+                self.loop = asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+            self.thread = threading.Thread(target=self.run, name="simconnect-double", daemon=True)
+            self.thread.start()
+
+    def unregister_client_data_handler(self, handler: ClientDataHandler) -> None:
+        if handler in self.client_data_handlers:
+            logging.info("Unregister client data handler")
+            self.client_data_handlers.remove(handler)
+
+    def run(self) -> None:
+        logging.info("SimConnect double delivering %s at %s frames/s, every screen held for %s frames",
+                     self.source, self.rate, self.hold)
+        interval: float = 1.0 / self.rate
+        started: float = time.monotonic()
+        due: float = started
+        report_at: float = started + REPORT_INTERVAL
+        frame: int = 0
+        while not self.stopped.is_set():
+            now: float = time.monotonic()
+            if self.duration and now - started >= self.duration:
+                self.stop()
+                break
+            if now >= report_at:
+                logging.info("SimConnect double: %s", self.stats.summary(len(self.requests)))
+                self.stats = DoubleStats()
+                report_at = now + REPORT_INTERVAL
+            if now - due > MAX_LAG:
+                skipped: int = int((now - due) / interval)
+                self.stats.behind += skipped
+                frame += skipped
+                due += skipped * interval
+            if due > now:
+                self.stopped.wait(due - now)
+                continue
+            self.deliver_frame(frame)
+            frame += 1
+            due += interval
+        logging.info("SimConnect double delivered %s client data frames, SimConnect calls: %s", self.delivered, self.dll.calls)
+
+    def deliver_frame(self, frame: int) -> None:
+        self.stats.frames += 1
+        with self.lock:
+            requests: List[ClientDataRequest] = list(self.requests.values())
+        for request in requests:
+            if request.period == PERIOD_ONCE and request.request_id in self.last_delivered:
+                continue
+            if request.period == PERIOD_SECOND and frame % max(1, round(self.rate)) != 0:
+                continue
+            with self.lock:
+                frames: Optional[List[bytes]] = self.request_frames(request)
+            if not frames:
+                continue
+            index: int = (frame // self.hold + request.ordinal * max(1, len(frames) // 2)) % len(frames)
+            if request.flags & FLAG_CHANGED and self.last_delivered.get(request.request_id) == index:
+                self.stats.unchanged += 1
+                continue
+            self.last_delivered[request.request_id] = index
+            self.dispatch(frames[index])
+
+    def dispatch(self, received: bytes) -> None:
+        ctypes.memmove(self.buffer, received, len(received))
+        self.delivered += 1
+        self.stats.delivered += 1
+        started: float = time.perf_counter()
+        for handler in list(self.client_data_handlers):
+            try:
+                handler(self.client_data)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logging.error("Client data handler failed on frame %s: %s", self.delivered, e)
+        elapsed: float = time.perf_counter() - started
+        self.stats.handler_time += elapsed
+        self.stats.handler_max = max(self.stats.handler_max, elapsed)
+
+    def stop(self) -> None:
+        logging.info("SimConnect double ran for %.0f s, stopping", self.duration)
+        _thread.interrupt_main()
+        if self.loop is not None:
+            # The interrupt is only handled once the loop wakes up, it may be waiting for I/O
+            self.loop.call_soon_threadsafe(lambda: None)
+
+    def exit(self) -> None:
+        self.stopped.set()
+
+
+def env_number(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logging.warning("Ignoring invalid %s=%s", name, os.environ.get(name))
+        return default
+
+
+def simconnect_double() -> Optional[SimConnectDouble]:
+    """Returns the SimConnect test double if MOBIFLIGHT_CDU_SIMCONNECT is set, None otherwise."""
+    source: str = os.environ.get(SIMCONNECT_ENV, "")
+    if not source:
+        return None
+    rate: float = env_number(RATE_ENV, DEFAULT_RATE)
+    return SimConnectDouble(
+        source,
+        rate if rate > 0 else DEFAULT_RATE,
+        max(1, int(env_number(HOLD_ENV, 1))),
+        max(0.0, env_number(DURATION_ENV, 0.0)),
+    )
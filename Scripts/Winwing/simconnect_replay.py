@@ -0,0 +1,101 @@
+"""
+SimConnect stand-in replaying recorded client data for the SimConnect based WinWing CDU scripts
+
+While a recording is replayed (see cdu_feed_recording.py), the scripts use ReplaySimConnect instead of their
+SimConnectMobiFlight. It offers what the scripts use of SimConnect:
+- dll accepts every SimConnect call (MapClientDataNameToID, AddToClientDataDefinition, RequestClientData, ...)
+  and does nothing, the recorded client data is delivered regardless of what was requested
+- register_client_data_handler() / unregister_client_data_handler() like SimConnectMobiFlight
+- the recorded SIMCONNECT_RECV_CLIENT_DATA structures are delivered to the handlers on a separate thread,
+  like SimConnect's dispatch thread, so the handlers and everything after them run unchanged
+
+Replay starts when the first handler is registered. The first frame follows REPLAY_START_DELAY later (see
+cdu_feed_recording.py), so the handlers of all CDUs, which register once their MobiFlight connection is up,
+are in place for it.
+
+Without a recording, replay_simconnect() returns the SimConnect test double of simconnect_double.py if
+MOBIFLIGHT_CDU_SIMCONNECT is set, which delivers corpus or recorded client data at visual-frame rate.
+"""
+
+import ctypes
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from SimConnect.Enum import SIMCONNECT_RECV_CLIENT_DATA
+
+from cdu_feed_recording import FeedReplay, feed_replay  # pylint: disable=import-error
+from simconnect_client_data import CLIENT_DATA_CHANNEL  # pylint: disable=import-error
+from simconnect_double import SimConnectDouble, simconnect_double  # pylint: disable=import-error
+
+ClientDataHandler = Callable[[Any], None]
+
+
+class ReplayDll:
+    """Accepts and counts every SimConnect function call."""
+
+    def __init__(self) -> None:
+        self.calls: Dict[str, int] = {}
+
+    def __getattr__(self, name: str) -> Callable[..., int]:
+        def call(*_args: Any) -> int:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return 0  # S_OK
+        return call
+
+
+class ReplaySimConnect:
+    """Delivers the client data of a recording to the registered handlers."""
+
+    def __init__(self, replay: FeedReplay) -> None:
+        self.replay: FeedReplay = replay
+        self.dll: ReplayDll = ReplayDll()
+        self.hSimConnect: Optional[int] = None  # pylint: disable=invalid-name
+        self.client_data_handlers: List[ClientDataHandler] = []
+        self.thread: Optional[threading.Thread] = None
+        self.stopped: threading.Event = threading.Event()
+        self.delivered: int = 0
+
+    def register_client_data_handler(self, handler: ClientDataHandler) -> None:
+        if handler not in self.client_data_handlers:
+            logging.info("Register new client data handler")
+            self.client_data_handlers.append(handler)
+        if self.thread is None:
+            self.replay.watch_loop()
+            self.thread = threading.Thread(target=self.run, name="simconnect-replay", daemon=True)
+            self.thread.start()
+
+    def unregister_client_data_handler(self, handler: ClientDataHandler) -> None:
+        if handler in self.client_data_handlers:
+            logging.info("Unregister client data handler")
+            self.client_data_handlers.remove(handler)
+
+    def run(self) -> None:
+        for frame in self.replay.blocking_frames([CLIENT_DATA_CHANNEL]):
+            if self.stopped.is_set():
+                break
+            self.dispatch(frame.payload)
+        logging.info("Replayed %s SimConnect client data frames, SimConnect calls: %s", self.delivered, self.dll.calls)
+
+    def dispatch(self, received: bytes) -> None:
+        # The recorded structure may be shorter than the declared one, which reserves the maximum payload size
+        buffer = ctypes.create_string_buffer(received, max(len(received), ctypes.sizeof(SIMCONNECT_RECV_CLIENT_DATA)))
+        client_data = SIMCONNECT_RECV_CLIENT_DATA.from_buffer(buffer)
+        self.delivered += 1
+        for handler in list(self.client_data_handlers):
+            try:
+                handler(client_data)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logging.error("Client data handler failed on replayed frame %s: %s", self.delivered, e)
+
+    def exit(self) -> None:
+        self.stopped.set()
+
+
+def replay_simconnect() -> Optional[Union[ReplaySimConnect, SimConnectDouble]]:
+    """
+    Returns the SimConnect stand-in while a recording is replayed, the test double if MOBIFLIGHT_CDU_SIMCONNECT
+    is set, None otherwise.
+    """
+    replay: Optional[FeedReplay] = feed_replay()
+    return ReplaySimConnect(replay) if replay is not None else simconnect_double()
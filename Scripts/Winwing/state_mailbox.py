@@ -0,0 +1,75 @@
+"""
+Drop-stale mailbox between the X-Plane dataref pipeline and the display pipeline of a CDU
+
+The dataref side produces a complete set of CDU values for every changed message, the display side
+renders at most one frame per rate limit interval. With an unbounded asyncio.Queue every intermediate
+set was rendered in turn, so the display fell behind the simulator whenever pages were changed quickly.
+
+StateMailbox holds only the newest state:
+- put() never blocks and replaces a state that has not been taken yet
+- wait() returns once a state is available, get_nowait() takes the newest one
+  so the consumer can wait, apply its rate limit and only then take the state that is current
+- depth is the number of states put since the last get, i.e. what the queue would have held,
+  and max_depth its peak; put, taken and dropped count the states
+- a state can be put together with the FrameTrace of the data it was built from,
+  get_traced_nowait() hands out both
+"""
+
+import asyncio
+import logging
+from typing import Generic, Optional, Tuple, TypeVar
+
+from cdu_latency_metrics import NULL_TRACE, FrameTrace  # pylint: disable=import-error
+
+T = TypeVar("T")
+
+
+class StateMailbox(Generic[T]):
+    """Single-slot mailbox that always hands out the newest state and drops superseded ones."""
+
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.state: Optional[T] = None
+        self.trace: FrameTrace = NULL_TRACE
+        self.available: asyncio.Event = asyncio.Event()
+        self.depth: int = 0
+        self.max_depth: int = 0
+        self.put_count: int = 0
+        self.taken: int = 0
+        self.dropped: int = 0
+
+    def put(self, state: T, trace: FrameTrace = NULL_TRACE) -> None:
+        if self.available.is_set():
+            self.dropped += 1
+        self.state = state
+        self.trace = trace
+        self.put_count += 1
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        self.available.set()
+
+    async def wait(self) -> None:
+        await self.available.wait()
+
+    def get_nowait(self) -> T:
+        return self.get_traced_nowait()[0]
+
+    def get_traced_nowait(self) -> Tuple[T, FrameTrace]:
+        if not self.available.is_set():
+            raise asyncio.QueueEmpty
+        state: T = self.state
+        trace: FrameTrace = self.trace
+        self.state = None
+        self.trace = NULL_TRACE
+        self.depth = 0
+        self.taken += 1
+        self.available.clear()
+        return state, trace
+
+    async def get(self) -> T:
+        await self.wait()
+        return self.get_nowait()
+
+    def log_stats(self) -> None:
+        logging.info("%s: %s states put, %s taken, %s dropped as superseded, max depth %s",
+                     self.name, self.put_count, self.taken, self.dropped, self.max_depth)
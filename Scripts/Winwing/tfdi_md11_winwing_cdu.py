@@ -2,13 +2,21 @@ from ctypes import wintypes, Structure, c_uint16, c_bool
 import ctypes
 import json
 import logging
+import os
+import sys
 import asyncio
-import struct
-import websockets.asyncio.client as ws_client
 from typing import Optional, List, Dict, Union, Any
 from SimConnect import SimConnect, Enum
 from SimConnect.Enum import SIMCONNECT_CLIENT_DATA_ID, SIMCONNECT_RECV_ID, SIMCONNECT_RECV_CLIENT_DATA
 
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from simconnect_client_data import client_data_bytes, record_client_data  # pylint: disable=wrong-import-position,import-error
+from simconnect_replay import replay_simconnect  # pylint: disable=wrong-import-position,import-error
+from cdu_frame_dedup import FrameDeduplicator  # pylint: disable=wrong-import-position,import-error
+from mobiflight_sink import MobiFlightSink  # pylint: disable=wrong-import-position,import-error
+from cdu_latency_metrics import start_trace  # pylint: disable=wrong-import-position,import-error
+
 # URLs
 CAPTAIN_CDU_URL: str = "ws://localhost:8320/winwing/cdu-captain"
 CENTER_CDU_URL: str = "ws://localhost:8320/winwing/cdu-observer"
@@ -72,61 +80,13 @@ class SimConnectMobiFlight(SimConnect):
     def my_dispatch_proc(self, pData, cbData, pContext):
         dwID = pData.contents.dwID
         if dwID == SIMCONNECT_RECV_ID.SIMCONNECT_RECV_ID_CLIENT_DATA:
+            record_client_data(pData, cbData)
             client_data = ctypes.cast(pData, ctypes.POINTER(SIMCONNECT_RECV_CLIENT_DATA)).contents
             for handler in self.client_data_handlers:
                 handler(client_data)
         else:
             super().my_dispatch_proc(pData, cbData, pContext)
 
-class MobiFlightClient:
-    def __init__(self, websocket_uri: str, max_retries: int = 3) -> None:
-        self.websocket: Optional[ws_client.ClientConnection] = None
-        self.connected: asyncio.Event = asyncio.Event()
-        self.websocket_uri: str = websocket_uri
-        self.retries: int = 0
-        self.max_retries: int = max_retries
-        self.last_display_data: Optional[str] = None
-        self._was_connected: bool = False
-
-    async def run(self) -> None:
-        while self.retries < self.max_retries:
-            try:
-                if self.websocket is None:
-                    logging.info("Connecting to MobiFlight at %s", self.websocket_uri)
-                    self.websocket = await ws_client.connect(self.websocket_uri, ping_interval=None)
-                    logging.info("MobiFlight connected")
-                    self.connected.set()
-                    
-                    # If we were previously connected and have last display data, resend it
-                    if self._was_connected and self.last_display_data:
-                        logging.info("Resending last display data after reconnection")
-                        await self.send(self.last_display_data)
-                    
-                    self._was_connected = True
-                    self.retries = 0  # Reset retries on successful connection
-                
-                await self.websocket.recv()
-            except Exception as e: 
-                self.retries += 1
-                logging.error(f"WebSocket error: {e} with retries {self.retries}")
-                self.websocket = None
-                self.connected.clear()
-            await asyncio.sleep(5)
-        logging.error("Max retries reached. Giving up connecting to MobiFlight at %s", self.websocket_uri)
-        self.connected.set()
-
-    async def send(self, data: str) -> None:
-        if self.websocket and self.connected.is_set():
-            await self.websocket.send(data)
-            self.last_display_data = data
-
-    async def close(self) -> None:
-        if self.websocket:
-            await self.websocket.close()
-            self.websocket = None
-            self.connected.clear()
-            self._was_connected = False
-
 def create_mobi_json(data: bytes) -> str:
     message: Dict[str, Union[str, List[List[Union[str, int]]], Dict[str, bool]]] = {
         "Target": "Display",
@@ -178,13 +138,12 @@ def create_mobi_json(data: bytes) -> str:
 class MD11CDUClient:
     def __init__(self, sc_mobiflight: SimConnectMobiFlight, websocket_uri: str, cdu_definition: int) -> None:
         self.sc_mobiflight: SimConnectMobiFlight = sc_mobiflight
-        self.mobiflight: MobiFlightClient = MobiFlightClient(websocket_uri)
-        self.event_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.mobiflight: MobiFlightSink = MobiFlightSink(websocket_uri)
         self.cdu_definition: int = cdu_definition
-        self.last_data: Optional[bytes] = None
+        self.dedup: FrameDeduplicator = FrameDeduplicator(websocket_uri)
 
     def failed_to_connect(self) -> bool:
-        return self.mobiflight.retries >= self.mobiflight.max_retries
+        return self.mobiflight.gave_up()
 
     def setup_simconnect(self) -> bool:
         try:
@@ -228,19 +187,14 @@ class MD11CDUClient:
                 
     def handle_cdu_data(self, client_data: Any) -> None:
         try:
-            if client_data.dwDefineID == self.cdu_definition and hasattr(client_data, 'dwData'):                
-                int_count : int = int(MCDU_DATA_SIZE / 4)              
-                if len(client_data.dwData) >= int_count:
-                    data_list : bytearray = bytearray()                  
-                    for i in range(int_count): 
-                        my_bytes : bytes = struct.pack("I", client_data.dwData[i])
-                        data_list.extend(my_bytes)                
-                    data: bytes = bytes(data_list) 
-                    # Only send if data has changed
-                    if data != self.last_data:
-                        self.last_data = data
-                        json_data = create_mobi_json(data)
-                        asyncio.run_coroutine_threadsafe(self.mobiflight.send(json_data), self.event_loop)                                              
+            if client_data.dwDefineID == self.cdu_definition and hasattr(client_data, 'dwData'):
+                trace = start_trace()
+                data: bytes = client_data_bytes(client_data, MCDU_DATA_SIZE)
+                # Only send if data has changed
+                if self.dedup.is_new(data):
+                    trace.mark("decode")
+                    json_data = create_mobi_json(data)
+                    self.mobiflight.post_threadsafe(json_data, trace)
         except Exception as e:
             logging.error(f"Error handling MCDU data: {e}")
 
@@ -253,7 +207,6 @@ class MD11CDUClient:
             await asyncio.sleep(0.1)
 
     async def run(self) -> None:
-        self.event_loop = asyncio.get_running_loop()
         logging.info("Starting MCDU client")
         
         try:
@@ -275,6 +228,7 @@ class MD11CDUClient:
         except Exception as e:
             logging.error(f"Error: {e}")
         finally:
+            self.dedup.log_stats()
             await self.mobiflight.close()
 
 if __name__ == "__main__":
@@ -283,7 +237,7 @@ if __name__ == "__main__":
         format='%(asctime)s - %(levelname)s - %(message)s'
     )
     
-    sc_mobiflight: SimConnectMobiFlight = SimConnectMobiFlight()
+    sc_mobiflight = replay_simconnect() or SimConnectMobiFlight()
     
     # Create clients for all three MCDUs
     left_mcdu: MD11CDUClient = MD11CDUClient(sc_mobiflight, CAPTAIN_CDU_URL, MD11_MCDU_LEFT_DEFINITION)
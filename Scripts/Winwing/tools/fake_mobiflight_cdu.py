@@ -0,0 +1,351 @@
+"""
+Local stand-in for the MobiFlight WinWing CDU display endpoints
+
+Listens on ws://localhost:8320/winwing/cdu-captain, cdu-co-pilot and cdu-observer like MobiFlight does,
+so a bridge script can be run without MobiFlight and a WinWing device attached.
+Every endpoint keeps the screen a device would currently show:
+- "Font" messages load the font, like MobiFlight without acknowledging them. Frames arriving within
+  --font-load-time after the font are counted as early, a device would draw them in the previous font
+- "Display" messages replace the whole screen
+- "DisplayPatch" messages (see cdu_display_delta.py) are applied to the current screen
+
+Every frame is validated: a screen has 336 cells, a cell is empty or [character, colour, size] with a single
+character, one of the colour codes the device knows and size 0 or 1. Invalid frames are logged and not shown.
+Endpoints listed with --inactive are refused with HTTP 501 like MobiFlight does without a device attached.
+
+Every endpoint logs frames, bytes, rates and the longest gap between frames when the bridge disconnects and
+at shutdown. --frames-csv additionally writes the arrival time and size of every single frame.
+
+A slow or stalling MobiFlight can be simulated to test the back-pressure behaviour of a bridge:
+--delay holds every frame for the given time, --stall-every / --stall-for stop reading for --stall-for
+seconds once every --stall-every seconds. Frames the server has not read yet stay in the receive queue of at
+most --max-queue frames and then in the socket's receive buffer, after that the bridge's writes block.
+The kernel buffers megabytes at both ends of a localhost connection, --receive-buffer limits the server's end
+so that writes block once the bridge's socket send buffer is full.
+
+Run a bridge with MOBIFLIGHT_CDU_DISPLAY_DELTA=1 against this server to test delta mode end to end.
+With --show the screen is printed whenever it changes, so the result can be compared with the aircraft.
+
+Usage:
+    python fake_mobiflight_cdu.py [--host localhost] [--port 8320] [--show] [--inactive cdu-observer]
+                                  [--font-load-time 1.0] [--frames-csv frames.csv]
+                                  [--delay 0.05] [--stall-every 10 --stall-for 3] [--max-queue 16]
+                                  [--receive-buffer 16384]
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import socket
+import sys
+import time
+from http import HTTPStatus
+from typing import Any, Dict, List, Optional, Set, TextIO
+
+from websockets.asyncio.server import ServerConnection, serve
+from websockets.exceptions import ConnectionClosed
+from websockets.http11 import Request, Response
+
+# The shared helper modules live in the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cdu_display_delta import (  # pylint: disable=wrong-import-position,import-error
+    DISPLAY_COLUMNS, DISPLAY_PATCH_TARGET, DISPLAY_TARGET, apply_display_patch
+)
+
+CDU_PATHS: List[str] = ["/winwing/cdu-captain", "/winwing/cdu-co-pilot", "/winwing/cdu-observer"]
+DISPLAY_CELLS: int = 336
+FONT_TARGET: str = "Font"
+# Fonts the scripts request, others are accepted with a warning
+KNOWN_FONTS: Set[str] = {"AirbusThales", "Boeing", "Collins"}
+# Colour codes of the device: amber, cyan, grey, green, khaki, magenta, blue, red, white, yellow
+CELL_COLOURS: Set[str] = {"a", "c", "e", "g", "k", "m", "o", "r", "w", "y"}
+CELL_SIZES: Set[int] = {0, 1}
+# Time MobiFlight needs to load a font, the bridges wait this long before their first frame by default
+DEFAULT_FONT_LOAD_TIME: float = 1.0
+
+
+def cell_error(cell: Any) -> Optional[str]:
+    """Returns what is wrong with a display cell, None if it is valid."""
+    if not isinstance(cell, list):
+        return f"cell {cell!r} is not a list"
+    if not cell:
+        return None
+    if len(cell) != 3:
+        return f"cell {cell!r} does not have 3 fields"
+    character, colour, size = cell
+    if not isinstance(character, str) or len(character) != 1:
+        return f"cell {cell!r} does not hold a single character"
+    if colour not in CELL_COLOURS:
+        return f"cell {cell!r} has unknown colour {colour!r}"
+    if isinstance(size, bool) or size not in CELL_SIZES:
+        return f"cell {cell!r} has unknown size {size!r}"
+    return None
+
+
+def display_errors(data: Any) -> List[str]:
+    """Returns the problems of the Data of a Display message."""
+    if not isinstance(data, list):
+        return ["Data is not a list of cells"]
+    errors: List[str] = []
+    if len(data) != DISPLAY_CELLS:
+        errors.append(f"{len(data)} cells instead of {DISPLAY_CELLS}")
+    for index, cell in enumerate(data):
+        error: Optional[str] = cell_error(cell)
+        if error:
+            errors.append(f"{error} at {index}")
+    return errors
+
+
+def patch_errors(data: Any) -> List[str]:
+    """Returns the problems of the Data of a DisplayPatch message."""
+    if not isinstance(data, list):
+        return ["Data is not a list of patches"]
+    errors: List[str] = []
+    for patch in data:
+        if not isinstance(patch, list) or len(patch) != 2 or not isinstance(patch[0], int) \
+                or not isinstance(patch[1], list):
+            errors.append(f"patch {patch!r} is not [first cell index, cells]")
+            continue
+        start, cells = patch
+        if start < 0 or start + len(cells) > DISPLAY_CELLS:
+            errors.append(f"patch range {start}..{start + len(cells)} outside of {DISPLAY_CELLS} cells")
+        for offset, cell in enumerate(cells):
+            error: Optional[str] = cell_error(cell)
+            if error:
+                errors.append(f"{error} at {start + offset}")
+    return errors
+
+
+class FrameLog:
+    """Writes the arrival time (Unix time, to match it with the bridge's log) and size of every frame to a CSV file."""
+
+    def __init__(self, path: str) -> None:
+        self.file: TextIO = open(path, "w", newline="", encoding="utf-8")  # pylint: disable=consider-using-with
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["time", "endpoint", "target", "bytes", "valid", "early"])
+
+    def write(self, path: str, target: str, size: int, valid: bool, early: bool) -> None:
+        self.writer.writerow([f"{time.time():.6f}", path, target, size, int(valid), int(early)])
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class FrameStats:
+    """Frames, bytes and arrival gaps of one endpoint over a period, e.g. one connection of the bridge."""
+
+    def __init__(self) -> None:
+        self.started: float = time.monotonic()
+        self.frames: int = 0
+        self.bytes: int = 0
+        self.invalid: int = 0
+        self.early: int = 0
+        self.last_arrival: Optional[float] = None
+        self.max_gap: float = 0.0
+
+    def add(self, arrival: float, size: int, valid: bool, early: bool) -> None:
+        if self.last_arrival is not None:
+            self.max_gap = max(self.max_gap, arrival - self.last_arrival)
+        self.last_arrival = arrival
+        self.frames += 1
+        self.bytes += size
+        self.invalid += 0 if valid else 1
+        self.early += 1 if early else 0
+
+    def summary(self) -> str:
+        duration: float = max(time.monotonic() - self.started, 1e-9)
+        average: float = self.bytes / self.frames if self.frames else 0.0
+        return (f"{self.frames} frames, {self.bytes} bytes in {duration:.1f} s "
+                f"({self.frames / duration:.1f} frames/s, {self.bytes / duration / 1024:.1f} KiB/s, "
+                f"{average:.0f} bytes/frame), longest gap {self.max_gap * 1000:.0f} ms, "
+                f"{self.invalid} invalid, {self.early} before the font was loaded")
+
+
+class SlowConsumer:
+    """Simulates a MobiFlight that reads frames slowly or stops reading for a while."""
+
+    def __init__(self, delay: float, stall_every: float, stall_for: float) -> None:
+        self.delay: float = delay
+        self.stall_every: float = stall_every
+        self.stall_for: float = stall_for
+        self.next_stall: float = time.monotonic() + stall_every
+
+    def enabled(self) -> bool:
+        return self.delay > 0 or (self.stall_every > 0 and self.stall_for > 0)
+
+    async def consume(self, path: str) -> None:
+        """Holds the frame just read before the next one is read."""
+        if self.delay > 0:
+            await asyncio.sleep(self.delay)
+        if self.stall_every > 0 and self.stall_for > 0 and time.monotonic() >= self.next_stall:
+            logging.info("%s: stalling for %.1f s", path, self.stall_for)
+            await asyncio.sleep(self.stall_for)
+            self.next_stall = time.monotonic() + self.stall_every
+
+
+class FakeCduEndpoint:
+    """State of one CDU endpoint, kept across reconnects of the bridge."""
+
+    def __init__(self, path: str, show: bool, font_load_time: float, frame_log: Optional[FrameLog]) -> None:
+        self.path: str = path
+        self.show: bool = show
+        self.font_load_time: float = font_load_time
+        self.frame_log: Optional[FrameLog] = frame_log
+        self.screen: List[Any] = [[] for _ in range(DISPLAY_CELLS)]
+        self.font: str = ""
+        self.font_loaded_at: float = 0.0
+        self.messages: int = 0
+        self.bytes_received: int = 0
+        self.total: FrameStats = FrameStats()
+        self.connection: FrameStats = FrameStats()
+
+    def connected(self) -> None:
+        self.connection = FrameStats()
+
+    def handle_message(self, message: str) -> None:
+        arrival: float = time.monotonic()
+        size: int = len(message)
+        self.messages += 1
+        self.bytes_received += size
+        try:
+            decoded: Dict[str, Any] = json.loads(message)
+            target: str = decoded.get("Target", "")
+        except (ValueError, AttributeError) as e:
+            self.add_frame(arrival, "", size, False, False)
+            raise ValueError(f"not a MobiFlight message: {e}") from e
+
+        if target == FONT_TARGET:
+            self.load_font(decoded.get("Data"), arrival)
+            return
+        if target not in (DISPLAY_TARGET, DISPLAY_PATCH_TARGET):
+            logging.warning("%s: unknown target %s", self.path, target)
+            return
+
+        data: Any = decoded.get("Data")
+        errors: List[str] = display_errors(data) if target == DISPLAY_TARGET else patch_errors(data)
+        early: bool = arrival < self.font_loaded_at
+        self.add_frame(arrival, target, size, not errors, early)
+        if errors:
+            logging.error("%s: invalid %s frame with %s problems, first: %s", self.path, target, len(errors), errors[0])
+            return
+        if target == DISPLAY_TARGET:
+            self.screen = list(data)
+        else:
+            apply_display_patch(self.screen, data)
+
+        logging.debug("%s: %s with %s bytes", self.path, target, size)
+        if self.show:
+            print(f"--- {self.path} ({target}, {size} bytes{', early' if early else ''})")
+            print(self.screen_text())
+
+    def load_font(self, font: Any, arrival: float) -> None:
+        if not isinstance(font, str) or not font:
+            logging.error("%s: invalid font %r", self.path, font)
+            return
+        if font not in KNOWN_FONTS:
+            logging.warning("%s: unknown font %s", self.path, font)
+        self.font = font
+        self.font_loaded_at = arrival + self.font_load_time
+        logging.info("%s: font %s", self.path, self.font)
+
+    def add_frame(self, arrival: float, target: str, size: int, valid: bool, early: bool) -> None:
+        self.total.add(arrival, size, valid, early)
+        self.connection.add(arrival, size, valid, early)
+        if self.frame_log:
+            self.frame_log.write(self.path, target, size, valid, early)
+
+    def screen_text(self) -> str:
+        rows: List[str] = []
+        for start in range(0, len(self.screen), DISPLAY_COLUMNS):
+            rows.append("".join(str(cell[0])[:1] if cell else " " for cell in self.screen[start:start + DISPLAY_COLUMNS]))
+        return "\n".join(rows)
+
+
+async def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8320)
+    parser.add_argument("--show", action="store_true", help="print the screen after every update")
+    parser.add_argument("--inactive", action="append", default=[], metavar="ENDPOINT",
+                        help="refuse an endpoint like MobiFlight without the device, e.g. cdu-observer")
+    parser.add_argument("--font-load-time", type=float, default=DEFAULT_FONT_LOAD_TIME,
+                        help="seconds after a font request in which frames count as early")
+    parser.add_argument("--frames-csv", help="write the arrival time and size of every frame to this file")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to hold every frame before reading on")
+    parser.add_argument("--stall-every", type=float, default=0.0, help="stop reading once every this many seconds")
+    parser.add_argument("--stall-for", type=float, default=0.0, help="seconds to stop reading for")
+    parser.add_argument("--max-queue", type=int, default=16, help="frames received but not read yet per connection")
+    parser.add_argument("--receive-buffer", type=int, help="socket receive buffer size in bytes")
+    args = parser.parse_args()
+
+    inactive: Set[str] = {f"/winwing/{name.strip('/').rsplit('/', 1)[-1]}" for name in args.inactive}
+    frame_log: Optional[FrameLog] = FrameLog(args.frames_csv) if args.frames_csv else None
+    endpoints: Dict[str, FakeCduEndpoint] = {
+        path: FakeCduEndpoint(path, args.show, args.font_load_time, frame_log) for path in CDU_PATHS
+    }
+
+    def process_request(connection: ServerConnection, request: Request) -> Optional[Response]:
+        if request.path in inactive:
+            logging.info("%s: refusing connection, endpoint is inactive", request.path)
+            return connection.respond(HTTPStatus.NOT_IMPLEMENTED, "CDU endpoint not active\n")
+        return None
+
+    async def handler(connection: ServerConnection) -> None:
+        endpoint = endpoints.get(connection.request.path)
+        if endpoint is None:
+            logging.warning("Rejecting connection to unknown path %s", connection.request.path)
+            await connection.close(code=1008, reason="unknown CDU endpoint")
+            return
+        logging.info("%s: bridge connected", endpoint.path)
+        endpoint.connected()
+        consumer = SlowConsumer(args.delay, args.stall_every, args.stall_for)
+        try:
+            async for message in connection:
+                try:
+                    endpoint.handle_message(message)
+                except (ValueError, KeyError, TypeError) as e:
+                    logging.error("%s: invalid message: %s", endpoint.path, e)
+                if consumer.enabled():
+                    await consumer.consume(endpoint.path)
+        except ConnectionClosed as e:
+            logging.info("%s: connection lost: %s", endpoint.path, e)
+        logging.info("%s: bridge disconnected after %s", endpoint.path, endpoint.connection.summary())
+        if frame_log:
+            frame_log.flush()
+
+    listener: Optional[socket.socket] = None
+    if args.receive_buffer:
+        # Accepted connections inherit the receive buffer size of the listening socket
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, args.receive_buffer)
+        listener.bind((args.host, args.port))
+
+    try:
+        # MobiFlight's WebSocket server does not negotiate compression, the frames travel at their full size
+        async with serve(handler, None if listener else args.host, None if listener else args.port, sock=listener,
+                         process_request=process_request, max_queue=args.max_queue, compression=None) as server:
+            logging.info("Fake MobiFlight CDU endpoints listening on ws://%s:%s", args.host, args.port)
+            await server.serve_forever()
+    finally:
+        for endpoint in endpoints.values():
+            if endpoint.messages:
+                logging.info("%s: %s in total", endpoint.path, endpoint.total.summary())
+        if frame_log:
+            frame_log.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,258 @@
+"""
+Local stand-in for the FlyByWire SimBridge MCDU interface
+
+Listens on ws://localhost:8380/interfaces/v1/mcdu like SimBridge does, so fbw_a32nx_winwing_cdu.py and
+headwind_a33_winwing_cdu.py can be run and benchmarked without the simulator:
+- "update:{"left": <page>, "right": <page>}" messages flip the pages of both MCDUs at --rate updates per
+  second, --burst sends that many updates back to back on every tick to create page flip storms
+- "requestUpdate" is answered with the current pages, like the aircraft answers it through SimBridge
+- every update is sent to all connected clients without waiting for them, as SimBridge does, a client that
+  does not keep up shows as a growing write buffer in the statistics
+
+The pages are taken from a JSON list of SimBridge pages ({"name": ..., "content": <page>}), by default the
+benchmark corpus (benchmarks/corpus/fbw_a32nx_pages.json), or from the update messages of a recording made
+by a bridge with MOBIFLIGHT_CDU_RECORD (see cdu_feed_recording.py).
+
+Faulty updates can be injected to test the error handling of the bridges:
+- --malformed-every N replaces every Nth update by one of: truncated JSON, JSON that is not an object,
+  a page with wrong types, a message that is not an update, a binary message
+- --oversized-every N replaces every Nth update by pages with lines of --oversized-bytes in total,
+  above 1 MiB the message is larger than the websockets library accepts by default
+
+Usage:
+    python fake_simbridge_mcdu.py [--pages pages.json | --recording feed.rec] [--rate 2] [--burst 1]
+                                  [--malformed-every 0] [--oversized-every 0] [--oversized-bytes 65536]
+                                  [--duration 0] [--host localhost] [--port 8380]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional, Set, Union
+
+from websockets.asyncio.server import ServerConnection, broadcast, serve
+from websockets.exceptions import ConnectionClosed
+
+SCRIPTS_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The shared helper modules live in the parent folder
+sys.path.insert(0, SCRIPTS_DIR)
+
+from cdu_feed_recording import SIMBRIDGE_CHANNEL, read_recording  # pylint: disable=wrong-import-position,import-error
+
+MCDU_PATH: str = "/interfaces/v1/mcdu"
+DEFAULT_PAGES: str = os.path.join(SCRIPTS_DIR, "benchmarks", "corpus", "fbw_a32nx_pages.json")
+UPDATE_PREFIX: str = "update:"
+REQUEST_UPDATE: str = "requestUpdate"
+DEFAULT_OVERSIZED_BYTES: int = 64 * 1024
+# The schedule is given up if the server falls further behind, so no backlog of updates is sent at once
+MAX_LAG: float = 1.0
+
+Message = Union[str, bytes]
+
+
+def update_message(left: Optional[Dict[str, Any]], right: Optional[Dict[str, Any]]) -> str:
+    return UPDATE_PREFIX + json.dumps({"left": left, "right": right})
+
+
+def load_pages(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as file:
+        return [page["content"] for page in json.load(file)]
+
+
+def page_updates(pages: List[Dict[str, Any]]) -> List[str]:
+    """One update per page, the right MCDU shows the page half a cycle ahead of the left one."""
+    return [update_message(page, pages[(index + len(pages) // 2) % len(pages)]) for index, page in enumerate(pages)]
+
+
+def recorded_updates(path: str) -> List[str]:
+    return [
+        frame.payload.decode("utf-8")
+        for frame in read_recording(path)
+        if frame.channel == SIMBRIDGE_CHANNEL and frame.payload.startswith(UPDATE_PREFIX.encode("utf-8"))
+    ]
+
+
+def oversized_update(page: Dict[str, Any], size: int) -> str:
+    """The page with every line filled up, so the update carries about size bytes."""
+    lines: List[List[str]] = page.get("lines") or [["", "", ""]]
+    text: str = "{green}" + "X" * max(1, size // (len(lines) * 3 * 2)) + "{end}"
+    oversized = dict(page, lines=[[text, text, text] for _ in lines])
+    return update_message(oversized, oversized)
+
+
+def malformed_updates(page: Dict[str, Any]) -> List[Message]:
+    """Updates a bridge must survive, cycled through in this order."""
+    return [
+        UPDATE_PREFIX + json.dumps({"left": page})[:40],
+        UPDATE_PREFIX + json.dumps([page]),
+        update_message(dict(page, lines=5, title=["not", "text"], arrows="up"), {"lines": [[None, 5, {}]]}),
+        "mcduConnected",
+        update_message(page, page).encode("utf-8"),
+    ]
+
+
+class UpdateSchedule:
+    """The updates sent by the server, with the faulty ones injected."""
+
+    def __init__(self, updates: List[str], malformed_every: int, oversized_every: int, oversized_bytes: int) -> None:
+        self.updates: List[str] = updates
+        self.malformed_every: int = malformed_every
+        self.oversized_every: int = oversized_every
+        first_page: Dict[str, Any] = json.loads(updates[0][len(UPDATE_PREFIX):]).get("left") or {}
+        self.malformed: List[Message] = malformed_updates(first_page)
+        self.oversized: str = oversized_update(first_page, oversized_bytes)
+        self.sent: int = 0
+        self.malformed_sent: int = 0
+        self.oversized_sent: int = 0
+        # The last valid update, sent again on requestUpdate
+        self.current: str = updates[0]
+
+    def next(self) -> Message:
+        self.sent += 1
+        if self.malformed_every and self.sent % self.malformed_every == 0:
+            self.malformed_sent += 1
+            return self.malformed[(self.malformed_sent - 1) % len(self.malformed)]
+        if self.oversized_every and self.sent % self.oversized_every == 0:
+            self.oversized_sent += 1
+            return self.oversized
+        self.current = self.updates[self.sent % len(self.updates)]
+        return self.current
+
+
+class SimBridgeStats:
+    """What the server has sent since the last report."""
+
+    def __init__(self) -> None:
+        self.started: float = time.monotonic()
+        self.updates: int = 0
+        self.bytes: int = 0
+        self.requests: int = 0
+        self.behind: int = 0
+
+    def summary(self, clients: Set[ServerConnection]) -> str:
+        duration: float = max(time.monotonic() - self.started, 1e-9)
+        buffered: int = max((client.transport.get_write_buffer_size() for client in clients), default=0)
+        return (f"{self.updates} updates, {self.bytes} bytes in {duration:.1f} s "
+                f"({self.updates / duration:.1f} updates/s, {self.bytes / duration / 1024:.1f} KiB/s) to "
+                f"{len(clients)} clients, {self.requests} update requests, {self.behind} behind, "
+                f"largest client write buffer {buffered} bytes")
+
+
+class FakeSimBridge:
+    """The MCDU interface: broadcasts the scheduled updates to all clients and answers their requests."""
+
+    def __init__(self, schedule: UpdateSchedule, rate: float, burst: int) -> None:
+        self.schedule: UpdateSchedule = schedule
+        self.rate: float = rate
+        self.burst: int = burst
+        self.clients: Set[ServerConnection] = set()
+        self.stats: SimBridgeStats = SimBridgeStats()
+
+    def send(self, clients: Set[ServerConnection], message: Message) -> None:
+        broadcast(clients, message)
+        self.stats.updates += 1
+        self.stats.bytes += len(message) * len(clients)
+
+    async def handler(self, connection: ServerConnection) -> None:
+        if connection.request.path != MCDU_PATH:
+            logging.warning("Rejecting connection to unknown path %s", connection.request.path)
+            await connection.close(code=1008, reason="unknown interface")
+            return
+        self.clients.add(connection)
+        logging.info("Client %s connected, %s connected", connection.remote_address, len(self.clients))
+        try:
+            async for message in connection:
+                if message == REQUEST_UPDATE:
+                    self.stats.requests += 1
+                    self.send({connection}, self.schedule.current)
+                else:
+                    logging.debug("Ignoring client message %.80s", message)
+        except ConnectionClosed as e:
+            logging.info("Client %s lost: %s", connection.remote_address, e)
+        finally:
+            self.clients.discard(connection)
+        logging.info("Client %s disconnected, %s connected", connection.remote_address, len(self.clients))
+
+    async def send_updates(self) -> None:
+        loop = asyncio.get_running_loop()
+        interval: float = 1.0 / self.rate
+        due: float = loop.time()
+        while True:
+            now: float = loop.time()
+            if now - due > MAX_LAG:
+                skipped = int((now - due) / interval)
+                self.stats.behind += skipped
+                due += skipped * interval
+            while due <= now:
+                if self.clients:
+                    for _ in range(self.burst):
+                        self.send(self.clients, self.schedule.next())
+                due += interval
+            await asyncio.sleep(max(0.0, due - loop.time()))
+
+    async def report(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            if self.clients or self.stats.updates:
+                logging.info("%s", self.stats.summary(self.clients))
+            self.stats = SimBridgeStats()
+
+
+async def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8380)
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--pages", default=DEFAULT_PAGES, help="JSON list of SimBridge MCDU pages")
+    source.add_argument("--recording", help="recording of a SimBridge bridge made with MOBIFLIGHT_CDU_RECORD")
+    parser.add_argument("--rate", type=float, default=2.0, help="ticks per second")
+    parser.add_argument("--burst", type=int, default=1, help="updates sent back to back on every tick")
+    parser.add_argument("--malformed-every", type=int, default=0, help="replace every Nth update by a malformed one")
+    parser.add_argument("--oversized-every", type=int, default=0, help="replace every Nth update by an oversized one")
+    parser.add_argument("--oversized-bytes", type=int, default=DEFAULT_OVERSIZED_BYTES,
+                        help="size of the oversized updates")
+    parser.add_argument("--report-interval", type=float, default=5.0, help="seconds between the statistics")
+    parser.add_argument("--duration", type=float, default=0.0, help="seconds to run, 0 runs until interrupted")
+    args = parser.parse_args()
+    if args.rate <= 0 or args.burst < 1:
+        parser.error("--rate must be positive and --burst at least 1")
+
+    try:
+        updates: List[str] = recorded_updates(args.recording) if args.recording else page_updates(load_pages(args.pages))
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(str(e))
+    if not updates:
+        parser.error("no MCDU pages found")
+
+    schedule = UpdateSchedule(updates, args.malformed_every, args.oversized_every, args.oversized_bytes)
+    bridge = FakeSimBridge(schedule, args.rate, args.burst)
+    tasks: List[asyncio.Task] = [asyncio.create_task(bridge.send_updates()),
+                                 asyncio.create_task(bridge.report(args.report_interval))]
+    # SimBridge does not compress, the pages travel at their full size
+    async with serve(bridge.handler, args.host, args.port, compression=None, max_size=None) as server:
+        logging.info("Fake SimBridge MCDU listening on ws://%s:%s%s with %s updates, %s x %s updates/s",
+                     args.host, args.port, MCDU_PATH, len(updates), args.rate, args.burst)
+        try:
+            if args.duration > 0:
+                await asyncio.sleep(args.duration)
+                logging.info("Stopping after %.0f s", args.duration)
+            else:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            logging.info("Sent %s updates, %s malformed and %s oversized", schedule.sent,
+                         schedule.malformed_sent, schedule.oversized_sent)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
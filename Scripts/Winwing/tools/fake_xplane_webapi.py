@@ -0,0 +1,429 @@
+"""
+Load-generating stand-in for the X-Plane Web API
+
+Serves what the X-Plane CDU scripts use of the Web API on http://localhost:8086, so a bridge can be run and
+stress-tested without X-Plane:
+- GET /api/capabilities and /api/v2/datarefs/count, which identify the session for the dataref cache
+- GET /api/v2/datarefs with fields, filter[name], start and limit
+- the WebSocket /api/v2 with dataref_subscribe_values / dataref_unsubscribe_values, answered with a result,
+  the current values of the subscribed datarefs and then dataref_update_values messages
+
+The catalogue holds the complete CDU dataref sets of the selected aircraft, for every CDU they have, and is
+filled up to --datarefs entries with other datarefs like a session with add-ons loaded. The names of a real
+catalogue saved with "curl http://localhost:8086/api/v2/datarefs" can be used for the filling with --catalogue.
+
+The CDU values are taken from the benchmark corpus (benchmarks/corpus), the screens of real pages encoded the
+way each aircraft delivers them, base64 text and int arrays. Every update message steps the pages: with
+--mode page a message carries all datarefs changed by the next page of every CDU, as X-Plane sends them
+after a page change, with --mode line every changed dataref is sent in a message of its own, as when typing
+into the scratchpad. --rate sets the messages per second of every connection, up to thousands. Messages that
+cannot be sent in time because the bridge does not read fast enough are counted as behind and skipped.
+
+Every connection logs what it has sent every --report-interval seconds. --duration stops the server.
+
+Usage:
+    python fake_xplane_webapi.py [--aircraft zibo] [--aircraft toliss ...] [--datarefs 40000]
+                                 [--catalogue datarefs.json] [--rate 10] [--mode page|line]
+                                 [--duration 60] [--host localhost] [--port 8086]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+import urllib.parse
+from http import HTTPStatus
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from websockets.asyncio.server import ServerConnection, serve
+from websockets.exceptions import ConnectionClosed
+from websockets.http11 import Request, Response
+
+CORPUS_DIR: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "corpus")
+
+API_PREFIX: str = "/api"
+WEBSOCKET_PATH: str = "/api/v2"
+XPLANE_VERSION: str = "12.1.4"
+FIRST_DATAREF_ID: int = 10000
+DEFAULT_DATAREF_COUNT: int = 40000
+# The schedule is given up if a connection falls further behind, so a slow bridge is not flooded afterwards
+MAX_LAG: float = 1.0
+
+# Datarefs holding int arrays and ints, all other CDU datarefs are base64 encoded byte arrays ("data")
+INT_ARRAY_ENDINGS: Tuple[str, ...] = ("symbolsColor", "symbolsSize", "symbolsEffects", "_style")
+INT_ENDINGS: Tuple[str, ...] = ("VertSlewKeys",)
+
+
+class AircraftProfile(NamedTuple):
+    """The CDU datarefs of an aircraft: {cdu} in prefix is replaced by every entry of cdus."""
+    corpus: str
+    prefix: str
+    cdus: List[str]
+    suffixes: List[str]
+
+    def cdu_prefix(self, cdu: str) -> str:
+        return self.prefix.format(cdu=cdu)
+
+    def names(self, cdu: str) -> List[str]:
+        return [self.cdu_prefix(cdu) + suffix for suffix in self.suffixes]
+
+
+TOLISS_COLOURS: str = "abgmswy"
+
+AIRCRAFT: Dict[str, AircraftProfile] = {
+    "zibo": AircraftProfile(
+        "zibo_737_800x.json", "laminar/B738/{cdu}/", ["fmc1", "fmc2"],
+        [f"Line00_{suffix}" for suffix in ("L", "S", "G", "M", "I", "C")]
+        + [f"Line{line:02d}_{suffix}" for line in range(1, 7)
+           for suffix in ("X", "LX", "GX", "L", "S", "G", "M", "I", "SI", "C")]
+        + ["Line_entry", "Line_entry_I"],
+    ),
+    "toliss": AircraftProfile(
+        "toliss_a3xx.json", "AirbusFBW/{cdu}", ["MCDU1", "MCDU2"],
+        [f"{part}{colour}" for part in ["title", "stitle"] + [f"{kind}{line}" for kind in ("label", "cont", "scont")
+                                                              for line in range(1, 7)]
+         for colour in TOLISS_COLOURS] + ["spa", "spw", "VertSlewKeys"],
+    ),
+    "cl650": AircraftProfile(
+        "hotstart_cl650.json", "CL650/CDU/{cdu}/screen/", ["1", "2", "3"],
+        [f"{kind}_line{line}" for kind in ("text", "style") for line in range(15)],
+    ),
+    "ff777": AircraftProfile(
+        "flightfactor_777v2.json", "1-sim/{cdu}/display/", ["cduL", "cduR", "cduC"],
+        ["symbols", "symbolsColor", "symbolsSize", "symbolsEffects"],
+    ),
+    "ff757": AircraftProfile(
+        "flightfactor_75_76.json", "1-sim/{cdu}/display/", ["cduL", "cduR"],
+        ["symbols", "symbolsColor", "symbolsSize"],
+    ),
+    "rotate_md11": AircraftProfile(
+        "rotate_md11.json", "Rotate/aircraft/controls/{cdu}/", ["cdu_0", "cdu_1", "cdu_2"],
+        [f"mcdu_line_{line}_{kind}" for line in range(14) for kind in ("content", "style")],
+    ),
+    "rotate_md80": AircraftProfile(
+        "rotate_md80.json", "Rotate/md80/instruments/", [""],
+        [f"cdu_line_{line:02d}" for line in range(1, 15)],
+    ),
+}
+
+
+def value_type(name: str) -> str:
+    if name.endswith(INT_ARRAY_ENDINGS):
+        return "int[]"
+    if name.endswith(INT_ENDINGS):
+        return "int"
+    return "data"
+
+
+def blank_value(name: str) -> Any:
+    """The value of a CDU dataref showing nothing."""
+    return {"int[]": [], "int": 0}.get(value_type(name), "")
+
+
+def load_corpus_frames(profile: AircraftProfile) -> List[Dict[str, Any]]:
+    with open(os.path.join(CORPUS_DIR, profile.corpus), "r", encoding="utf-8") as file:
+        return list(json.load(file)["frames"])
+
+
+def filler_names(count: int, catalogue_path: Optional[str]) -> List[str]:
+    """Names of the datarefs that are not CDU datarefs, from a saved catalogue or generated."""
+    if catalogue_path:
+        with open(catalogue_path, "r", encoding="utf-8") as file:
+            content = json.load(file)
+        entries = content["data"] if isinstance(content, dict) else content
+        return [str(entry["name"]) for entry in entries]
+    return [f"sim/fake/group{index // 100:04d}/dataref{index % 100:02d}" for index in range(count)]
+
+
+class DatarefCatalogue:
+    """All datarefs of the fake session and the page cycle of the CDU datarefs."""
+
+    def __init__(self, aircraft: List[str], dataref_count: int, catalogue_path: Optional[str]) -> None:
+        cdu_names: List[str] = []
+        for name in aircraft:
+            profile = AIRCRAFT[name]
+            for cdu in profile.cdus:
+                cdu_names.extend(profile.names(cdu))
+        known: Set[str] = set(cdu_names)
+        others: List[str] = [name for name in filler_names(max(0, dataref_count - len(cdu_names)), catalogue_path)
+                             if name not in known]
+
+        # The simulator's own datarefs come first, the add-on aircraft registers its datarefs when loaded
+        self.entries: List[Dict[str, Any]] = [
+            {"id": FIRST_DATAREF_ID + index, "is_writable": False, "name": name,
+             "value_type": value_type(name) if name in known else "float"}
+            for index, name in enumerate(dict.fromkeys(others + cdu_names))
+        ]
+        self.ids: Dict[str, int] = {entry["name"]: entry["id"] for entry in self.entries}
+        self.names: Dict[int, str] = {entry["id"]: entry["name"] for entry in self.entries}
+        self.pages: List[Dict[int, Any]] = self.page_cycle(aircraft)
+        self.list_responses: Dict[str, str] = {}
+
+    def page_cycle(self, aircraft: List[str]) -> List[Dict[int, Any]]:
+        """The complete CDU dataref values of every step of the page cycle."""
+        cycles: List[List[Dict[int, Any]]] = []
+        for name in aircraft:
+            profile = AIRCRAFT[name]
+            frames = load_corpus_frames(profile)
+            captain: str = profile.cdu_prefix(profile.cdus[0])
+            for position, cdu in enumerate(profile.cdus):
+                # The CDUs of an aircraft show different pages
+                offset: int = position * len(frames) // len(profile.cdus)
+                cdu_prefix: str = profile.cdu_prefix(cdu)
+                cycle: List[Dict[int, Any]] = []
+                for step in range(len(frames)):
+                    values = {self.ids[dataref]: blank_value(dataref) for dataref in profile.names(cdu)}
+                    for dataref, value in frames[(step + offset) % len(frames)].items():
+                        values[self.ids[cdu_prefix + dataref[len(captain):]]] = value
+                    cycle.append(values)
+                cycles.append(cycle)
+
+        length: int = max((len(cycle) for cycle in cycles), default=0)
+        pages: List[Dict[int, Any]] = [{} for _ in range(length)]
+        for cycle in cycles:
+            for step in range(length):
+                pages[step].update(cycle[step % len(cycle)])
+        return pages
+
+    def list_response(self, query: Dict[str, List[str]]) -> str:
+        """The /api/v2/datarefs response, the complete list is serialized once per field selection."""
+        names: List[str] = query.get("filter[name]", [])
+        fields: Optional[List[str]] = query["fields"][0].split(",") if "fields" in query else None
+        start: int = int(query.get("start", ["0"])[0])
+        limit: Optional[int] = int(query["limit"][0]) if "limit" in query else None
+        cache_key: Optional[str] = ",".join(fields or ["all"]) if not names and not start and limit is None else None
+        if cache_key and cache_key in self.list_responses:
+            return self.list_responses[cache_key]
+
+        entries = [self.entries[self.ids[name] - FIRST_DATAREF_ID] for name in names if name in self.ids] \
+            if names else self.entries
+        entries = entries[start:None if limit is None else start + limit]
+        if fields:
+            entries = [{field: entry[field] for field in fields if field in entry} for entry in entries]
+        response: str = json.dumps({"data": entries})
+        if cache_key:
+            self.list_responses[cache_key] = response
+        return response
+
+
+class StreamStats:
+    """What one connection has sent since the last report."""
+
+    def __init__(self) -> None:
+        self.started: float = time.monotonic()
+        self.messages: int = 0
+        self.bytes: int = 0
+        self.behind: int = 0
+        self.send_time: float = 0.0
+        self.max_send_time: float = 0.0
+
+    def add(self, size: int, send_time: float) -> None:
+        self.messages += 1
+        self.bytes += size
+        self.send_time += send_time
+        self.max_send_time = max(self.max_send_time, send_time)
+
+    def summary(self) -> str:
+        duration: float = max(time.monotonic() - self.started, 1e-9)
+        return (f"{self.messages} messages, {self.bytes} bytes in {duration:.1f} s "
+                f"({self.messages / duration:.0f} messages/s, {self.bytes / duration / 1024:.1f} KiB/s), "
+                f"{self.behind} behind, {self.send_time / duration * 100:.0f}% waiting to send, "
+                f"longest send {self.max_send_time * 1000:.1f} ms")
+
+
+class DatarefStream:
+    """The subscriptions of one WebSocket connection and the update messages sent for them."""
+
+    def __init__(self, name: str, catalogue: DatarefCatalogue, rate: float, mode: str) -> None:
+        self.name: str = name
+        self.catalogue: DatarefCatalogue = catalogue
+        self.rate: float = rate
+        self.mode: str = mode
+        self.subscribed: Set[int] = set()
+        self.messages: List[str] = []
+        self.position: int = 0
+        self.changed: asyncio.Event = asyncio.Event()
+        self.stats: StreamStats = StreamStats()
+        self.total: StreamStats = StreamStats()
+
+    def handle_request(self, request: Dict[str, Any]) -> List[str]:
+        """Returns the messages answering a request."""
+        request_type: str = request.get("type", "")
+        req_id: Any = request.get("req_id")
+        datarefs: Any = request.get("params", {}).get("datarefs", [])
+        if request_type == "dataref_subscribe_values":
+            ids: List[int] = [int(dataref["id"]) for dataref in datarefs]
+            unknown: List[int] = [dataref_id for dataref_id in ids if dataref_id not in self.catalogue.names]
+            if unknown:
+                return [json.dumps({"type": "result", "req_id": req_id, "success": False,
+                                    "error_code": "invalid_dataref_id",
+                                    "error_message": f"Unknown dataref IDs {unknown[:10]}"})]
+            self.subscribed.update(ids)
+            self.rebuild()
+            current: Dict[int, Any] = self.catalogue.pages[0] if self.catalogue.pages else {}
+            values = {str(dataref_id): current.get(dataref_id, 0) for dataref_id in ids}
+            logging.info("%s: subscribed to %s datarefs", self.name, len(ids))
+            return [json.dumps({"type": "result", "req_id": req_id, "success": True}),
+                    json.dumps({"type": "dataref_update_values", "data": values})]
+        if request_type == "dataref_unsubscribe_values":
+            if datarefs == "all":
+                self.subscribed.clear()
+            else:
+                self.subscribed.difference_update(int(dataref["id"]) for dataref in datarefs)
+            self.rebuild()
+            return [json.dumps({"type": "result", "req_id": req_id, "success": True})]
+        return [json.dumps({"type": "result", "req_id": req_id, "success": False, "error_code": "invalid_request",
+                            "error_message": f"Unsupported request type {request_type}"})]
+
+    def rebuild(self) -> None:
+        """Serializes the update messages of the page cycle for the subscribed datarefs once."""
+        pages: List[Dict[int, Any]] = self.catalogue.pages
+        messages: List[str] = []
+        for step, page in enumerate(pages):
+            previous: Dict[int, Any] = pages[step - 1]
+            changes = {str(dataref_id): value for dataref_id, value in page.items()
+                       if dataref_id in self.subscribed and previous.get(dataref_id) != value}
+            if self.mode == "line":
+                messages.extend(json.dumps({"type": "dataref_update_values", "data": {dataref_id: value}})
+                                for dataref_id, value in changes.items())
+            elif changes:
+                messages.append(json.dumps({"type": "dataref_update_values", "data": changes}))
+        self.messages = messages
+        self.position = 0
+        self.changed.set()
+        if not messages and self.subscribed:
+            logging.warning("%s: none of the subscribed datarefs are CDU datarefs, no updates are sent", self.name)
+
+    async def send_updates(self, connection: ServerConnection) -> None:
+        loop = asyncio.get_running_loop()
+        interval: float = 1.0 / self.rate
+        due: float = loop.time()
+        while True:
+            if not self.messages:
+                self.changed.clear()
+                await self.changed.wait()
+                due = loop.time()
+            now: float = loop.time()
+            if now - due > MAX_LAG:
+                skipped = int((now - due) / interval)
+                self.stats.behind += skipped
+                self.total.behind += skipped
+                due += skipped * interval
+            while due <= now and self.messages:
+                message: str = self.messages[self.position % len(self.messages)]
+                self.position += 1
+                started: float = loop.time()
+                await connection.send(message)
+                send_time: float = loop.time() - started
+                self.stats.add(len(message), send_time)
+                self.total.add(len(message), send_time)
+                due += interval
+            await asyncio.sleep(max(0.0, due - loop.time()))
+
+    async def report(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            logging.info("%s: %s", self.name, self.stats.summary())
+            self.stats = StreamStats()
+
+
+def json_response(connection: ServerConnection, body: str, status: HTTPStatus = HTTPStatus.OK) -> Response:
+    response: Response = connection.respond(status, body)
+    del response.headers["Content-Type"]
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+def rest_response(connection: ServerConnection, request: Request, catalogue: DatarefCatalogue) -> Response:
+    url = urllib.parse.urlsplit(request.path)
+    query: Dict[str, List[str]] = urllib.parse.parse_qs(url.query)
+    if url.path == f"{API_PREFIX}/capabilities":
+        return json_response(connection, json.dumps({"api": {"versions": ["v1", "v2"]},
+                                                     "x-plane": {"version": XPLANE_VERSION}}))
+    if url.path == f"{API_PREFIX}/v2/datarefs/count":
+        return json_response(connection, json.dumps({"data": len(catalogue.entries)}))
+    if url.path == f"{API_PREFIX}/v2/datarefs":
+        try:
+            return json_response(connection, catalogue.list_response(query))
+        except ValueError as e:
+            return json_response(connection, json.dumps({"error_code": "invalid_parameter", "error_message": str(e)}),
+                                 HTTPStatus.BAD_REQUEST)
+    return json_response(connection, json.dumps({"error_code": "route_not_found", "error_message": url.path}),
+                         HTTPStatus.NOT_FOUND)
+
+
+async def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # Every REST request is a rejected WebSocket handshake to the websockets library
+    logging.getLogger("websockets.server").setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8086)
+    parser.add_argument("--aircraft", action="append", choices=sorted(AIRCRAFT),
+                        help="aircraft whose CDU datarefs are served, can be repeated (default: zibo)")
+    parser.add_argument("--datarefs", type=int, default=DEFAULT_DATAREF_COUNT, help="size of the catalogue")
+    parser.add_argument("--catalogue", help="saved /api/v2/datarefs response whose names fill the catalogue")
+    parser.add_argument("--rate", type=float, default=10.0, help="update messages per second and connection")
+    parser.add_argument("--mode", choices=["page", "line"], default="page",
+                        help="one message per page change or one per changed dataref")
+    parser.add_argument("--report-interval", type=float, default=5.0, help="seconds between the statistics")
+    parser.add_argument("--duration", type=float, default=0.0, help="seconds to run, 0 runs until interrupted")
+    args = parser.parse_args()
+    if args.rate <= 0:
+        parser.error("--rate must be positive")
+
+    started: float = time.monotonic()
+    catalogue = DatarefCatalogue(args.aircraft or ["zibo"], args.datarefs, args.catalogue)
+    logging.info("Catalogue of %s datarefs with %s CDU datarefs of %s built in %.2f s", len(catalogue.entries),
+                 len(catalogue.pages[0]) if catalogue.pages else 0, args.aircraft or ["zibo"],
+                 time.monotonic() - started)
+    connections: List[int] = [0]
+
+    def process_request(connection: ServerConnection, request: Request) -> Optional[Response]:
+        if request.path == WEBSOCKET_PATH:
+            return None
+        return rest_response(connection, request, catalogue)
+
+    async def handler(connection: ServerConnection) -> None:
+        connections[0] += 1
+        stream = DatarefStream(f"connection {connections[0]}", catalogue, args.rate, args.mode)
+        logging.info("%s: WebSocket connected", stream.name)
+        tasks: List[asyncio.Task] = [asyncio.create_task(stream.send_updates(connection)),
+                                     asyncio.create_task(stream.report(args.report_interval))]
+        try:
+            async for message in connection:
+                try:
+                    request: Dict[str, Any] = json.loads(message)
+                    answers: List[str] = stream.handle_request(request)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    logging.error("%s: invalid request: %s", stream.name, e)
+                    continue
+                for answer in answers:
+                    await connection.send(answer)
+        except ConnectionClosed as e:
+            logging.info("%s: connection lost: %s", stream.name, e)
+        finally:
+            for task in tasks:
+                task.cancel()
+        logging.info("%s: disconnected after %s", stream.name, stream.total.summary())
+
+    # Like X-Plane, the fake does not compress, the values travel at their full size
+    async with serve(handler, args.host, args.port, process_request=process_request, compression=None,
+                     max_size=None) as server:
+        logging.info("Fake X-Plane Web API listening on http://%s:%s, %s update messages/s in %s mode",
+                     args.host, args.port, args.rate, args.mode)
+        if args.duration > 0:
+            await asyncio.sleep(args.duration)
+            logging.info("Stopping after %.0f s", args.duration)
+        else:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,98 @@
+"""
+Replays a recorded simulator feed through a CDU bridge script
+
+A bridge started with MOBIFLIGHT_CDU_RECORD=<file> records the raw frames it receives from the simulator
+(see cdu_feed_recording.py). This tool runs the bridge again with the recording in place of the simulator:
+decoding, rendering and sending to MobiFlight run unchanged, so a performance problem seen in the simulator can
+be reproduced and profiled on any system, including Linux without a simulator.
+
+The frames are sent to the MobiFlight CDU endpoints as usual, run fake_mobiflight_cdu.py to receive them
+without MobiFlight. The bridge is stopped once the recording has been replayed.
+
+By default the script that made the recording is run, at the recorded speed. --speed scales the timing,
+--fast replays as fast as possible. --info only lists what the recording holds.
+
+Usage:
+    python replay_cdu_feed.py recording [--script zibo_737_800x.py] [--speed 1.0 | --fast] [--info]
+"""
+
+import argparse
+import logging
+import os
+import runpy
+import sys
+from collections import Counter
+from typing import Dict, List, Optional
+
+# The bridge scripts and shared helper modules live in the parent folder
+SCRIPTS_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from cdu_feed_recording import (  # pylint: disable=wrong-import-position,import-error
+    RECORD_ENV, REPLAY_ENV, REPLAY_SPEED_ENV, SESSION_CHANNEL, read_recording, recorded_scripts
+)
+
+
+def log_info(path: str) -> None:
+    frames: Dict[str, int] = Counter()
+    sizes: Dict[str, int] = Counter()
+    first: Optional[float] = None
+    duration: float = 0.0
+    for frame in read_recording(path):
+        if frame.channel == SESSION_CHANNEL:
+            logging.info("Session of %s", frame.payload.decode("utf-8"))
+            first = None
+            continue
+        if first is None:
+            first = frame.timestamp
+        duration = max(duration, frame.timestamp - first)
+        frames[frame.channel] += 1
+        sizes[frame.channel] += len(frame.payload)
+    for channel, count in sorted(frames.items()):
+        logging.info("%-24s %8s frames %12s bytes", channel, count, sizes[channel])
+    logging.info("Longest session: %.1f s", duration)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", help="file recorded with MOBIFLIGHT_CDU_RECORD")
+    parser.add_argument("--script", help="bridge script to run, the recording script by default")
+    parser.add_argument("--speed", type=float, default=1.0, help="factor on the recorded speed")
+    parser.add_argument("--fast", action="store_true", help="replay as fast as possible")
+    parser.add_argument("--info", action="store_true", help="list the sessions and channels of the recording")
+    args = parser.parse_args()
+
+    try:
+        scripts: List[str] = recorded_scripts(args.recording)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if args.info:
+        log_info(args.recording)
+        return
+
+    script: Optional[str] = args.script or (scripts[0] if scripts else None)
+    if script is None:
+        parser.error("the recording holds no session, pass --script")
+    if len(set(scripts)) > 1 and not args.script:
+        logging.warning("The recording holds sessions of %s, replaying all of them through %s", sorted(set(scripts)), script)
+    script_path: str = script if os.path.isabs(script) else os.path.join(SCRIPTS_DIR, script)
+    if not os.path.exists(script_path):
+        parser.error(f"bridge script {script_path} not found")
+
+    os.environ[REPLAY_ENV] = os.path.abspath(args.recording)
+    os.environ[REPLAY_SPEED_ENV] = "0" if args.fast else str(args.speed)
+    # The replayed frames must not be appended to a recording again
+    os.environ.pop(RECORD_ENV, None)
+
+    logging.info("Replaying %s through %s", args.recording, script_path)
+    sys.argv = [script_path]
+    try:
+        runpy.run_path(script_path, run_name="__main__")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
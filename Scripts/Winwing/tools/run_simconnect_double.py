@@ -0,0 +1,74 @@
+"""
+Runs a SimConnect based CDU bridge script against the SimConnect test double
+
+The PMDG 737/777, CRJ, MaddogX, MD-11, A340 and EC135 scripts read their CDU from SimConnect client data. This
+tool starts one of them with the test double of simconnect_double.py in place of SimConnect, so the client data
+handlers, decoding and sending to MobiFlight can be profiled and load-tested without MSFS, including on Linux.
+The double delivers the client data at visual-frame rate and logs the delivered frames and the time the handlers
+took every few seconds.
+
+The frames are sent to the MobiFlight CDU endpoints as usual, run fake_mobiflight_cdu.py to receive them
+without MobiFlight.
+
+The data comes from the benchmark corpus of the aircraft by default, --source takes a recording made with
+MOBIFLIGHT_CDU_RECORD or a corpus file instead. --hold keeps every screen for that many frames, 1 changes the
+screen every frame. --duration stops the script after that many seconds, so its statistics are logged.
+
+Usage:
+    python run_simconnect_double.py pmdg_737_winwing_cdu.py [--source corpus] [--rate 60] [--hold 1] [--duration 0]
+"""
+
+import argparse
+import logging
+import os
+import runpy
+import sys
+
+# The bridge scripts and shared helper modules live in the parent folder
+SCRIPTS_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from cdu_feed_recording import RECORD_ENV, REPLAY_ENV  # pylint: disable=wrong-import-position,import-error
+from simconnect_double import (  # pylint: disable=wrong-import-position,import-error
+    CORPUS_SOURCE, DEFAULT_RATE, DURATION_ENV, HOLD_ENV, RATE_ENV, SIMCONNECT_ENV
+)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("script", help="SimConnect based bridge script to run")
+    parser.add_argument("--source", default=CORPUS_SOURCE,
+                        help="'corpus', a recording made with MOBIFLIGHT_CDU_RECORD or a corpus file")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="visual frames per second")
+    parser.add_argument("--hold", type=int, default=1, help="frames every screen is held")
+    parser.add_argument("--duration", type=float, default=0.0, help="seconds to run, 0 runs until interrupted")
+    args = parser.parse_args()
+    if args.rate <= 0 or args.hold < 1:
+        parser.error("--rate must be positive and --hold at least 1")
+
+    script_path: str = args.script if os.path.isabs(args.script) else os.path.join(SCRIPTS_DIR, args.script)
+    if not os.path.exists(script_path):
+        parser.error(f"bridge script {script_path} not found")
+    if args.source != CORPUS_SOURCE and not os.path.exists(args.source):
+        parser.error(f"source {args.source} not found")
+
+    os.environ[SIMCONNECT_ENV] = args.source if args.source == CORPUS_SOURCE else os.path.abspath(args.source)
+    os.environ[RATE_ENV] = str(args.rate)
+    os.environ[HOLD_ENV] = str(args.hold)
+    os.environ[DURATION_ENV] = str(args.duration)
+    # A replay would take precedence over the double, and the generated frames must not be recorded
+    os.environ.pop(REPLAY_ENV, None)
+    os.environ.pop(RECORD_ENV, None)
+
+    logging.info("Running %s against the SimConnect double with %s", script_path, args.source)
+    sys.argv = [script_path]
+    try:
+        runpy.run_path(script_path, run_name="__main__")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Persistent dataref ID mapping cache for the X-Plane CDU scripts
+
+The X-Plane Web API delivers dataref values by numeric ID, so every script needs the IDs of the CDU
+datarefs of its aircraft before it can subscribe. Downloading the complete /api/v2/datarefs list and
+filtering it takes seconds once many add-ons are loaded, and doing so with urllib blocks the event loop.
+
+load_dataref_mapping() keeps the selected mapping of every aircraft and CDU in a JSON file together with
+the X-Plane session it was taken from (X-Plane version and number of registered datarefs).
+On startup a cached mapping is validated cheaply instead:
+- the session must be unchanged, which costs two small requests
+- the cached names are looked up with filter[name] and must all still have the cached IDs
+Only if that fails, the full list is downloaded and filtered again. All HTTP and file work runs in a
+worker thread, so the event loop keeps serving the other CDUs and the MobiFlight connections.
+load_dataref_mappings() resolves the mappings of several CDUs at once and downloads the full list at most once.
+
+The cache is stored in %LOCALAPPDATA%/MobiFlight (the home folder on other systems), a different file can
+be set with the environment variable MOBIFLIGHT_XPLANE_DATAREF_CACHE.
+
+While a recording is replayed (see cdu_feed_recording.py) there is no X-Plane to ask, the mappings are selected
+from the datarefs subscribed in the recording instead, so they match the IDs of the recorded messages.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from typing import Any, Callable, Dict, List, Optional
+
+from cdu_feed_recording import XPLANE_DATAREFS_CHANNEL, FeedReplay, feed_replay  # pylint: disable=import-error
+
+BASE_API_URL: str = "http://localhost:8086/api"
+DATAREF_CACHE_ENV: str = "MOBIFLIGHT_XPLANE_DATAREF_CACHE"
+CACHE_VERSION: int = 1
+REQUEST_TIMEOUT: float = 5.0
+# Names per filter[name] request, keeps the URLs short
+LOOKUP_CHUNK_SIZE: int = 50
+
+# A dataref entry of the /api/v2/datarefs list, e.g. {"id": 1234, "name": "laminar/B738/fmc1/Line00_L"}
+DatarefEntry = Dict[str, Any]
+DatarefSelector = Callable[[List[DatarefEntry]], Dict[int, str]]
+
+# Scripts watching several CDUs load their mappings concurrently, the cache file is written by one at a time
+_cache_lock = threading.Lock()
+
+
+def default_cache_path() -> str:
+    path: str = os.environ.get(DATAREF_CACHE_ENV, "")
+    if path:
+        return path
+    base: str = os.environ.get("LOCALAPPDATA", "") or os.path.expanduser("~")
+    return os.path.join(base, "MobiFlight", "xplane_dataref_cache.json")
+
+
+def get_json(url: str) -> Any:
+    with urllib.request.urlopen(url, timeout=REQUEST_TIMEOUT) as response:
+        return json.load(response)
+
+
+def get_session(api_url: str) -> Dict[str, Any]:
+    """Returns what identifies the running X-Plane session: dataref IDs are only valid within it."""
+    capabilities = get_json(f"{api_url}/capabilities")
+    count = get_json(f"{api_url}/v2/datarefs/count")
+    return {
+        "xplane_version": capabilities.get("x-plane", {}).get("version"),
+        "dataref_count": count.get("data"),
+    }
+
+
+def lookup_datarefs(api_url: str, names: List[str]) -> Dict[str, int]:
+    """Looks up the IDs of the given dataref names without downloading the full list."""
+    ids: Dict[str, int] = {}
+    for start in range(0, len(names), LOOKUP_CHUNK_SIZE):
+        chunk = names[start:start + LOOKUP_CHUNK_SIZE]
+        query: str = urllib.parse.urlencode([("filter[name]", name) for name in chunk] + [("fields", "id,name")])
+        response = get_json(f"{api_url}/v2/datarefs?{query}")
+        ids.update({str(entry["name"]): int(entry["id"]) for entry in response.get("data", [])})
+    return ids
+
+
+def fetch_all_datarefs(api_url: str) -> List[DatarefEntry]:
+    response = get_json(f"{api_url}/v2/datarefs?fields=id,name")
+    return list(response["data"])
+
+
+class DatarefCache:
+    """Dataref mappings of all aircraft and CDUs, stored in one JSON file."""
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+
+    def read(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                content = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(content, dict) or content.get("version") != CACHE_VERSION:
+            return {}
+        return content.get("entries", {})
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.read().get(key)
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        with _cache_lock:
+            entries = self.read()
+            entries[key] = entry
+            try:
+                directory: str = os.path.dirname(self.path) or "."
+                os.makedirs(directory, exist_ok=True)
+                # Write to a temporary file first, so a script stopped halfway does not leave a broken cache
+                handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+                with os.fdopen(handle, "w", encoding="utf-8") as file:
+                    json.dump({"version": CACHE_VERSION, "entries": entries}, file)
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                logging.warning("Could not write dataref cache %s: %s", self.path, e)
+
+
+def validate_cached_mapping(key: str, session: Dict[str, Any], api_url: str, cache: DatarefCache) -> Optional[Dict[int, str]]:
+    """Returns the cached mapping for key if it is still valid for the running session."""
+    entry = cache.get(key)
+    if entry is None or entry.get("session") != session:
+        return None
+    mapping: Dict[int, str] = {int(dataref_id): name for dataref_id, name in entry.get("mapping", {}).items()}
+    if mapping and lookup_datarefs(api_url, list(mapping.values())) == {name: i for i, name in mapping.items()}:
+        return mapping
+    logging.info("Cached dataref mapping for %s is outdated", key)
+    return None
+
+
+def resolve_dataref_mappings(
+    selects: Dict[str, DatarefSelector], api_url: str, cache: DatarefCache
+) -> Dict[str, Dict[int, str]]:
+    started: float = time.monotonic()
+    session = get_session(api_url)
+
+    mappings: Dict[str, Dict[int, str]] = {}
+    for key in selects:
+        mapping = validate_cached_mapping(key, session, api_url, cache)
+        if mapping is not None:
+            logging.info("Using cached mapping of %s datarefs for %s, validated in %.2f s",
+                         len(mapping), key, time.monotonic() - started)
+            mappings[key] = mapping
+
+    missing: List[str] = [key for key in selects if key not in mappings]
+    if missing:
+        # One download serves all mappings that could not be taken from the cache
+        datarefs = fetch_all_datarefs(api_url)
+        for key in missing:
+            mapping = selects[key](datarefs)
+            # Nothing to cache if the aircraft is not loaded yet
+            if mapping:
+                cache.put(key, {"session": session, "mapping": {str(i): name for i, name in mapping.items()}})
+            logging.info("Fetched mapping of %s datarefs for %s in %.2f s",
+                         len(mapping), key, time.monotonic() - started)
+            mappings[key] = mapping
+    return mappings
+
+
+def replayed_dataref_mappings(selects: Dict[str, DatarefSelector], replay: FeedReplay) -> Dict[str, Dict[int, str]]:
+    recorded: Optional[bytes] = replay.first_payload(XPLANE_DATAREFS_CHANNEL)
+    datarefs: List[DatarefEntry] = json.loads(recorded) if recorded else []
+    if not datarefs:
+        logging.warning("The recording %s holds no subscribed datarefs", replay.path)
+    return {key: select(datarefs) for key, select in selects.items()}
+
+
+async def load_dataref_mappings(
+    selects: Dict[str, DatarefSelector],
+    api_url: str = BASE_API_URL,
+    cache_path: Optional[str] = None,
+) -> Dict[str, Dict[int, str]]:
+    """
+    Returns the dataref ID to name mapping for every key of selects, see load_dataref_mapping().
+    The full dataref list is downloaded at most once for all keys.
+    """
+    replay: Optional[FeedReplay] = feed_replay()
+    if replay is not None:
+        return await asyncio.to_thread(replayed_dataref_mappings, selects, replay)
+    cache = DatarefCache(cache_path or default_cache_path())
+    return await asyncio.to_thread(resolve_dataref_mappings, selects, api_url, cache)
+
+
+async def load_dataref_mapping(
+    key: str,
+    select: DatarefSelector,
+    api_url: str = BASE_API_URL,
+    cache_path: Optional[str] = None,
+) -> Dict[int, str]:
+    """
+    Returns the dataref ID to name mapping selected from the full dataref list by select.
+    key identifies the aircraft and CDU, e.g. "zibo_737_800x/fmc1". The mapping is taken from the
+    cache if it is still valid for the running X-Plane session, otherwise it is fetched and stored.
+    """
+    mappings = await load_dataref_mappings({key: select}, api_url, cache_path)
+    return mappings[key]
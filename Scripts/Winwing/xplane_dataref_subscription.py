@@ -0,0 +1,148 @@
+"""
+Shared X-Plane dataref subscription for the X-Plane CDU scripts
+
+Every CDU of an aircraft used to open its own connection to the X-Plane Web API, subscribe to its own
+datarefs and decode every value message on its own. With two or three CDUs attached that multiplies the
+socket and JSON decoding work for the same stream of values.
+
+DatarefSubscription holds one connection per script:
+- every CDU registers its dataref mapping, a value decoder and the mailbox of its display pipeline
+- on every (re)connect a single request subscribes to the union of all registered datarefs, before any
+  value is read, so no CDU ever runs on a partial subscription
+- every value message is decoded once and routed by dataref ID to the CDU the dataref belongs to
+- a CDU only receives a new set of values if one of its own datarefs has changed
+- every set of values is handed over with its FrameTrace (see cdu_latency_metrics.py), started when
+  the message was received and marked as decoded once the values have been decoded
+- the subscribed datarefs and every received message are recorded if recording is enabled, and while a
+  recording is replayed the recorded messages take the place of the connection (see cdu_feed_recording.py)
+"""
+
+import json
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import websockets
+
+from cdu_feed_recording import XPLANE_CHANNEL, XPLANE_DATAREFS_CHANNEL, connect_websocket, feed_recorder  # pylint: disable=import-error
+from cdu_latency_metrics import start_trace  # pylint: disable=import-error
+from state_mailbox import StateMailbox  # pylint: disable=import-error
+
+# Converts a raw value of the Web API into the value the display pipeline expects, e.g. base64 to text
+DatarefDecoder = Callable[[str, Any], Any]
+
+
+def keep_value(_dataref_name: str, value: Any) -> Any:
+    return value
+
+
+class DatarefFeed:
+    """The datarefs of one CDU and the mailbox its display pipeline takes complete sets of values from."""
+
+    def __init__(
+        self,
+        name: str,
+        dataref_map: Dict[int, str],
+        mailbox: StateMailbox,
+        decode: DatarefDecoder = keep_value,
+    ) -> None:
+        self.name: str = name
+        self.dataref_map: Dict[int, str] = dataref_map
+        self.mailbox: StateMailbox = mailbox
+        self.decode: DatarefDecoder = decode
+        self.last_known_values: Dict[str, Any] = {}
+        self.updates: int = 0
+
+    def publish(self, changes: List[Tuple[str, Any]], received_at: Optional[float] = None) -> None:
+        trace = start_trace(received_at)
+        new_values = dict(self.last_known_values)
+        for dataref_name, value in changes:
+            new_values[dataref_name] = self.decode(dataref_name, value)
+
+        if new_values == self.last_known_values:
+            return
+
+        self.last_known_values = new_values
+        self.updates += 1
+        trace.mark("decode")
+        self.mailbox.put(new_values, trace)
+
+
+class DatarefSubscription:
+    """One X-Plane Web API connection serving the dataref subscriptions of all CDUs of a script."""
+
+    def __init__(self, websocket_uri: str) -> None:
+        self.websocket_uri: str = websocket_uri
+        self.feeds: List[DatarefFeed] = []
+        # Dataref ID to the feed it belongs to and its name
+        self.routes: Dict[int, Tuple[DatarefFeed, str]] = {}
+        self.messages: int = 0
+
+    def add_feed(
+        self,
+        name: str,
+        dataref_map: Dict[int, str],
+        mailbox: StateMailbox,
+        decode: DatarefDecoder = keep_value,
+    ) -> DatarefFeed:
+        """Registers the datarefs of one CDU. Must be called before run()."""
+        feed = DatarefFeed(name, dataref_map, mailbox, decode)
+        self.feeds.append(feed)
+        for dataref_id, dataref_name in dataref_map.items():
+            if dataref_id in self.routes:
+                logging.warning("Dataref %s is used by %s and %s, routing it to %s only",
+                                dataref_name, self.routes[dataref_id][0].name, name, name)
+            self.routes[dataref_id] = (feed, dataref_name)
+        return feed
+
+    def subscribe_message(self) -> str:
+        return json.dumps(
+            {
+                "type": "dataref_subscribe_values",
+                "req_id": 1,
+                "params": {"datarefs": [{"id": id_value} for id_value in self.routes]},
+            }
+        )
+
+    def recorded_datarefs(self) -> str:
+        """The subscribed datarefs in the format of the /api/v2/datarefs list."""
+        return json.dumps([{"id": dataref_id, "name": name} for dataref_id, (_, name) in self.routes.items()])
+
+    def route(self, data: Dict[str, Any], received_at: Optional[float] = None) -> None:
+        changes: Dict[DatarefFeed, List[Tuple[str, Any]]] = {}
+        for dataref_id, value in data.items():
+            route: Optional[Tuple[DatarefFeed, str]] = self.routes.get(int(dataref_id))
+            if route is None:
+                continue
+            feed, dataref_name = route
+            changes.setdefault(feed, []).append((dataref_name, value))
+
+        for feed, feed_changes in changes.items():
+            feed.publish(feed_changes, received_at)
+
+    async def run(self) -> None:
+        logging.info("Connecting to X-Plane websocket server for %s datarefs of %s",
+                     len(self.routes), [str(feed.name) for feed in self.feeds])
+        recorder = feed_recorder()
+        async for websocket in connect_websocket(self.websocket_uri, XPLANE_CHANNEL):
+            logging.info("Connected successfully to X-Plane websocket server")
+            try:
+                await websocket.send(self.subscribe_message())
+                # The IDs are only valid within the X-Plane session, a replay needs their names
+                recorder.record(XPLANE_DATAREFS_CHANNEL, self.recorded_datarefs())
+                while True:
+                    message = await websocket.recv()
+                    received_at: float = time.perf_counter()
+                    recorder.record(XPLANE_CHANNEL, message)
+                    data = json.loads(message)
+
+                    if "data" not in data:
+                        continue
+
+                    self.messages += 1
+                    self.route(data["data"], received_at)
+            except websockets.exceptions.ConnectionClosed:
+                logging.error(
+                    "X-Plane websocket connection was closed... Attempting to reconnect"
+                )
+                continue
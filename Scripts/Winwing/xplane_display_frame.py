@@ -0,0 +1,72 @@
+"""
+Incremental display rendering for the X-Plane CDU scripts
+
+The X-Plane bridges receive the CDU screen as a set of datarefs, each of them belonging to one line of the
+aircraft's CDU which covers one or two rows of the display. Rebuilding all rows whenever a single dataref
+changes turns every blinking cursor or ticking clock into a full frame conversion.
+
+DisplayFrame keeps the rendered frame between updates. For every new set of dataref values it determines
+the datarefs that differ from the values rendered last, maps them to their lines and re-renders only those
+lines into the persistent frame buffer. The aircraft specific parts are provided by the script:
+- get_line(dataref) returns the line a dataref belongs to, or None if it is not displayed
+- render_line(line, line_datarefs, display_data) renders the rows of a line into the frame buffer
+update() marks the render stage on the FrameTrace of the values (see cdu_latency_metrics.py).
+"""
+
+import json
+from typing import Callable, Dict, List, Optional
+
+from cdu_latency_metrics import NULL_TRACE, FrameTrace  # pylint: disable=import-error
+
+CDU_COLUMNS = 24
+CDU_ROWS = 14
+CDU_CELLS = CDU_COLUMNS * CDU_ROWS
+
+# Dataref name to dataref value, as collected by the scripts from the X-Plane WebSocket messages
+DatarefValues = Dict[str, str]
+
+
+class DisplayFrame:
+    """Persistent frame buffer of one CDU that re-renders only the lines affected by changed datarefs."""
+
+    def __init__(
+        self,
+        get_line: Callable[[str], Optional[int]],
+        render_line: Callable[[int, DatarefValues, List[list]], None],
+    ) -> None:
+        self.get_line = get_line
+        self.render_line = render_line
+        self.display_data: List[list] = [[] for _ in range(CDU_CELLS)]
+        self.values: DatarefValues = {}
+        # Datarefs grouped by line, in the order they were first received
+        self.lines: Dict[int, DatarefValues] = {}
+        self.line_of_dataref: Dict[str, Optional[int]] = {}
+        self.frames = 0
+        self.lines_rendered = 0
+
+    def update(self, values: DatarefValues, trace: FrameTrace = NULL_TRACE) -> str:
+        """Brings the frame up to date with the given dataref values and returns the display JSON."""
+        changed_lines = set()
+        last_values = self.values
+
+        for dataref, value in values.items():
+            if dataref in last_values and last_values[dataref] == value:
+                continue
+
+            if dataref not in self.line_of_dataref:
+                self.line_of_dataref[dataref] = self.get_line(dataref)
+            line = self.line_of_dataref[dataref]
+            if line is None:
+                continue
+
+            self.lines.setdefault(line, {})[dataref] = value
+            changed_lines.add(line)
+
+        self.values = values
+        for line in changed_lines:
+            self.render_line(line, self.lines[line], self.display_data)
+
+        self.frames += 1
+        self.lines_rendered += len(changed_lines)
+        trace.mark("render")
+        return json.dumps({"Target": "Display", "Data": self.display_data})
@@ -7,26 +7,32 @@ In order to support multiple CDU devices seamlessly, a dynamic approach is taken
 A device is considered "supported" if it exists in the aircraft. Some aircraft have 3 CDUs while others have 2.
 Each enum member is assigned a value that represents the X-Plane dataref identifier. Example: fmc1 of laminar/B738/fmc1/Line04_I.
 
-Upon script start, MobiFlight is probed (get_available_devices()) to detect the devices connected to the PC. Any device that returns a successful response is then tracked.
+Upon script start, all MobiFlight CDU endpoints are probed at once (get_available_devices()) to detect the devices connected to the PC. Any device that accepts the connection is then tracked and the probe connection is kept for its display updates.
 
-Two tasks are started independently for each avialable CDU device.
-1. handle_dataref_updates -> Listens to X-Plane's WebSocket server for dataref updates for that specific CDU and pushes an event to a queue
-2. handle_device_update   -> Listens to the queue and dispatches updates to MobiFlight to update that CDU
+A single DatarefSubscription (xplane_dataref_subscription.py) connects to X-Plane's WebSocket server once, subscribes to the datarefs of all available CDU devices and routes every update to the device it belongs to.
+For each available CDU device, handle_device_update takes the newest set of values from the device's StateMailbox (state_mailbox.py) and dispatches updates to MobiFlight to update that CDU. Sets of values superseded while the display is rate limited are dropped, so the display never falls behind the simulator.
 
-Tasks are started independently for each CDU device to ensure each device can update quickly, particularly when players might be performing shared cockpit flights.
+Every device has its own display task to ensure each device can update quickly, particularly when players might be performing shared cockpit flights.
 
-Upon a failed connection while dispatching updates to MobiFlight, the handle_device_update function use `async for` with the websockets client. The failed message is put back in the queue, the loop continues to the next iteration which then reconnects again.
-The failed message is picked back up and dispatched to MobiFlight. This ensures a user's device eventually receives the updated display contents and doesn't hang which would require the user to cycle the page again.
+handle_device_update posts the translated display to a MobiFlightSink (mobiflight_sink.py), which only keeps the latest display if MobiFlight can't keep up. Upon a failed connection the sink reconnects and sends the latest display again. This ensures a user's device eventually receives the updated display contents and doesn't hang which would require the user to cycle the page again.
 """
 
 import asyncio
 import base64
-import json
 import logging
-import urllib.request
-import websockets
+import os
+import sys
+from functools import partial
 from enum import StrEnum
 
+# Shared helper modules are located next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from xplane_display_frame import DisplayFrame  # pylint: disable=wrong-import-position,import-error
+from mobiflight_sink import MobiFlightSink, discover_endpoints  # pylint: disable=wrong-import-position,import-error
+from xplane_dataref_cache import load_dataref_mappings  # pylint: disable=wrong-import-position,import-error
+from xplane_dataref_subscription import DatarefSubscription  # pylint: disable=wrong-import-position,import-error
+from state_mailbox import StateMailbox  # pylint: disable=wrong-import-position,import-error
+
 CDU_COLUMNS = 24
 CDU_ROWS = 14
 CDU_CELLS = CDU_COLUMNS * CDU_ROWS
@@ -34,7 +40,7 @@ CDU_CELLS = CDU_COLUMNS * CDU_ROWS
 WEBSOCKET_HOST = "localhost"
 WEBSOCKET_PORT = 8320
 
-BASE_REST_URL = "http://localhost:8086/api/v2/datarefs"
+BASE_API_URL = "http://localhost:8086/api"
 BASE_WEBSOCKET_URI = f"ws://{WEBSOCKET_HOST}:8086/api/v2"
 
 WS_CAPTAIN = f"ws://{WEBSOCKET_HOST}:{WEBSOCKET_PORT}/winwing/cdu-captain"
@@ -44,9 +50,6 @@ CHARACTER_MAPPING = {"`": "°", "*": "☐", "=": "*"}
 COLOR_MAPPING = {"G": "g", "C": "c", "I": "e", "M": "m"}
 
 
-FONT_REQUEST = json.dumps({"Target": "Font", "Data": "Boeing"})
-
-
 class CduDevice(StrEnum):
     Captain = "fmc1"
     CoPilot = "fmc2"
@@ -61,22 +64,16 @@ class CduDevice(StrEnum):
                 raise KeyError(f"Invalid device specified {self}")
 
 
-def fetch_dataref_mapping(device: CduDevice):
-    with urllib.request.urlopen(BASE_REST_URL, timeout=5) as response:
-        response_json = json.load(response)
+def select_cdu_datarefs(device: CduDevice, datarefs: list[dict]) -> dict[int, str]:
+    prefix = f"laminar/B738/{device}"
+    return {int(dataref["id"]): str(dataref["name"]) for dataref in datarefs if str(dataref["name"]).startswith(prefix)}
 
-        data = list(response_json["data"])
-        dataref_map = filter(
-            lambda x: str(x["name"]).startswith(f"laminar/B738/{device}"),
-            data,
-        )
 
-        return dict(
-            map(
-                lambda dataref: (int(dataref["id"]), str(dataref["name"])),
-                dataref_map,
-            )
-        )
+async def fetch_dataref_mappings(devices: list[CduDevice]) -> dict[CduDevice, dict[int, str]]:
+    mappings = await load_dataref_mappings(
+        {f"zibo_737_800x/{device}": partial(select_cdu_datarefs, device) for device in devices}, BASE_API_URL
+    )
+    return {device: mappings[f"zibo_737_800x/{device}"] for device in devices}
 
 
 def get_color(dataref: str) -> bool:
@@ -119,173 +116,89 @@ def process_cdu_line(line_datarefs: dict[str, str], row: int) -> list[list]:
     return line_chars
 
 
-def group_datarefs_by_line(values: dict[str, str]) -> dict[int, dict[str, str]]:
-    grouped_datarefs = {}
-
-    for dataref, value in values.items():
-        dataref_name = dataref[dataref.rindex("/") + 1 :]
-        line_num = (
-            7 if dataref_name.startswith("Line_entry") else int(dataref_name[4:6])
-        )
+def get_line_number(dataref: str) -> int:
+    dataref_name = dataref[dataref.rindex("/") + 1 :]
+    return 7 if dataref_name.startswith("Line_entry") else int(dataref_name[4:6])
 
-        if line_num not in grouped_datarefs:
-            grouped_datarefs[line_num] = {}
-        grouped_datarefs[line_num][dataref] = value
 
-    return grouped_datarefs
+# Rows covered by each dataref line. Row 0 is covered by line 0 alone, all other lines cover 2 rows between the label and the main content.
+# Row 1 is skipped, row 14 is the scratchpad line and is drawn on the last display row.
+LINE_ROWS = {0: [0], **{line: [line * 2, line * 2 + 1] for line in range(1, 7)}, 7: [14]}
 
 
-def generate_display_json(values: dict[str, str]) -> str:
-    display_data = [[] for _ in range(CDU_CELLS)]
-
-    grouped_datarefs = group_datarefs_by_line(values)
-
-    for row in range(CDU_ROWS + 1):
-        if row == 1:
-            continue
-
-        dataref_line = row // 2 if row > 0 else 0
+def render_line(line: int, line_datarefs: dict[str, str], display_data: list) -> None:
+    for row in LINE_ROWS.get(line, []):
+        start_index = (row - 1 if row > 0 else row) * CDU_COLUMNS
+        display_data[start_index : start_index + CDU_COLUMNS] = process_cdu_line(line_datarefs, row)
 
-        line_datarefs = grouped_datarefs.get(dataref_line, {})
-        if not line_datarefs:
-            continue
 
-        line_chars = process_cdu_line(line_datarefs, row)
+def create_display_frame() -> DisplayFrame:
+    return DisplayFrame(get_line_number, render_line)
 
-        start_index = (row - 1 if row > 0 else row) * CDU_COLUMNS
-        display_data[start_index : start_index + CDU_COLUMNS] = line_chars
 
-    return json.dumps({"Target": "Display", "Data": display_data})
+def generate_display_json(values: dict[str, str]) -> str:
+    return create_display_frame().update(values)
 
 
-async def handle_device_update(queue: asyncio.Queue, device: CduDevice):
+async def handle_device_update(mailbox: StateMailbox, device: CduDevice, sink: MobiFlightSink):
     """
     Translates and sends dataref updates to MobiFlight.
     """
     last_run_time = 0
     rate_limit_time = 0.1
 
-    endpoint = device.get_endpoint()
-    logging.info("Connecting to CDU device %s", device)
-    async for websocket in websockets.connect(endpoint):
-        logging.info("Connected successfully to CDU device %s", device)
-        while True:
-            values = await queue.get()
-
-            try:
-                elapsed = asyncio.get_event_loop().time() - last_run_time
-
-                # Weaker CPUs may experience performance issues when a websocket connection is saturated with requests, such as when pages are frequently changed.
-                # This rate limits the number of active websocket requests to MobiFlight.
-                # The delay should not be noticeable unless a user heavily spams page changes, but it should be enough that too many messages won't be pushed at once.
-                if elapsed < rate_limit_time:
-                    await asyncio.sleep(rate_limit_time - elapsed)
-
-                display_json = generate_display_json(values)
-                await websocket.send(display_json)
-                last_run_time = asyncio.get_event_loop().time()
-
-            except websockets.exceptions.ConnectionClosed:
-                logging.error(
-                    "MobiFlight websocket connection was closed... Attempting to reconnect"
-                )
-                await queue.put(values)
-                break
-
-
-async def handle_dataref_updates(queue: asyncio.Queue, device: CduDevice):
-    last_known_values = {}
-
-    dataref_map = fetch_dataref_mapping(device)
-    logging.info("Connecting to X-Plane websocket server")
-    async for websocket in websockets.connect(
-        BASE_WEBSOCKET_URI,
-    ):
-        logging.info("Connected successfully to X-Plane websocket server")
-        try:
-            await websocket.send(
-                json.dumps(
-                    {
-                        "type": "dataref_subscribe_values",
-                        "req_id": 1,
-                        "params": {
-                            "datarefs": [
-                                {"id": id_value} for id_value in dataref_map.keys()
-                            ]
-                        },
-                    }
-                )
-            )
-            while True:
-                message = await websocket.recv()
-                data = json.loads(message)
+    # Only rows affected by changed datarefs are re-rendered into the persistent frame
+    display_frame = create_display_frame()
 
-                if "data" not in data:
-                    continue
+    # The sink reconnects on its own and redelivers the latest display after a reconnect
+    sink_task = asyncio.create_task(sink.run())
+    try:
+        while True:
+            await mailbox.wait()
 
-                new_values = dict(last_known_values)
+            elapsed = asyncio.get_event_loop().time() - last_run_time
 
-                for dataref_id, value in data["data"].items():
-                    dataref_id = int(dataref_id)
-                    if dataref_id not in dataref_map:
-                        continue
+            # Weaker CPUs may experience performance issues when a websocket connection is saturated with requests, such as when pages are frequently changed.
+            # This rate limits the number of active websocket requests to MobiFlight.
+            # The delay should not be noticeable unless a user heavily spams page changes, but it should be enough that too many messages won't be pushed at once.
+            if elapsed < rate_limit_time:
+                await asyncio.sleep(rate_limit_time - elapsed)
 
-                    dataref_name = dataref_map[dataref_id]
+            # States that arrived during the rate limit supersede the one that woke us up
+            values, trace = mailbox.get_traced_nowait()
 
-                    new_values[dataref_name] = (
-                        base64.b64decode(value).decode().replace("\x00", " ")
-                    )
+            display_json = display_frame.update(values, trace)
+            sink.post(display_json, trace)
+            last_run_time = asyncio.get_event_loop().time()
+    finally:
+        sink_task.cancel()
+        mailbox.log_stats()
+        await sink.close()
 
-                if new_values == last_known_values:
-                    continue
 
-                last_known_values = new_values
-                await queue.put(new_values)
-        except websockets.exceptions.ConnectionClosed:
-            logging.error(
-                "X-Plane websocket connection was closed... Attempting to reconnect"
-            )
-            continue
+def decode_dataref_value(dataref_name: str, value):
+    return base64.b64decode(value).decode().replace("\x00", " ")
 
 
-async def get_available_devices() -> list[CduDevice]:
-    device_candidates = [device for device in CduDevice]
-
-    available_devices = []
-
+async def get_available_devices() -> dict[CduDevice, MobiFlightSink]:
     logging.info("Checking MobiFlight for available CDU devices")
-    for device in device_candidates:
-        device_endpoint = device.get_endpoint()
-        try:
-            async with websockets.connect(device_endpoint) as socket:
-                logging.info(
-                    "Discovered CDU device %s at endpoint %s", device, device_endpoint
-                )
-                available_devices.append(device)
-                await socket.send(FONT_REQUEST)
-                await asyncio.sleep(1) # wait a second for font to be set
-        except websockets.WebSocketException:
-            logging.warning(
-                "Attempted to probe CDU device %s at endpoint %s but device wasn't available",
-                device,
-                device_endpoint,
-            )
-            continue
-
-    return available_devices
+    # All endpoints are probed at once, the probe connections are kept for sending the display updates
+    return await discover_endpoints({device: device.get_endpoint() for device in CduDevice}, font="Boeing")
 
 
 async def main():
     available_devices = await get_available_devices()
+    dataref_maps = await fetch_dataref_mappings(list(available_devices))
+    subscription = DatarefSubscription(BASE_WEBSOCKET_URI)
 
     tasks = []
-    for device in available_devices:
-        queue = asyncio.Queue()
-
-        tasks.append(asyncio.create_task(handle_dataref_updates(queue, device)))
-        tasks.append(asyncio.create_task(handle_device_update(queue, device)))
+    for device, sink in available_devices.items():
+        mailbox = StateMailbox(f"{device} datarefs")
+        subscription.add_feed(device, dataref_maps[device], mailbox, decode_dataref_value)
+        tasks.append(asyncio.create_task(handle_device_update(mailbox, device, sink)))
+    tasks.append(asyncio.create_task(subscription.run()))
 
-    logging.info("Started background tasks for %s", available_devices)
+    logging.info("Started background tasks for %s", list(available_devices))
 
     await asyncio.gather(*tasks)
 